@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+N2Sys push agent.
+
+Runs on a managed server and periodically POSTs the raw output of the collection commands to
+the backend (`/ingest/inventory`), which parses and stores them like an SSH collection.
+Only the standard library is used so the script can be copied to any host with python3.
+It must run as root to read the login records.
+
+    n2sys_agent.py --url http://backend:3876 --token-file /etc/n2sys/agent_token [--interval 600] [--once]
+
+The token is issued by an admin with POST /server/{server_id}/agent_token.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+# Keep in sync with backend/server_helpers.py
+RELEASE_CMD = "cat /etc/*release | grep -i DISTRIB_DESCRIPTION"
+NIC_DUMP_CMD = "lspci -D; echo '#N2SYS#'; for i in /sys/class/net/*; do echo \"${i##*/} $(readlink \"$i/device\")\"; done"
+INVENTORY_FINGERPRINT_CMD = "{ uname -r; cat /etc/*release; " + NIC_DUMP_CMD + "; } 2>/dev/null | sha256sum | cut -d' ' -f1"
+LOGIN_RECORDS_CMD = "date '+%Y-%m-%d %H:%M:%S'; LC_ALL=C last -F -R -w 2>/dev/null"
+
+def run(cmd: str) -> str:
+    result = subprocess.run(["bash", "-c", cmd], capture_output=True, text=True, timeout=30)
+    return result.stdout
+
+def collect() -> dict:
+    return {
+        "kernel": run("uname -r"),
+        "release": run(RELEASE_CMD),
+        "nics": run(NIC_DUMP_CMD),
+        "logins": run(LOGIN_RECORDS_CMD),
+        "fingerprint": run(INVENTORY_FINGERPRINT_CMD).strip(),
+    }
+
+def push(url: str, token: str, report: dict) -> dict:
+    request = urllib.request.Request(
+        url.rstrip("/") + "/ingest/inventory",
+        data=json.dumps(report).encode(),
+        headers={"Content-Type": "application/json", "Authorization": f"Bearer {token}"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+def main():
+    parser = argparse.ArgumentParser(description="Push the inventory of this server to N2Sys")
+    parser.add_argument("--url", required=True, help="Base URL of the backend")
+    parser.add_argument("--token", default=os.getenv("N2SYS_AGENT_TOKEN"), help="Agent token (default: $N2SYS_AGENT_TOKEN)")
+    parser.add_argument("--token-file", help="File containing the agent token")
+    parser.add_argument("--interval", type=float, default=600, help="Seconds between two reports")
+    parser.add_argument("--once", action="store_true", help="Push one report and exit")
+    args = parser.parse_args()
+
+    token = args.token
+    if args.token_file:
+        with open(args.token_file) as f:
+            token = f.read().strip()
+    if not token:
+        parser.error("an agent token is required")
+
+    while True:
+        try:
+            print(f"Pushed inventory: {push(args.url, token, collect())}", flush=True)
+        except (urllib.error.URLError, OSError, subprocess.SubprocessError) as e:
+            print(f"Error pushing inventory: {e}", file=sys.stderr, flush=True)
+            if args.once:
+                sys.exit(1)
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 import asyncssh
+import base64
+import shlex
 
 async def sshAccountIsExists(conn: asyncssh.SSHClientConnection, account: str) -> bool:
     """
@@ -151,4 +153,140 @@ async def sshAccountUnsudo(conn: asyncssh.SSHClientConnection, account: str) ->
     if result.exit_status != 0:
         err_result = result.stderr.strip()
         return False, err_result
-    return True, None
\ No newline at end of file
+    return True, None
+
+async def sshAccountsSnapshot(conn: asyncssh.SSHClientConnection, accounts: list[str]) -> dict:
+    """
+    Read the state of many accounts on the server in one command: the passwd database,
+    the members of the sudo group and the authorized keys (or their .n2sysbackup) of every account.
+    Returns {"passwd": {account: entry}, "sudoers": set, "keys": {account: (state, keys)}}
+    where state is "keys", "backup" or "none".
+    """
+    names = " ".join(shlex.quote(account) for account in accounts)
+    cmd = (
+        "getent passwd; echo '#N2SYS#'; "
+        "getent group sudo | cut -d: -f4; echo '#N2SYS#'; "
+        f"for a in {names}; do "
+        "if sudo test -f \"/home/$a/.ssh/authorized_keys\"; then echo \"$a keys $(sudo base64 -w0 \"/home/$a/.ssh/authorized_keys\")\"; "
+        "elif sudo test -f \"/home/$a/.ssh/authorized_keys.n2sysbackup\"; then echo \"$a backup $(sudo base64 -w0 \"/home/$a/.ssh/authorized_keys.n2sysbackup\")\"; "
+        "else echo \"$a none\"; fi; "
+        "done"
+    )
+    result = await conn.run(cmd, timeout=10)
+    if result.exit_status != 0:
+        raise Exception(f"Error reading accounts state: {result.stderr.strip()}")
+    passwd_out, sudo_out, keys_out = result.stdout.split("#N2SYS#\n")
+    passwd = {}
+    for line in passwd_out.splitlines():
+        name = line.split(":", 1)[0]
+        if name:
+            passwd[name] = line
+    sudoers = set(member for member in sudo_out.strip().split(",") if member)
+    keys = {}
+    for line in keys_out.splitlines():
+        parts = line.split(" ")
+        if len(parts) < 2:
+            continue
+        content = base64.b64decode(parts[2]).decode(errors="replace").strip() if len(parts) > 2 else ""
+        keys[parts[0]] = (parts[1], content)
+    return {"passwd": passwd, "sudoers": sudoers, "keys": keys}
+
+# Reconcile script, runs as root on the server and is fed through stdin.
+# Every `reconcile` call brings one account to its desired state with the same end state as the
+# sshAccount* helpers above, and prints one line: RESULT <name> <ok|error> <changes> <base64 error>
+RECONCILE_SCRIPT = r'''
+b64() { printf '%s' "$1" | base64 -w0; }
+result() { echo "RESULT $(b64 "$1") $2 ${3:--} $(b64 "$4") ${5:--}"; }
+# Hash of the desired state and of everything the reconcile looks at on the host
+fingerprint() {
+    local home="/home/$1"
+    { printf '%s\n' "$2" "$3" "$4"; getent passwd "$1"; id -nG "$1" 2>/dev/null
+      cat "$home/.ssh/authorized_keys" 2>/dev/null; echo '#'
+      stat -c '%U %a' "$home/.ssh/authorized_keys" 2>/dev/null
+      [ -f "$home/.ssh/authorized_keys.n2sysbackup" ] && echo backup; } | sha256sum | cut -d' ' -f1
+}
+reconcile() {
+    local name keys login="$2" sudo="$3" home changes="" err ent members
+    name=$(printf '%s' "$1" | base64 -d)
+    [ "$4" = - ] || keys=$(printf '%s' "$4" | base64 -d)
+    home="/home/$name"
+    if [ "$5" = "$(fingerprint "$name" "$2" "$3" "$4")" ]; then
+        result "$name" ok unchanged "" "$5"
+        return
+    fi
+    if ! getent passwd "$name" >/dev/null; then
+        err=$(useradd "$name" -m -d "$home" 2>&1) || { result "$name" error "$changes" "$err"; return; }
+        err=$(echo "$name:123456" | chpasswd --crypt-method=SHA256 2>&1) || { result "$name" error "$changes" "$err"; return; }
+        changes="$changes,created"
+    fi
+    if [ "$login" != 1 ]; then
+        if [ -f "$home/.ssh/authorized_keys" ]; then
+            err=$(mv "$home/.ssh/authorized_keys" "$home/.ssh/authorized_keys.n2sysbackup" 2>&1) || { result "$name" error "$changes" "$err"; return; }
+            changes="$changes,disabled"
+        fi
+        result "$name" ok "${changes#,}" "" "$(fingerprint "$name" "$2" "$3" "$4")"
+        return
+    fi
+    local old="" merged
+    if [ -f "$home/.ssh/authorized_keys" ]; then
+        old=$(cat "$home/.ssh/authorized_keys")
+    elif [ -f "$home/.ssh/authorized_keys.n2sysbackup" ]; then
+        old=$(cat "$home/.ssh/authorized_keys.n2sysbackup")
+    fi
+    merged=$(awk 'FNR == NR { seen[$0] = 1; print; next } !($0 in seen) { seen[$0] = 1; print }' \
+        <(printf '%s\n' "$old") <(printf '%s\n' "$keys") | grep -v '^[[:space:]]*$')
+    if [ ! -f "$home/.ssh/authorized_keys" ] || [ "$(cat "$home/.ssh/authorized_keys")" != "$merged" ]; then
+        err=$(mkdir -p "$home/.ssh" 2>&1 && printf '%s\n' "$merged" 2>&1 > "$home/.ssh/authorized_keys") || { result "$name" error "$changes" "$err"; return; }
+        changes="$changes,keys"
+    fi
+    err=$(chown "$name:$name" "$home/.ssh/authorized_keys" 2>&1 && chmod 600 "$home/.ssh/authorized_keys" 2>&1) || { result "$name" error "$changes" "$err"; return; }
+    ent=$(getent passwd "$name")
+    case "$ent" in
+        */bin/false*|*/usr/sbin/nologin*)
+            err=$(usermod -s /bin/bash "$name" 2>&1) || { result "$name" error "$changes" "$err"; return; }
+            changes="$changes,shell" ;;
+    esac
+    members=$(getent group sudo | cut -d: -f4)
+    case ",$members," in
+        *",$name,"*) [ "$sudo" = 1 ] || { err=$(gpasswd -d "$name" sudo 2>&1) || { result "$name" error "$changes" "$err"; return; }; changes="$changes,unsudo"; } ;;
+        *) [ "$sudo" != 1 ] || { err=$(usermod -aG sudo "$name" 2>&1) || { result "$name" error "$changes" "$err"; return; }; changes="$changes,sudo"; } ;;
+    esac
+    result "$name" ok "${changes#,}" "" "$(fingerprint "$name" "$2" "$3" "$4")"
+}
+'''
+
+async def sshAccountsReconcile(conn: asyncssh.SSHClientConnection, accounts: list[dict]) -> dict[str, dict]:
+    """
+    Bring many accounts to their desired state in a single round-trip: the reconcile script and the
+    desired state of every account are sent on stdin to one `sudo bash -s`.
+    Each account is a dict with "name", "is_login_able", "is_sudo", "public_key" and optionally the
+    "fingerprint" of its last successful reconcile: if the host still computes the same fingerprint the
+    account is left untouched and reported with the "unchanged" change.
+    Returns {name: {"ok": bool, "changes": [str], "error": str, "fingerprint": str}}, accounts missing
+    from the output are reported as failed.
+    """
+    def b64(value: str) -> str:
+        return base64.b64encode(value.encode()).decode()
+    lines = [RECONCILE_SCRIPT]
+    for account in accounts:
+        lines.append(f"reconcile {b64(account['name'])} {int(account['is_login_able'])} {int(account['is_sudo'])} {b64(account['public_key']) or '-'} {account.get('fingerprint') or '-'}")
+    script = "\n".join(lines) + "\n"
+    results = {account["name"]: {"ok": False, "changes": [], "error": "No result from reconcile script", "fingerprint": ""} for account in accounts}
+    result = await conn.run("sudo bash -s", input=script, timeout=10 + 2 * len(accounts))
+    for line in result.stdout.splitlines():
+        parts = line.split(" ")
+        if len(parts) != 6 or parts[0] != "RESULT":
+            continue
+        name = base64.b64decode(parts[1]).decode(errors="replace")
+        results[name] = {
+            "ok": parts[2] == "ok",
+            "changes": [] if parts[3] == "-" else parts[3].split(","),
+            "error": base64.b64decode(parts[4]).decode(errors="replace").strip(),
+            "fingerprint": "" if parts[5] == "-" else parts[5],
+        }
+    if result.exit_status != 0:
+        err_result = result.stderr.strip()
+        for name in results:
+            if not results[name]["ok"] and results[name]["error"] == "No result from reconcile script":
+                results[name]["error"] = err_result
+    return results
@@ -1,389 +1,673 @@
 import asyncio
-from app.database import Account, SessionLocal, AccountStatus, Server, User, UserStatus, ServerStatus, ServerInterface
+from app.database import Account, SessionLocal, AccountStatus, Server, User, UserStatus, ServerStatus, ServerInterface, SyncJob, SyncJobKind, SyncJobState
 from logger import logger
-from sqlalchemy.orm import make_transient
+from sqlalchemy import exists, insert, literal, or_, select, true, update
+from sqlalchemy.orm import Session, make_transient
 from account_helpers import *
 from server_helpers import *
 import asyncssh
 import copy
 from contextlib import asynccontextmanager
+from connection_pool import ConnectionPool
+from sync_events import bindLoop, notifySync, waitForSync
+from sync_scheduler import Priority, SyncScheduler
+from sync_jobs import claimJob, enqueueJobs, finishJob, isClaimable, nextJobDelay, postponeJob, releaseLeases, renewLeases, worker_id
+from leader_lease import acquireLease, releaseLease
+from server_health import HealthTracker
+from server_inventory import applyServerInventory, applyUnchangedInventory
+from db_executor import runInSession
+from loop_monitor import LoopLagMonitor
+from metrics import SSH_CONNECT_SECONDS, WATCHER_ROUTINE_SECONDS, MeteredConnection
 import datetime
-# async semaphore to limit the number of concurrent tasks
-
+import time
+# Scheduler limiting the number of concurrent tasks, in total, per server and per proxy
 concurrent_tasks = 20
-semaphore = asyncio.Semaphore(concurrent_tasks)
+scheduler = SyncScheduler(max_running=concurrent_tasks, max_per_server=2, max_per_proxy=8, max_queued=1000)
+
+# Send every account of a batch to the server as one reconcile script instead of one command per step
+reconcile_with_script = True
+
+# SSH connections shared by account sync and server collection
+pool = ConnectionPool(max_per_server=4, idle_timeout=300, keepalive_interval=30)
+
+# Backoff and circuit breaker of unreachable servers
+health = HealthTracker(base_backoff=15, max_backoff=1800, failure_threshold=3)
+# Delay before failed accounts on a reachable server are retried
+account_retry_delay = 60
+
+# Reports when the event loop shared by the engine and the API is blocked
+loop_monitor = LoopLagMonitor(interval=0.1, warn_threshold=0.02)
+
+# Servers whose push agent reported within this delay are not collected over SSH
+agent_stale_after = datetime.timedelta(minutes=30)
+
+# Delay between two collections of a server
+collect_interval = datetime.timedelta(hours=1)
+# Leases of the claimed jobs, renewed every third of the lease until the engine stopped and its jobs finished
+job_lease = datetime.timedelta(seconds=90)
+# Shortest delay before a job denied by the server health is looked at again
+min_postpone = 5
+
+# The watcher is woken by notifySync, the periodic tick only catches what was not notified
+watcher_interval = 300
+# Dirty accounts written by the other API workers are not notified to this process, poll them
+dirty_poll_interval = 5
+
+# Only the process holding the leader lease runs the sync engine, the others only serve the API
+leader_lease_name = "sync_engine"
+leader_lease_ttl = datetime.timedelta(seconds=30)
 
-syncing_accounts = {}
-last_server_collect_date = {}
-last_server_collecting = {}
 start_watcher = False
+run_election = False
+# Task running watchAccountSync, stopEngine waits for it before releasing anything
+watcher_task = None
+# Task renewing the job leases, it outlives start_watcher until the last running job finished
+lease_renewer = None
 
 def startWatcher():
-    global start_watcher
-    start_watcher = True
+    """
+    Start the leader election of this process, the sync engine runs while it is the leader.
+    """
+    global run_election
+    run_election = True
+    loop_monitor.start()
     loop = asyncio.get_event_loop()
-    loop.create_task(watchAccountSync())
+    bindLoop(loop)
+    loop.create_task(electLeader())
 
 async def stopWatcher():
-    global start_watcher
+    global run_election
+    run_election = False
+    if start_watcher:
+        await stopEngine()
+    await runInSession(releaseLease, leader_lease_name, worker_id)
+    loop_monitor.stop()
+
+async def electLeader():
+    """
+    Take or renew the leader lease every third of its ttl, start the engine when it is won and
+    stop it when it is lost (e.g. the database was unreachable longer than the ttl).
+    """
+    while run_election:
+        try:
+            leader = await runInSession(acquireLease, leader_lease_name, worker_id, leader_lease_ttl)
+        except Exception as e:
+            logger.error(f"Error renewing the leader lease: {e}")
+            leader = False
+        if not run_election:
+            break
+        if leader and not start_watcher:
+            logger.info(f"Worker {worker_id} is the sync engine leader, starting the engine.")
+            startEngine()
+        elif not leader and start_watcher:
+            logger.warning(f"Worker {worker_id} lost the sync engine leadership, stopping the engine.")
+            await stopEngine()
+        await asyncio.sleep(leader_lease_ttl.total_seconds() / 3)
+
+def startEngine():
+    global start_watcher, watcher_task, lease_renewer
+    start_watcher = True
+    pool.start()
+    loop = asyncio.get_event_loop()
+    if watcher_task is None:
+        watcher_task = loop.create_task(watchAccountSync())
+    if lease_renewer is None:
+        lease_renewer = loop.create_task(renewJobLeases())
+
+async def stopEngine():
+    global start_watcher, watcher_task, lease_renewer
     start_watcher = False
+    notifySync()
+    # The watcher may be claiming jobs, nothing is released until it stopped submitting them
+    if watcher_task is not None:
+        await watcher_task
+        watcher_task = None
     waiting_ticks = 0
     while True:
         logger.info(f"Waiting for tasks to finish. Waiting {waiting_ticks} seconds.")
         waiting_ticks += 1
-        finished = True
-        for account_id in syncing_accounts:
-            if syncing_accounts[account_id]:
-                finished = False
-        for server_id in last_server_collecting:
-            if last_server_collecting[server_id]:
-                finished = False
-        if finished:
+        if scheduler.isIdle():
             break
         await asyncio.sleep(1)
+    # The running jobs kept their leases until now, the next leader must not claim them while they run here
+    if lease_renewer is not None:
+        lease_renewer.cancel()
+        lease_renewer = None
+    await runInSession(releaseLeases)
+    await pool.closeAll()
     logger.info("All tasks finished. Stopping watcher.")
 
+class ServerUnreachable(Exception):
+    pass
+
+def setServerStatus(db: Session, server_id: int, status: ServerStatus):
+    db.execute(update(Server).where(Server.id == server_id).values(server_status=status))
+    db.commit()
+
+async def recordReachability(server: Server, error: Exception | None):
+    """
+    Feed the reachability of the server into its health, the circuit state is mirrored to Server.server_status.
+    `error` is None once a connection was obtained, a ServerUnreachable when connecting failed; other
+    errors (the database, a command) tell nothing about the server and leave its health alone.
+    """
+    if error is None:
+        if health.recordSuccess(server.id):
+            logger.info(f"Server {server.host} is reachable again, closing its circuit.")
+            await runInSession(setServerStatus, server.id, ServerStatus.ACTIVE)
+            # Pick up the work held back while the circuit was open
+            notifySync()
+    elif isinstance(error, ServerUnreachable):
+        if health.recordFailure(server.id, str(error)):
+            logger.warning(f"Server {server.host} is unreachable, opening its circuit for {health.retryDelay(server.id):.0f}s.")
+            await runInSession(setServerStatus, server.id, ServerStatus.UNABLE_TO_REACH)
+    elif health.isProbing(server.id):
+        # The probe failed before reaching the server, let the next job probe it again
+        health.cancelProbe(server.id)
+
+def resolveRoute(db: Session, server_id: int) -> tuple[tuple[int, str, int], ...]:
+    """
+    Get the hops (id, host, port) to reach the server, from the outermost jump host to the server itself.
+    """
+    route = []
+    server = db.query(Server).filter(Server.id == server_id).first()
+    if not server:
+        raise Exception(f"Server {server_id} not found in database while getting connection.")
+    while server:
+        if any(hop[0] == server.id for hop in route):
+            raise Exception(f"Proxy loop detected while resolving the route to server {server_id}.")
+        route.insert(0, (server.id, server.host, server.port))
+        server = server.proxy_server
+    return tuple(route)
+
+async def openConnection(route: tuple[tuple[int, str, int], ...]) -> asyncssh.SSHClientConnection:
+    """
+    Open a connection along the route, the jump hosts are reached through the shared tunnels of the pool.
+    """
+    keepalive = {"keepalive_interval": pool.keepalive_interval, "keepalive_count_max": pool.keepalive_count_max}
+    *proxies, (_, host, port) = route
+    if not proxies:
+        logger.info(f"Connecting to server {host}:{port} directly.")
+        with SSH_CONNECT_SECONDS.labels(host).time():
+            return await asyncio.wait_for(asyncssh.connect(host=host, port=port, known_hosts=None, **keepalive), timeout=3) # TODO: add known_hosts
+    proxy_route = tuple(proxies)
+    proxy_id, proxy_host, proxy_port = proxy_route[-1]
+    tunnel = await pool.tunnel(proxy_id, proxy_route, lambda: openConnection(proxy_route),
+                               via=tuple(hop[0] for hop in proxy_route[:-1]))
+    logger.info(f"Connecting to server {host}:{port} through proxy {proxy_host}:{proxy_port}")
+    with SSH_CONNECT_SECONDS.labels(host).time():
+        return await asyncio.wait_for(
+            asyncssh.connect(host=host, port=port, tunnel=tunnel, known_hosts=None, **keepalive),
+            timeout=6
+        )
+
 @asynccontextmanager
 async def getConnection(srv: Server):
-    db = SessionLocal()
+    """
+    Lease a pooled connection to the server, the connection is reused by later operations on the same server.
+    """
     try:
-        server = db.query(Server).filter(Server.id == srv.id).first()
-        if not server:
-            raise Exception(f"Server {server.id} not found in database while getting connection.")
-        if not server.proxy_server:
-            host = server.host
-            port = server.port
-            db.close()
-            logger.info(f"Connecting to server {host}:{port} directly.")
-            conn = await asyncio.wait_for(asyncssh.connect(host=host, port=port, known_hosts=None), timeout=3) # TODO: add known_hosts
-            yield conn
-            conn.close()
-        else:
-            logger.info(f"Connecting to server {server.host}:{server.port} through proxy {server.proxy_server.host}:{server.proxy_server.port}")
-            # generate ssh config
-            ssh_config_path = './ssh/'
-            ssh_config_file = f"{ssh_config_path}ssh_config_{server.id}"
-            # mkdir if not exists
-            import os
-            if not os.path.exists(ssh_config_path):
-                os.makedirs(ssh_config_path)
-            with open(ssh_config_file, 'w') as f:
-                f.write(f"Host {server.proxy_server.host}\n")
-                f.write(f"    HostName {server.proxy_server.host}\n")
-                f.write(f"    Port {server.proxy_server.port}\n")
-                f.write(f"\n")
-                f.write(f"Host {server.host}\n")
-                f.write(f"    HostName {server.host}\n")
-                f.write(f"    Port {server.port}\n")
-                f.write(f"    ProxyJump {server.proxy_server.host}:{server.proxy_server.port}\n")
-            default_config_path = os.path.expanduser("~/.ssh/config")
-            host = server.host
-            port = server.port
-            db.close()
-            conn = await asyncio.wait_for(
-                asyncssh.connect(
-                    host=host,
-                    port=port,
-                    known_hosts=None,
-                    config=[default_config_path, ssh_config_file]
-                ),
-                timeout=6
-            )
-            yield conn
-            conn.close()
+        route = await runInSession(resolveRoute, srv.id)
+        via = tuple(hop[0] for hop in route[:-1])
+        async def connect() -> asyncssh.SSHClientConnection:
+            try:
+                return await openConnection(route)
+            except Exception as e:
+                raise ServerUnreachable(str(e) or type(e).__name__) from e
+        async with pool.connection(srv.id, route, connect, via) as conn:
+            await recordReachability(srv, None)
+            yield MeteredConnection(conn, srv.host)
     except Exception as e:
         logger.error(f"Error connecting to server {srv.host}: {e}")
         raise e
 
-async def doSyncAccount(user: User, server: Server, account: Account):
-    async with semaphore:
-        logger.info(f"Connecting to server {server.host}")
-        async with getConnection(server) as conn:
-            logger.info(f"Connected to server {server.host}")
-            # Step 1 - Check if the account exists if not create it
-            if not await sshAccountIsExists(conn, user.account_name):
-                logger.info(f"Account {user.account_name} does not exist. Creating it.")
-                result, err = await sshAccountCreate(conn, user.account_name)
-                if not result:
-                    raise Exception(f"Error creating account {user.account_name} on {server.host}: {err}")
-            else:
-                logger.info(f"Account {user.account_name} already exists. Skipping creation.")
-            # Step 2 - Make the account the same loginable as the account
-            if account.is_login_able:
-                old_authorized_keys = await sshAccountGetAuthorizedKeys(conn, user.account_name)
-                new_authorized_keys = user.public_key.split("\n")
-                # Merge the keys
-                final_keys = old_authorized_keys.split("\n")
-                for key in new_authorized_keys:
-                    if key not in final_keys:
-                        final_keys.append(key)
-                final_keys = [key for key in final_keys if key.strip() != ""]
-                logger.info(f"Enabling account {user.account_name} on {server.host} with {len(final_keys)} keys.")
-                final_keys = "\n".join(final_keys)
-                result, err = await sshAccountEnable(conn, user.account_name, final_keys)
-                if not result:
-                    raise Exception(f"Error enabling account {user.account_name} on {server.host}: {err}")
-            else:
-                result, err = await sshAccountDisable(conn, user.account_name)
-                if not result:
-                    raise Exception(f"Error disabling account {user.account_name} on {server.host}: {err}")
-                return
-            # Step 3 - Make the account sudoable if needed
-            if account.is_sudo:
-                result, err = await sshAccountSudo(conn, user.account_name)
-                if not result:
-                    raise Exception(f"Error making account {user.account_name} sudoable on {server.host}: {err}")
-            elif await sshAccountIsSudo(conn, user.account_name):
-                result, err = await sshAccountUnsudo(conn, user.account_name)
-                if not result:
-                    raise Exception(f"Error making account {user.account_name} no sudo on {server.host}: {err}")
-            else:
-                logger.info(f"Account {user.account_name} is not sudoable on {server.host}. Skipping.")
-
-async def syncAccount(user : User, server : Server, account: Account):
-    if not account.id:
-        logger.fatal(f"Account {account.id} not found in database, this will cause a crash.")
-        import os
-        os._exit(1)
+async def doSyncAccount(conn: asyncssh.SSHClientConnection, snapshot: dict, user: User, account: Account):
+    """
+    Bring one account to its desired state, the current state is taken from the server snapshot.
+    """
+    name = user.account_name
+    # Step 1 - Check if the account exists if not create it
+    if name not in snapshot["passwd"]:
+        logger.info(f"Account {name} does not exist. Creating it.")
+        result, err = await sshAccountCreate(conn, name)
+        if not result:
+            raise Exception(f"Error creating account {name}: {err}")
+    else:
+        logger.info(f"Account {name} already exists. Skipping creation.")
+    keys_state, old_authorized_keys = snapshot["keys"].get(name, ("none", ""))
+    # Step 2 - Make the account the same loginable as the account
+    if account.is_login_able:
+        new_authorized_keys = user.public_key.split("\n")
+        # Merge the keys
+        final_keys = old_authorized_keys.split("\n")
+        for key in new_authorized_keys:
+            if key not in final_keys:
+                final_keys.append(key)
+        final_keys = [key for key in final_keys if key.strip() != ""]
+        logger.info(f"Enabling account {name} with {len(final_keys)} keys.")
+        final_keys = "\n".join(final_keys)
+        result, err = await sshAccountEnable(conn, name, final_keys)
+        if not result:
+            raise Exception(f"Error enabling account {name}: {err}")
+    else:
+        if keys_state == "keys":
+            result, err = await sshAccountDisable(conn, name)
+            if not result:
+                raise Exception(f"Error disabling account {name}: {err}")
+        return
+    # Step 3 - Make the account sudoable if needed
+    if account.is_sudo:
+        if name not in snapshot["sudoers"]:
+            result, err = await sshAccountSudo(conn, name)
+            if not result:
+                raise Exception(f"Error making account {name} sudoable: {err}")
+    elif name in snapshot["sudoers"]:
+        result, err = await sshAccountUnsudo(conn, name)
+        if not result:
+            raise Exception(f"Error making account {name} no sudo: {err}")
+    else:
+        logger.info(f"Account {name} is not sudoable. Skipping.")
+
+async def doSyncServerAccounts(server: Server, entries: list[tuple[User, Account]]) -> tuple[dict[int, bool], dict[int, str]]:
+    """
+    Reconcile all the given accounts of one server over a single connection.
+    With `reconcile_with_script` this is a single round-trip, otherwise the state of the server is
+    read once and every account is brought to its desired state with the sshAccount* helpers.
+    Returns the result and the new sync fingerprint of every account keyed by account id, accounts
+    whose fingerprint still matches on the server are not touched.
+    """
+    results = {account.id: False for _, account in entries}
+    fingerprints = {}
+    logger.info(f"Connecting to server {server.host}")
+    async with getConnection(server) as conn:
+        logger.info(f"Connected to server {server.host}, syncing {len(entries)} accounts")
+        if reconcile_with_script:
+            desired = [{
+                "name": user.account_name,
+                "is_login_able": account.is_login_able,
+                "is_sudo": account.is_sudo,
+                "public_key": user.public_key,
+                "fingerprint": account.sync_fingerprint
+            } for user, account in entries]
+            reconciled = await sshAccountsReconcile(conn, desired)
+            for user, account in entries:
+                outcome = reconciled[user.account_name]
+                if outcome["ok"]:
+                    logger.info(f"Reconciled account {user.account_name} on {server.host}, changes: {outcome['changes']}")
+                    results[account.id] = True
+                    fingerprints[account.id] = outcome["fingerprint"]
+                else:
+                    logger.error(f"Error reconciling account {account.id} on server {server.host}: {outcome['error']}")
+            return results, fingerprints
+        snapshot = await sshAccountsSnapshot(conn, [user.account_name for user, _ in entries])
+        for user, account in entries:
+            try:
+                await doSyncAccount(conn, snapshot, user, account)
+                results[account.id] = True
+            except Exception as e:
+                logger.error(f"Error syncing account {account.id} on server {server.host}: {e}")
+    return results, fingerprints
+
+def finishAccountBatch(db: Session, job_id: int, server_id: int, account_ids: list[int], results: dict[int, bool],
+                       fingerprints: dict[int, str], retry_in: float, error: str) -> SyncJobState:
+    """
+    Store the outcome of a batch and of its job in one transaction, returns the new state of the job:
+    pending if accounts of the server became dirty meanwhile, failed (retried after `retry_in` seconds)
+    if accounts failed, done otherwise.
+    """
+    changed_ids = []
+    failed_ids = []
+    for account_db in db.query(Account).filter(Account.id.in_(account_ids)).all():
+        if account_db.status == AccountStatus.DIRTY:
+            logger.warning(f"Account {account_db.id} is dirty during updating.")
+            changed_ids.append(account_db.id)
+        elif results.get(account_db.id):
+            account_db.status = AccountStatus.ACTIVE
+            account_db.sync_fingerprint = fingerprints.get(account_db.id, "")
+        else:
+            account_db.status = AccountStatus.DIRTY
+            account_db.sync_fingerprint = ""
+            failed_ids.append(account_db.id)
+    db.flush()
+    now = datetime.datetime.now()
+    dirty_ids = [account_id for account_id, in db.query(Account.id).filter(
+        Account.server_id == server_id, Account.status == AccountStatus.DIRTY).all()]
+    if set(dirty_ids) - set(failed_ids):
+        # Changed while the batch was running, sync them again right away
+        state, next_run_at = SyncJobState.PENDING, now
+    elif failed_ids:
+        state, next_run_at = SyncJobState.FAILED, now + datetime.timedelta(seconds=retry_in)
+        error = error or f"Accounts {failed_ids} failed"
+    else:
+        state, next_run_at = SyncJobState.DONE, None
+    if not finishJob(db, job_id, state, next_run_at, error):
+        logger.warning(f"Lost the lease of sync job {job_id} while it was running.")
+    db.commit()
+    return state
+
+async def syncServerAccounts(server: Server, entries: list[tuple[User, Account]], job_id: int):
+    for _, account in entries:
+        if not account.id:
+            logger.fatal(f"Account {account.id} not found in database, this will cause a crash.")
+            import os
+            os._exit(1)
     try:
-        logger.info(f"Syncing account {account.id} for user {user.username} on server {server.host}")
-        success = False
+        logger.info(f"Syncing {len(entries)} accounts on server {server.host}")
+        results = {}
+        fingerprints = {}
+        error = None
         try:
-            await doSyncAccount(user, server, account)
-            success = True
+            results, fingerprints = await doSyncServerAccounts(server, entries)
         except Exception as e:
-            logger.error(f"Error syncing account {account.id}: {e}")
-        logger.info(f"Finished syncing account {account.id} for user {user.username} on server {server.host}")
-        
-        db = SessionLocal()
-        account_db = db.query(Account).filter(Account.id == account.id).first()
-        if not account_db:
-            logger.error(f"Account {account.id} not found in database.")
-        elif account_db.status == AccountStatus.DIRTY:
-            logger.warning(f"Account {account.id} is dirty during updating.")
-        else:
-            account_db.status = AccountStatus.ACTIVE if success else AccountStatus.DIRTY
-        db.commit()
-        db.close()
+            logger.error(f"Error syncing accounts on server {server.host}: {e}")
+            error = e
+            # A success was recorded by getConnection once the server answered
+            await recordReachability(server, error)
+        logger.info(f"Finished syncing {sum(results.values())}/{len(entries)} accounts on server {server.host}")
+
+        # Retry once the backoff of the server expired
+        retry_in = health.retryIn(server.id) or account_retry_delay
+        await runInSession(finishAccountBatch, job_id, server.id, [account.id for _, account in entries],
+                           results, fingerprints, retry_in, str(error or ""))
+        # Let the watcher pick up the rescheduled job
+        notifySync([])
     except Exception as e:
-        logger.error(f"Error processing clear transactions account {account.id}: {e}")
-    syncing_accounts[account.id] = False
+        logger.error(f"Error processing clear transactions on server {server.id}: {e}")
+
+def storeServerInventory(db: Session, server_id: int, *inventory) -> int | None:
+    """
+    Apply the collected inventory, returns None if the server was deleted meanwhile.
+    """
+    if not db.query(Server.id).filter(Server.id == server_id).first():
+        return None
+    return applyServerInventory(db, server_id, *inventory)
 
-async def syncServer(server: Server):
+def finishCollection(db: Session, job_id: int, next_run_at: datetime.datetime, error: str):
+    state = SyncJobState.FAILED if error else SyncJobState.DONE
+    if not finishJob(db, job_id, state, next_run_at, error):
+        logger.warning(f"Lost the lease of sync job {job_id} while it was running.")
+    db.commit()
+
+async def syncServer(server: Server, job_id: int):
+    error = ""
+    next_run_at = datetime.datetime.now() + collect_interval
     try:
         if not server.id:
             logger.fatal(f"Server {server.id} not found in database, this will cause a crash.")
             import os
             os._exit(1)
-        async with semaphore:
-            async with getConnection(server) as conn:
-                try:
-                    db = SessionLocal()
-                    server_db = db.query(Server).filter(Server.id == server.id).first()
-                    if not server_db:
-                        logger.error(f"Server {server.id} not found in database.")
-                        return
-                    server_db.server_status = ServerStatus.ACTIVE
-                    last_server_collect_date[server.id] = datetime.datetime.now()
-                    db.commit()
-                    db.close()
-
-                    # Step 1 - Get the kernel version
+        async with getConnection(server) as conn:
+            try:
+                # Step 1 - Fingerprint the inventory, an unchanged server only has its login history collected
+                fingerprint = await sshServerGetFingerprint(conn)
+                unchanged = fingerprint != "" and fingerprint == server.inventory_fingerprint
+                if unchanged:
+                    logger.info(f"Inventory of server {server.host} is unchanged, skipping its collection")
+                else:
+                    # Step 2 - Get the kernel version
                     kernel_version = await sshServerGetKernel(conn)
                     logger.info(f"Collecting kernel version from server {server.host} {kernel_version}")
-                    db = SessionLocal()
-                    server_db = db.query(Server).filter(Server.id == server.id).first()
-                    if not server_db:
-                        logger.error(f"Server {server.id} not found in database.")
-                        return
-                    server_db.kernel_version = kernel_version
-                    db.commit()
-                    db.close()
-
-                    # Step 2 - Get the release version
+
+                    # Step 3 - Get the release version
                     os_version = await sshServerGetRelease(conn)
-                    logger.info(f"Collecting release version from server {server.host} {os_version}")   
-                    db = SessionLocal() 
-                    server_db = db.query(Server).filter(Server.id == server.id).first()
-                    if not server_db:
-                        logger.error(f"Server {server.id} not found in database.")
-                        return
-                    server_db.os_version = os_version
-                    db.commit()
-                    db.close()
-
-                    # Step 3 - Get the NICs
-                    nics = await sshServerGetNICs(conn)
-                    ib_nics = await sshServerGetIBNICs(conn)
+                    logger.info(f"Collecting release version from server {server.host} {os_version}")
+
+                    # Step 4 - Get the NICs
+                    nics, ib_nics = await sshServerGetAllNICs(conn)
                     logger.info(f"Collecting NICs from server {server.host} {nics}")
                     logger.info(f"Collecting IB NICs from server {server.host} {ib_nics}")
-                    db = SessionLocal()
-                    server_db = db.query(Server).filter(Server.id == server.id).first()
-                    for nic in nics:
-                        old_interface = db.query(ServerInterface).filter(
-                            ServerInterface.server_id == server.id,
-                            ServerInterface.pci_address == nic["pci_address"]
-                        ).first()
-                        if old_interface:
-                            old_interface.interface = nic["interface_name"] if nic["interface_name"] else "No Name Eth"
-                            old_interface.manufacturer = nic["nic_name"]
-                        else:
-                            new_interface = ServerInterface(
-                                pci_address=nic["pci_address"],
-                                interface=nic["interface_name"] if nic["interface_name"] else "No Name Eth",
-                                manufacturer=nic["nic_name"],
-                                server_id=server.id
-                            )
-                            db.add(new_interface)
-                        db.commit()
-                    for ib_nic in ib_nics:
-                        old_interface = db.query(ServerInterface).filter(
-                            ServerInterface.server_id == server.id,
-                            ServerInterface.pci_address == ib_nic["pci_address"]
-                        ).first()
-                        if old_interface:
-                            old_interface.interface = ib_nic["interface_name"] if ib_nic["interface_name"] else "No Name IB"
-                            old_interface.manufacturer = ib_nic["nic_name"]
-                        else:
-                            new_interface = ServerInterface(
-                                pci_address=ib_nic["pci_address"],
-                                interface=ib_nic["interface_name"] if ib_nic["interface_name"] else "No Name IB",
-                                manufacturer=ib_nic["nic_name"],
-                                server_id=server.id
-                            )
-                            db.add(new_interface)
-                        db.commit()
-                    db.close()
-
-                    # Step 4 - Get the account login history
-                    db = SessionLocal()
-                    accounts = db.query(Account).filter(Account.server_id == server.id, Account.is_login_able == True).all()
-                    for account in accounts:
-                        db.refresh(account); db.expunge(account); make_transient(account)
-                    db.close()
-                    for account in accounts:
-                        db = SessionLocal()
-                        try:
-                            user = db.query(User).filter(User.id == account.user_id).first()
-                            if not user:
-                                db.close()
-                                raise Exception(f"User {account.user_id} not found in database.")
-                            account_name =  user.account_name
-                            db.close()
-                            status, login_date = await sshServerGetAccountLoginDate(conn, account_name)
-                            if not status:
-                                logger.error(f"Error collecting login date from server {server.host} for account {account_name}: {login_date}")
-                                continue
-                            # convert from +%Y-%m-%d %H:%M:%S to datetime
-                            logger.info(f"Collecting login date from server {server.host} for account {account_name} {login_date}")
-                            date = datetime.datetime.strptime(login_date, "%Y-%m-%d %H:%M:%S")
-                            db = SessionLocal()
-                            account_db = db.query(Account).filter(Account.id == account.id).first()
-                            if not account_db:
-                                db.close()
-                                raise Exception(f"Account {account.id} not found in database.")
-                            # update if date is newer
-                            if account_db.last_login_date < date:
-                                account_db.last_login_date = date
-                                db.commit()
-                            db.close()
-                        except Exception as e:
-                            logger.error(f"Error collecting login history for account {account.id} on server {server.host}: {str(e)}")
-                            continue
-                except Exception as e:
-                    logger.error(f"Error collecting data from server {server.host}: {e}")
-                    server.server_status = ServerStatus.NO_PERMISSION
+
+                # Step 5 - Get the account login history
+                login_dates = await sshServerGetLoginDates(conn)
+                if login_dates is None:
+                    logger.error(f"Error collecting login history from server {server.host}")
+
+                # Step 6 - Apply everything that was collected in one transaction
+                if unchanged:
+                    updated = await runInSession(applyUnchangedInventory, server.id, login_dates)
+                else:
+                    updated = await runInSession(storeServerInventory, server.id, fingerprint, kernel_version, os_version, nics, ib_nics, login_dates)
+                if updated is None:
+                    logger.error(f"Server {server.id} not found in database.")
+                    return
+                logger.info(f"Collected inventory from server {server.host}, updated the login date of {updated} accounts")
+            except Exception as e:
+                logger.error(f"Error collecting data from server {server.host}: {e}")
+                error = str(e) or type(e).__name__
+                await runInSession(setServerStatus, server.id, ServerStatus.NO_PERMISSION)
     except Exception as e:
         logger.error(f"Error collecting data from server {server.host}: {e}")
-        server.server_status = ServerStatus.UNABLE_TO_REACH
+        error = str(e) or type(e).__name__
+        await recordReachability(server, e)
+        # Unreachable, try again once the backoff expired instead of waiting for the next collection
+        next_run_at = datetime.datetime.now() + datetime.timedelta(seconds=max(health.retryIn(server.id), account_retry_delay))
     finally:
-        last_server_collecting[server.id] = False
+        await runInSession(finishCollection, job_id, next_run_at, error)
+        notifySync([])
 
-async def watchAccountSync():
-    try:
-        while start_watcher:
-            # Routine 1 - Check if there are any accounts to sync
-            dumping_sync_accounts = [syncing_accounts[k] for k in syncing_accounts if syncing_accounts[k]]
-            if len(dumping_sync_accounts) > 0:
-                logger.info("Dump syncing accounts: " + ",".join(dumping_sync_accounts))
-            db = SessionLocal()
-            accounts = db.query(Account).filter(Account.status == AccountStatus.DIRTY).all()
-            for account in accounts:
-                if account.id not in syncing_accounts or not syncing_accounts[account.id]:
-                    syncing_accounts[account.id] = True
-                    account.status = AccountStatus.UPDATING
-                    server = account.server
-                    user = account.user
-                    db.commit()
-                    
-                    db.refresh(account); db.expunge(account); make_transient(account)
-                    db.refresh(server); db.expunge(server); make_transient(server)
-                    db.refresh(user); db.expunge(user); make_transient(user)
-                    
-                    # Start the sync process
-                    asyncio.create_task(syncAccount(user, server, account))
-            
-            gateways = db.query(Server).filter(Server.is_gateway == True).all()
-            # Routine 2 - Admin user should have root permissions on gateway server, all active users should have account on gateway server
-            active_users = db.query(User).filter(User.status == UserStatus.ACTIVE)
-            for gateway in gateways:
-                # Check if the user has an account on the gateway server
-                for user in active_users:
-                    account = db.query(Account).filter(Account.user_id == user.id, Account.server_id == gateway.id).first()
-                    if not account:
-                        # Create the account
-                        new_account = Account(
-                            user_id=user.id,
-                            server_id=gateway.id,
-                            is_sudo=user.is_admin,
-                            is_login_able=True,
-                            status=AccountStatus.DIRTY
-                        )
-                        db.add(new_account)
-                        db.commit()
-                        db.refresh(new_account)
-                        logger.info(f"Automatically created account {new_account.id} for user {user.username} on gateway server {gateway.host}")
-                    elif not account.is_login_able or account.is_sudo != user.is_admin:
-                        # Update the account
-                        account.is_login_able = True
-                        account.is_sudo = user.is_admin
-                        account.status = AccountStatus.DIRTY
-                        db.commit()
-                        logger.info(f"Automatically updated account {account.id} for user {user.username} on gateway server {gateway.host}")
-
-            # Routine 3 - Disable inactive users accounts
-            inactive_users = db.query(User).filter(User.status == UserStatus.GRADUATED)
-            inactive_accounts = db.query(Account).filter(Account.user_id.in_([user.id for user in inactive_users])).all()
-            for account in inactive_accounts:
-                if account.is_login_able:
-                    account.is_login_able = False
-                    account.status = AccountStatus.DIRTY
-                    db.commit()
-                    logger.info(f"Automatically disabled account {account.id} for user {account.user.username} on server {account.server.host}")
-            
-            # Routine 4 - auto revoke account if the user is inactive for a long time
-            accounts = db.query(Account).filter(Account.is_login_able == True).all()
-            for account in accounts:
-                if account.server.is_gateway:
-                    continue
-                if account.user.is_admin:
-                    continue
-                if account.last_login_date < datetime.datetime.now() - datetime.timedelta(days=30):
-                    account.is_login_able = False
-                    account.status = AccountStatus.DIRTY
-                    db.commit()
-                    logger.info(f"Automatically disabled account {account.id} for user {account.user.username} on server {account.server.host}")
+def dirtyServerIds(db: Session, account_ids: set[int] | None = None) -> list[int]:
+    """
+    Get the servers with dirty accounts, or accounts left updating by a worker that died.
+    With `account_ids`, only the servers of these accounts are considered.
+    """
+    query = db.query(Account.server_id).filter(Account.status.in_([AccountStatus.DIRTY, AccountStatus.UPDATING]))
+    if account_ids is not None:
+        query = query.filter(Account.server_id.in_(select(Account.server_id).where(Account.id.in_(account_ids))))
+    return [server_id for server_id, in query.distinct().all()]
+
+def enqueueDirtyAccounts(db: Session, account_ids: set[int] | None = None, wake: bool = False):
+    """
+    Schedule the account job of every server with dirty accounts.
+    Without `wake`, the servers whose job is already scheduled or running are skipped, so polling writes nothing.
+    """
+    server_ids = dirtyServerIds(db, account_ids)
+    if not wake and server_ids:
+        scheduled = db.query(SyncJob.server_id).filter(
+            SyncJob.kind == SyncJobKind.ACCOUNTS,
+            SyncJob.server_id.in_(server_ids),
+            or_(SyncJob.state == SyncJobState.RUNNING, SyncJob.next_run_at.is_not(None)),
+        )
+        scheduled_ids = {server_id for server_id, in scheduled.all()}
+        server_ids = [server_id for server_id in server_ids if server_id not in scheduled_ids]
+    if server_ids:
+        enqueueJobs(db, SyncJobKind.ACCOUNTS, server_ids, datetime.datetime.now(), wake)
+        db.commit()
+
+def enqueueCollections(db: Session):
+    """
+    Schedule the collection job of the servers that do not have one yet.
+    """
+    enqueueJobs(db, SyncJobKind.COLLECT, [server_id for server_id, in db.query(Server.id).all()], datetime.datetime.now())
+    db.commit()
+
+def dueJobs(db: Session, limit: int = 500) -> list[tuple[int, SyncJobKind, Server]]:
+    """
+    Get the claimable jobs with their server (detached), account jobs first.
+    """
+    rows = (
+        db.query(SyncJob.id, SyncJob.kind, Server)
+          .join(Server, SyncJob.server_id == Server.id)
+          .filter(isClaimable(datetime.datetime.now()))
+          .order_by(SyncJob.kind, SyncJob.next_run_at)
+          .limit(limit)
+          .all()
+    )
+    for _, _, server in rows:
+        if server in db:
+            db.expunge(server); make_transient(server)
+    return rows
+
+def claimAccountsJob(db: Session, job_id: int, server_id: int) -> tuple[Server, list[tuple[User, Account]]] | None:
+    """
+    Claim the account job and mark the accounts of its server as updating, in one transaction.
+    Accounts left updating by a worker that died are taken over. Returns them detached with their
+    users and server, None if the job was claimed by someone else or there is nothing to do.
+    """
+    if not claimJob(db, job_id, job_lease):
+        db.rollback()
+        return None
+    batch = (
+        db.query(Account)
+          .filter(Account.server_id == server_id, Account.status.in_([AccountStatus.DIRTY, AccountStatus.UPDATING]))
+          .all()
+    )
+    if not batch:
+        finishJob(db, job_id, SyncJobState.DONE, None)
+        db.commit()
+        return None
+    for account in batch:
+        account.status = AccountStatus.UPDATING
+    server = batch[0].server
+    users = {account.user_id: account.user for account in batch}
+    db.commit()
 
+    db.refresh(server); db.expunge(server); make_transient(server)
+    for user in users.values():
+        db.refresh(user); db.expunge(user); make_transient(user)
+    entries = []
+    for account in batch:
+        db.refresh(account); db.expunge(account); make_transient(account)
+        entries.append((users[account.user_id], account))
+    return server, entries
+
+def claimCollectionJob(db: Session, job_id: int) -> bool:
+    claimed = claimJob(db, job_id, job_lease)
+    db.commit()
+    return claimed
+
+async def dispatchJobs():
+    """
+    Claim the due jobs and hand them to the scheduler.
+    """
+    now = datetime.datetime.now()
+    for job_id, kind, server in await runInSession(dueJobs):
+        if not start_watcher:
+            # The engine is stopping, the remaining jobs are left to the next leader
+            break
+        priority = Priority.ACCOUNT if kind == SyncJobKind.ACCOUNTS else Priority.COLLECT
+        if not scheduler.hasRoom(priority):
+            continue
+        if kind == SyncJobKind.COLLECT and server.agent_last_seen and server.agent_last_seen > now - agent_stale_after:
+            # Pushed by its agent, SSH is only the fallback when the agent stops reporting
+            await runInSession(postponeJob, job_id, server.agent_last_seen + agent_stale_after)
+            continue
+        if not health.allow(server.id):
+            # Backing off or circuit open, look at the job again once the server may be tried
+            await runInSession(postponeJob, job_id, now + datetime.timedelta(seconds=max(health.retryIn(server.id), min_postpone)))
+            continue
+        if kind == SyncJobKind.ACCOUNTS:
+            claimed = await runInSession(claimAccountsJob, job_id, server.id)
+            if claimed is None:
+                health.cancelProbe(server.id)
+                continue
+            server, entries = claimed
+            # Queue the sync process ahead of the collection jobs
+            scheduler.submit(f"accounts@{server.host}", Priority.ACCOUNT, server.id, server.proxy_server_id,
+                             lambda server=server, entries=entries, job_id=job_id: syncServerAccounts(server, entries, job_id))
+        else:
+            if not await runInSession(claimCollectionJob, job_id):
+                health.cancelProbe(server.id)
+                continue
             # Routine 5 - collect usage data from the servers
-            servers = db.query(Server).all()
-            for server in servers:
-                if server.id not in last_server_collect_date or last_server_collect_date[server.id] < datetime.datetime.now() - datetime.timedelta(hours=1):
-                    if server.id not in last_server_collecting or not last_server_collecting[server.id]:
-                        last_server_collecting[server.id] = True
-                        db.refresh(server); db.expunge(server); make_transient(server)
-                        asyncio.create_task(syncServer(server))
-
-            db.close()
-            await asyncio.sleep(30)
-    except Exception as e:
-        logger.error(f"Error in watchAccountSync: {e}")
+            scheduler.submit(f"collect@{server.host}", Priority.COLLECT, server.id, server.proxy_server_id,
+                             lambda server=server, job_id=job_id: syncServer(server, job_id))
+
+def applyAccountPolicies(db: Session):
+    """
+    Mark the accounts that have to change because of the account policies as dirty.
+    Every routine is one set-based statement and all of them are committed in one transaction,
+    so the cost of a tick does not grow with the number of users and servers.
+    """
+    now = datetime.datetime.now()
+    dirty = literal(AccountStatus.DIRTY, Account.__table__.c.status.type)
+    gateway_ids = select(Server.id).where(Server.is_gateway == True)
+    active_user_ids = select(User.id).where(User.status == UserStatus.ACTIVE)
+    # Routine 2 - Admin user should have root permissions on gateway server, all active users should have account on gateway server
+    missing_accounts = (
+        select(User.id, Server.id, User.is_admin, literal(True), dirty, literal(now))
+          .select_from(User)
+          .join(Server, true())
+          .where(User.status == UserStatus.ACTIVE, Server.is_gateway == True)
+          .where(~exists().where(Account.user_id == User.id, Account.server_id == Server.id))
+    )
+    created = db.execute(
+        insert(Account)
+          .from_select(["user_id", "server_id", "is_sudo", "is_login_able", "status", "last_login_date"], missing_accounts)
+          .returning(Account.id)
+    ).scalars().all()
+    if created:
+        logger.info(f"Automatically created accounts {created} on gateway servers")
+    user_is_admin = select(User.is_admin).where(User.id == Account.user_id).scalar_subquery()
+    updated = db.execute(
+        update(Account)
+          .where(Account.server_id.in_(gateway_ids), Account.user_id.in_(active_user_ids))
+          .where(or_(Account.is_login_able == False, Account.is_sudo != user_is_admin))
+          .values(is_login_able=True, is_sudo=user_is_admin, status=AccountStatus.DIRTY)
+          .returning(Account.id)
+          .execution_options(synchronize_session=False)
+    ).scalars().all()
+    if updated:
+        logger.info(f"Automatically updated accounts {updated} on gateway servers")
+
+    # Routine 3 - Disable inactive users accounts
+    disabled = db.execute(
+        update(Account)
+          .where(Account.is_login_able == True)
+          .where(Account.user_id.in_(select(User.id).where(User.status == UserStatus.GRADUATED)))
+          .values(is_login_able=False, status=AccountStatus.DIRTY)
+          .returning(Account.id)
+          .execution_options(synchronize_session=False)
+    ).scalars().all()
+    if disabled:
+        logger.info(f"Automatically disabled accounts {disabled} of inactive users")
+
+    # Routine 4 - auto revoke account if the user is inactive for a long time
+    revoked = db.execute(
+        update(Account)
+          .where(Account.is_login_able == True, Account.last_login_date < now - datetime.timedelta(days=30))
+          .where(Account.server_id.not_in(gateway_ids))
+          .where(Account.user_id.not_in(select(User.id).where(User.is_admin == True)))
+          .values(is_login_able=False, status=AccountStatus.DIRTY)
+          .returning(Account.id)
+          .execution_options(synchronize_session=False)
+    ).scalars().all()
+    if revoked:
+        logger.info(f"Automatically disabled accounts {revoked} not used for 30 days")
+    db.commit()
+
+async def renewJobLeases():
+    while True:
+        await asyncio.sleep(job_lease.total_seconds() / 3)
+        try:
+            await runInSession(renewLeases, job_lease)
+        except Exception as e:
+            logger.error(f"Error renewing sync job leases: {e}")
+
+async def watchAccountSync():
+    account_ids, full = set(), True
+    last_full = 0.0
+    while start_watcher:
+        delay = dirty_poll_interval
+        try:
+            # The database work runs in the database executor, the loop only waits for it
+            if full or time.monotonic() - last_full >= watcher_interval:
+                last_full = time.monotonic()
+                with WATCHER_ROUTINE_SECONDS.labels("policies").time():
+                    await runInSession(applyAccountPolicies)
+                with WATCHER_ROUTINE_SECONDS.labels("enqueue_collections").time():
+                    await runInSession(enqueueCollections)
+            # Routine 1 - Schedule the servers with dirty accounts, including the ones changed by the policies
+            # and by the other workers; accounts notified in this process skip their retry backoff
+            with WATCHER_ROUTINE_SECONDS.labels("enqueue_accounts").time():
+                await runInSession(enqueueDirtyAccounts, None, False)
+                if account_ids:
+                    await runInSession(enqueueDirtyAccounts, account_ids, True)
+            # Start every due job: new ones, retries and the ones whose worker died
+            with WATCHER_ROUTINE_SECONDS.labels("dispatch").time():
+                await dispatchJobs()
+            next_delay = await runInSession(nextJobDelay)
+            if next_delay is not None:
+                delay = min(max(next_delay, 1), delay)
+        except Exception as e:
+            logger.error(f"Error in watchAccountSync: {e}")
+        # Sleep until an API change notifies the engine, a job is due or the dirty accounts are polled again
+        account_ids, full = await waitForSync(delay)
@@ -1,10 +1,116 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import BaseModel
 from sqlalchemy.orm import Session
-from app.database import get_db, Account, User, AccountStatus
+from typing import List, Dict, Optional
+from enum import Enum
+from datetime import datetime
+from app.database import get_db, Account, Server, User, AccountStatus
 from validator import getUserAdmin
+from sync_events import notifySync
 
 router = APIRouter()
 
+# Largest number of items of one bulk call
+max_bulk_items = 1000
+
+class AccountBulkAction(str, Enum):
+    GRANT = 'grant' # Create the account or make it loginable again
+    REVOKE = 'revoke' # Disable the account
+    SUDO = 'sudo' # Set the sudo of the account, toggle it if is_sudo is not given
+
+class AccountBulkItem(BaseModel):
+    user_id: int
+    server_id: int
+    is_sudo: Optional[bool] = None
+
+class AccountBulkRequest(BaseModel):
+    action: AccountBulkAction
+    items: List[AccountBulkItem]
+
+def loadAccounts(db: Session, pairs: set[tuple[int, int]]) -> dict[tuple[int, int], Account]:
+    """
+    Get the existing accounts of the (user id, server id) pairs in one query.
+    """
+    if not pairs:
+        return {}
+    accounts = (
+        db.query(Account)
+          .filter(Account.user_id.in_({user_id for user_id, _ in pairs}),
+                  Account.server_id.in_({server_id for _, server_id in pairs}))
+          .all()
+    )
+    return {(acct.user_id, acct.server_id): acct for acct in accounts if (acct.user_id, acct.server_id) in pairs}
+
+def grantAccount(db: Session, accounts: dict[tuple[int, int], Account], user_id: int, server_id: int, is_sudo: bool) -> Account:
+    """
+    Create the account of the user on the server, or make the existing one loginable again, does not commit.
+    """
+    acct = accounts.get((user_id, server_id))
+    if acct:
+        acct.is_sudo = is_sudo
+        acct.is_login_able = True
+        acct.status = AccountStatus.DIRTY
+        acct.last_login_date = datetime.now()
+    else:
+        acct = Account(user_id=user_id, server_id=server_id, is_sudo=is_sudo)
+        db.add(acct)
+        accounts[(user_id, server_id)] = acct
+    return acct
+
+@router.post("/bulk", response_model=List[Dict])
+def bulk_accounts(
+    req: AccountBulkRequest,
+    admin: User = Depends(getUserAdmin),
+    db: Session = Depends(get_db)
+):
+    """
+    Grant, revoke or change the sudo of many accounts in one transaction.
+    Every item gets its own result, the changed accounts are handed to the sync engine as one batch.
+    """
+    if len(req.items) > max_bulk_items:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=f"At most {max_bulk_items} items per call")
+    pairs = {(item.user_id, item.server_id) for item in req.items}
+    user_ids = {user_id for user_id, in db.query(User.id).filter(User.id.in_({user_id for user_id, _ in pairs})).all()}
+    server_ids = {server_id for server_id, in db.query(Server.id).filter(Server.id.in_({server_id for _, server_id in pairs})).all()}
+    accounts = loadAccounts(db, pairs)
+
+    results = []
+    for item in req.items:
+        acct = None
+        error = ""
+        if item.user_id not in user_ids:
+            error = "User not found"
+        elif item.server_id not in server_ids:
+            error = "Server not found"
+        elif req.action == AccountBulkAction.GRANT:
+            acct = grantAccount(db, accounts, item.user_id, item.server_id, bool(item.is_sudo))
+        elif (item.user_id, item.server_id) not in accounts:
+            error = "Account not found"
+        else:
+            acct = accounts[(item.user_id, item.server_id)]
+            if req.action == AccountBulkAction.REVOKE:
+                acct.is_login_able = False
+                acct.is_sudo = False
+            else:
+                acct.is_sudo = not acct.is_sudo if item.is_sudo is None else item.is_sudo
+            acct.status = AccountStatus.DIRTY
+        results.append((item, acct, error))
+    # Ids of the new accounts, read before the commit expires the objects
+    db.flush()
+    response = [
+        {
+            "user_id": item.user_id,
+            "server_id": item.server_id,
+            "ok": acct is not None,
+            "account_id": acct.id if acct else None,
+            "error": error
+        }
+        for item, acct, error in results
+    ]
+    db.commit()
+    notifySync(list({result["account_id"] for result in response if result["ok"]}))
+    return response
+
 @router.put("/{account_id}/sudo", status_code=status.HTTP_204_NO_CONTENT)
 def toggle_sudo(
     account_id: int,
@@ -17,6 +123,7 @@ def toggle_sudo(
     acct.is_sudo = not acct.is_sudo
     acct.status = AccountStatus.DIRTY
     db.commit()
+    notifySync([acct.id])
     return {"msg": "Sudo status toggled"}
 
 @router.put("/{account_id}/revoke", status_code=status.HTTP_204_NO_CONTENT)
@@ -32,4 +139,5 @@ def revoke_account(
     acct.is_sudo = False
     acct.status = AccountStatus.DIRTY
     db.commit()
+    notifySync([acct.id])
     return {"msg": "Account revoked"}
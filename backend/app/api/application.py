@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
@@ -7,7 +7,10 @@ from app.database import get_db, Server, Application, User, Account, AccountStat
 from validator import getUser
 from logger import logger
 from validator import getUserAdmin
-from typing import List, Dict
+from sync_events import notifySync
+from app.api.account import grantAccount, loadAccounts, max_bulk_items
+from pagination import max_page_size, next_cursor_header, paginate, parseFields, trimPage
+from typing import List, Dict, Optional
 from datetime import datetime
 
 router = APIRouter()
@@ -17,6 +20,9 @@ class ApplicationCreate(BaseModel):
     need_sudo: bool
     uid: int
 
+class ApplicationBulk(BaseModel):
+    ids: List[int]
+
 @router.post("/submit", response_model=dict)
 def submit_application(
     app_in: ApplicationCreate,
@@ -50,6 +56,7 @@ def submit_application(
             db.add(new_acc)
         db.commit()
         db.refresh(new_acc)
+        notifySync([new_acc.id])
         return JSONResponse(
             content={
                 "account_id": new_acc.id,
@@ -78,26 +85,102 @@ def submit_application(
         status_code=status.HTTP_201_CREATED
     )
 
+# Fields of /app/pendings, a `fields=` projection selects among them
+application_list_fields = ["id", "user_id", "realname", "username", "server_id", "host", "need_sudo", "create_date"]
+APPLICATION_LIST_COLUMNS = {
+    "user_id": Application.user_id,
+    "realname": User.realname,
+    "username": User.username,
+    "server_id": Application.server_id,
+    "host": Server.host,
+    "need_sudo": Application.need_sudo,
+    "create_date": Application.create_date,
+}
+
 @router.get("/pendings", response_model=List[Dict])
 def list_pending(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=max_page_size),
+    fields: Optional[str] = None,
+    user_id: Optional[int] = None,
+    server_id: Optional[int] = None,
     admin: User = Depends(getUserAdmin),
     db: Session = Depends(get_db)
 ):
-    apps = db.query(Application).all()
+    names = parseFields(fields, application_list_fields)
+    query = db.query(Application.id, *(APPLICATION_LIST_COLUMNS[name].label(name) for name in names if name in APPLICATION_LIST_COLUMNS))
+    # The user and the server are only joined for their columns
+    if "realname" in names or "username" in names:
+        query = query.join(User, Application.user_id == User.id)
+    if "host" in names:
+        query = query.join(Server, Application.server_id == Server.id)
+    if user_id is not None:
+        query = query.filter(Application.user_id == user_id)
+    if server_id is not None:
+        query = query.filter(Application.server_id == server_id)
+    apps, next_cursor = trimPage(paginate(query, Application.id, cursor, limit).all(), limit)
+    if next_cursor:
+        response.headers[next_cursor_header] = next_cursor
     return [
-        {
-          "id": app.id,
-          "user_id": app.user_id,
-          "realname": app.user.realname,
-          "username": app.user.username,
-          "server_id": app.server_id,
-          "host": app.server.host,
-          "need_sudo": app.need_sudo,
-          "create_date": app.create_date.isoformat()
-        }
+        {name: app.create_date.isoformat() if name == "create_date" else getattr(app, name) for name in names}
         for app in apps
     ]
 
+def loadApplications(db: Session, ids: List[int]) -> dict[int, Application]:
+    if len(ids) > max_bulk_items:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"At most {max_bulk_items} applications per call")
+    return {app.id: app for app in db.query(Application).filter(Application.id.in_(set(ids))).all()}
+
+@router.post("/bulk/approve", response_model=List[Dict])
+def approve_applications(
+    req: ApplicationBulk,
+    admin: User = Depends(getUserAdmin),
+    db: Session = Depends(get_db)
+):
+    """
+    Approve many applications in one transaction, every application gets its own result and the
+    granted accounts are handed to the sync engine as one batch.
+    """
+    apps = loadApplications(db, req.ids)
+    accounts = loadAccounts(db, {(app.user_id, app.server_id) for app in apps.values()})
+    results = []
+    for app_id in req.ids:
+        app = apps.pop(app_id, None)
+        if not app:
+            results.append((app_id, None))
+            continue
+        results.append((app_id, grantAccount(db, accounts, app.user_id, app.server_id, app.need_sudo)))
+        db.delete(app)
+    # Ids of the new accounts, read before the commit expires the objects
+    db.flush()
+    response = [
+        {"id": app_id, "ok": True, "account_id": acct.id, "error": ""} if acct else
+        {"id": app_id, "ok": False, "account_id": None, "error": "Application not found"}
+        for app_id, acct in results
+    ]
+    db.commit()
+    notifySync(list({result["account_id"] for result in response if result["ok"]}))
+    return response
+
+@router.post("/bulk/reject", response_model=List[Dict])
+def reject_applications(
+    req: ApplicationBulk,
+    admin: User = Depends(getUserAdmin),
+    db: Session = Depends(get_db)
+):
+    apps = loadApplications(db, req.ids)
+    response = []
+    for app_id in req.ids:
+        app = apps.pop(app_id, None)
+        if not app:
+            response.append({"id": app_id, "ok": False, "error": "Application not found"})
+            continue
+        db.delete(app)
+        response.append({"id": app_id, "ok": True, "error": ""})
+    db.commit()
+    return response
+
 @router.post("/{app_id}/approve", response_model=dict)
 def approve_application(
     app_id: int,
@@ -119,6 +202,7 @@ def approve_application(
     db.delete(app)
     db.commit()
     db.refresh(acct)
+    notifySync([acct.id])
     return {"account_id": acct.id}
 
 @router.post("/{app_id}/reject", status_code=204)
@@ -30,8 +30,9 @@ def get_password_hash(password: str):
 
 def create_access_token(data: dict, expires_delta: timedelta):
     to_encode = data.copy() 
-    expire = datetime.utcnow() + expires_delta
-    to_encode.update({"exp": expire})
+    now = datetime.utcnow()
+    # iat is part of the key of the principal cache (validator.principals)
+    to_encode.update({"iat": now, "exp": now + expires_delta})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 # 请求与响应模型
@@ -0,0 +1,53 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from pydantic import BaseModel
+import datetime
+
+from app.database import get_db, Server
+from validator import getAgentServer
+from server_helpers import parseLoginRecords, parseNICDump, parseRelease
+from server_inventory import applyServerInventory, applyUnchangedInventory
+from logger import logger
+
+router = APIRouter()
+
+class InventoryReport(BaseModel):
+    """
+    Raw outputs of the collection commands, run by the agent on the server.
+    """
+    kernel: str # uname -r
+    release: str # RELEASE_CMD
+    nics: str # NIC_DUMP_CMD
+    logins: str = "" # LOGIN_RECORDS_CMD, empty if not available
+    fingerprint: str = "" # INVENTORY_FINGERPRINT_CMD
+
+@router.post("/inventory", response_model=dict)
+def ingest_inventory(
+    report: InventoryReport,
+    server: Server = Depends(getAgentServer),
+    db: Session = Depends(get_db)
+):
+    parsed = parseNICDump(report.nics)
+    if parsed is None:
+        # The rest of the report is still applied, the interfaces are left as they are
+        logger.error(f"Incomplete NIC dump pushed by server {server.host}")
+        parsed = None, None
+    nics, ib_nics = parsed
+    login_dates = None
+    if report.logins.strip():
+        try:
+            login_dates = parseLoginRecords(report.logins)
+        except ValueError as e:
+            logger.error(f"Error parsing login records pushed by server {server.host}: {e}")
+
+    # Everything is written in the transaction committed by the apply function
+    db.execute(update(Server).where(Server.id == server.id).values(agent_last_seen=datetime.datetime.now()))
+    unchanged = report.fingerprint != "" and report.fingerprint == server.inventory_fingerprint
+    if unchanged:
+        updated = applyUnchangedInventory(db, server.id, login_dates)
+    else:
+        updated = applyServerInventory(db, server.id, report.fingerprint, report.kernel.strip(),
+                                       parseRelease(report.release), nics, ib_nics, login_dates)
+    logger.info(f"Ingested inventory pushed by server {server.host}, unchanged: {unchanged}, updated the login date of {updated} accounts")
+    return {"msg": "Inventory ingested", "unchanged": unchanged, "updated_logins": updated}
@@ -9,20 +9,10 @@ from pydantic import BaseModel
 from typing import Optional
 
 from logger import logger
+from topology import topology
 
 router = APIRouter()
 
-def getPeer(conn : Connection, iface : Optional[ServerInterface] = None, sp : Optional[SwitchPort] = None) -> ServerInterface | SwitchPort:
-    for peer in conn.interfaces:
-        if not iface or peer.id != iface.id:
-            return peer
-    for peer in conn.switch_ports:
-        if not sp or peer.id != sp.id:
-            return peer
-    import os
-    logger.fatal(f"Peer not found for connection {conn.id}, interface {iface.id if iface else None}, switch port {sp.id if sp else None}, DB is inconsistent")
-    os._exit(1)
-
 # Connect two switch ports
 class ConnectSwitchPortsIn(BaseModel):
     port_a_id: int
@@ -41,6 +31,7 @@ def connect_switch_ports(
     if not pa or not pb:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Switch port not found")
     logger.info(f"Connecting switch ports {pa.id} and {pb.id}")
+    old_conn_ids = {pa.conn_id, pb.conn_id} - {None}
     if pa.conn:
         db.delete(pa.conn)
         logger.info(f"Automatically deleting connection {pa.conn.id} for switch port {pa.id}")
@@ -56,6 +47,9 @@ def connect_switch_ports(
     pa.conn_id = conn.id
     pb.conn_id = conn.id
     db.commit()
+    for old_conn_id in old_conn_ids:
+        topology.removeConnection(old_conn_id)
+    topology.setConnection(conn.id, [("switch_port", pa.id), ("switch_port", pb.id)])
     return {"connection_id": conn.id}
 
 # Connect switch port and server interface
@@ -74,6 +68,7 @@ def connect_port_interface(
     if not sp or not iface:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Port or interface not found")
     logger.info(f"Connecting switch port {sp.id} and interface {iface.id}")
+    old_conn_ids = {sp.conn_id, iface.conn_id} - {None}
     if sp.conn:
         db.delete(sp.conn)
         logger.info(f"Automatically deleting connection {sp.conn.id} for switch port {sp.id}")
@@ -89,6 +84,9 @@ def connect_port_interface(
     sp.conn_id = conn.id
     iface.conn_id = conn.id
     db.commit()
+    for old_conn_id in old_conn_ids:
+        topology.removeConnection(old_conn_id)
+    topology.setConnection(conn.id, [("switch_port", sp.id), ("interface", iface.id)])
     return {"connection_id": conn.id}
 
 # Connect two server interfaces
@@ -109,6 +107,7 @@ def connect_interfaces(
     if not ia or not ib:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Interface not found {data.interface_a_id} {data.interface_b_id}")
     logger.info(f"Connecting interfaces {ia.id} and {ib.id}")
+    old_conn_ids = {ia.conn_id, ib.conn_id} - {None}
     if ia.conn:
         db.delete(ia.conn)
         logger.info(f"Automatically deleting connection {ia.conn.id} for interface {ia.id}")
@@ -124,6 +123,9 @@ def connect_interfaces(
     ia.conn_id = conn.id
     ib.conn_id = conn.id
     db.commit()
+    for old_conn_id in old_conn_ids:
+        topology.removeConnection(old_conn_id)
+    topology.setConnection(conn.id, [("interface", ia.id), ("interface", ib.id)])
     return {"connection_id": conn.id}
 
 # Disconnect a server interface by ID
@@ -141,8 +143,10 @@ def disconnect_interface(
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Interface not connected")
     conn = iface.conn
     if conn:
+        conn_id = conn.id
         db.delete(conn)
         db.commit()
+        topology.removeConnection(conn_id)
 
 # Disconnect a switch port by ID
 class DisconnectSwitchPortIn(BaseModel):
@@ -159,8 +163,10 @@ def disconnect_switch_port(
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Port not connected")
     conn = sp.conn
     if conn:
+        conn_id = conn.id
         db.delete(conn)
         db.commit()
+        topology.removeConnection(conn_id)
 
 # List devices and their connections
 @router.get("/devices", response_model=List[Dict])
@@ -168,28 +174,82 @@ def list_devices(
     db: Session = Depends(get_db),
     user: User = Depends(getUser)
 ):
-    switches = db.query(Switch).all()
     result = []
-    for sw in switches:
-        ports = []
-        for sp in sw.ports:
-            peer = None
-            if sp.conn_id:
-                conn = db.query(Connection).filter(Connection.id == sp.conn_id).first()
-                if not conn:
-                    logger.fatal(f"Connection {sp.conn_id} not found for switch port {sp.id}, DB is inconsistent")
-                    import os
-                    os._exit(1)
-                # look for peer switch port
-                peer_port = getPeer(conn, sp=sp)
-                if isinstance(peer_port, ServerInterface):
-                    peer = {"id": peer_port.id, "type": "interface", "name": peer_port.interface, "manufacturer": peer_port.manufacturer, "pci_address": peer_port.pci_address, "server_host": peer_port.server.host}
-                elif isinstance(peer_port, SwitchPort):
-                    # calculate switch port number as col_index * num_row + row_index
-                    peer_port_num = peer_port.phy_col * peer_port.switch.num_row + peer_port.phy_row + 1
-                    peer = {"id": peer_port.id, "type": "switch_port", "name": f"{peer_port.switch.name} {peer_port_num}"}
-            # calculate switch port number as col_index * num_row + row_index
-            port_num = sp.phy_col * sw.num_row + sp.phy_row + 1
-            ports.append({"id": sp.id, "name": port_num, "phy_row": sp.phy_row, "phy_col": sp.phy_col, "tag": sp.tag, "connected_to": peer})
-        result.append({"id": sw.id, "name": sw.name, "num_row": sw.num_row, "num_col": sw.num_col, "ports": ports})
-    return result
\ No newline at end of file
+    with topology.view(db) as topo:
+        for sw in topo.switches.values():
+            ports = []
+            for port_id in sw.port_ids:
+                sp = topo.ports[port_id]
+                peer = None
+                connected = topo.peer(("switch_port", sp.id))
+                if connected:
+                    kind, peer_port = connected
+                    if kind == "interface":
+                        peer = {"id": peer_port.id, "type": "interface", "name": peer_port.interface, "manufacturer": peer_port.manufacturer, "pci_address": peer_port.pci_address, "server_host": peer_port.server_host}
+                    else:
+                        peer = {"id": peer_port.id, "type": "switch_port", "name": f"{topo.switches[peer_port.switch_id].name} {topo.portNumber(peer_port)}"}
+                ports.append({"id": sp.id, "name": topo.portNumber(sp), "phy_row": sp.phy_row, "phy_col": sp.phy_col, "tag": sp.tag, "connected_to": peer})
+            result.append({"id": sw.id, "name": sw.name, "num_row": sw.num_row, "num_col": sw.num_col, "ports": ports})
+    return result
+
+def describeNode(topo, node) -> dict:
+    kind, node_id = node
+    if kind == "interface":
+        iface = topo.interfaces[node_id]
+        return {"type": "interface", "id": iface.id, "name": iface.interface, "server_id": iface.server_id, "server_host": iface.server_host}
+    if kind == "switch_port":
+        sp = topo.ports[node_id]
+        return {"type": "switch_port", "id": sp.id, "switch_id": sp.switch_id, "name": f"{topo.switches[sp.switch_id].name} {topo.portNumber(sp)}"}
+    return {"type": "switch", "id": node_id, "name": topo.switches[node_id].name}
+
+# Shortest L2 path between two servers or interfaces
+@router.get("/path", response_model=dict)
+def get_path(
+    from_server_id: Optional[int] = None,
+    from_interface_id: Optional[int] = None,
+    to_server_id: Optional[int] = None,
+    to_interface_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    user: User = Depends(getUser)
+):
+    """
+    The hops from one end to the other: interface, switch port, switch, switch port, ..., interface.
+    An end given as a server starts from (or arrives at) whichever of its interfaces is closest.
+    """
+    if not user:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Not authenticated")
+    with topology.view(db) as topo:
+        ends = []
+        for server_id, interface_id in ((from_server_id, from_interface_id), (to_server_id, to_interface_id)):
+            if interface_id is not None:
+                if interface_id not in topo.interfaces:
+                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Interface {interface_id} not found")
+                ends.append([("interface", interface_id)])
+            elif server_id is not None:
+                ends.append(topo.serverInterfaces(server_id))
+            else:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Both ends need a server or an interface")
+        path = topo.shortestPath(ends[0], ends[1])
+        if path is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No path between the two ends")
+        return {"hops": len(path) - 1, "path": [describeNode(topo, node) for node in path]}
+
+# Servers and switches reachable from a switch
+@router.get("/reachable/{switch_id}", response_model=dict)
+def get_reachable(
+    switch_id: int,
+    db: Session = Depends(get_db),
+    user: User = Depends(getUser)
+):
+    if not user:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Not authenticated")
+    with topology.view(db) as topo:
+        if switch_id not in topo.switches:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Switch not found")
+        switch_ids, server_ids = topo.reachable(switch_id)
+        hosts = {iface.server_id: iface.server_host for iface in topo.interfaces.values() if iface.server_id in server_ids}
+        return {
+            "switch_id": switch_id,
+            "switches": [{"id": sw_id, "name": topo.switches[sw_id].name} for sw_id in sorted(switch_ids)],
+            "servers": [{"id": server_id, "host": hosts[server_id]} for server_id in sorted(server_ids)]
+        }
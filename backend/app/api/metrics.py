@@ -0,0 +1,31 @@
+from fastapi import APIRouter, Header, HTTPException, Response, status
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest
+from typing import Optional
+import os
+
+from metrics import SyncEngineCollector
+
+router = APIRouter()
+
+# Scrapers send `Authorization: Bearer <METRICS_TOKEN>` when it is set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+REGISTRY.register(SyncEngineCollector())
+
+def metricsRegistry():
+    # With several workers every process writes its samples to PROMETHEUS_MULTIPROC_DIR, merge them
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    from prometheus_client import multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(SyncEngineCollector())
+    return registry
+
+@router.get("")
+def get_metrics(
+    authorization: Optional[str] = Header(None)
+):
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Invalid metrics token")
+    return Response(generate_latest(metricsRegistry()), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,69 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from typing import List, Dict, Optional
+
+from app.database import get_db, Server, User, SEARCH_DOCUMENTS
+from validator import getUser
+
+router = APIRouter()
+
+# Weights of the columns in the ranking: kind, ref_id, server_id, name, details, tags
+search_weights = (0, 0, 0, 10.0, 2.0, 5.0)
+
+def matchQuery(q: str) -> str:
+    """
+    Every word of the query as a prefix phrase, so the input is never parsed as FTS5 syntax.
+    """
+    return " ".join('"' + term.replace('"', '""') + '"*' for term in q.split())
+
+@router.get("", response_model=List[Dict])
+def search_fleet(
+    q: str,
+    kind: Optional[str] = None,
+    offset: int = 0,
+    limit: int = 50,
+    user: User = Depends(getUser),
+    db: Session = Depends(get_db)
+):
+    """
+    Search servers (host, OS, kernel, tags), interfaces (name, PCI address, manufacturer, tags) and,
+    for admins, users (real and account names). Results are ranked by relevance, best first.
+    """
+    if not user:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Not authenticated")
+    match = matchQuery(q)
+    if not match:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Empty search")
+    kinds = [kind] if kind else list(SEARCH_DOCUMENTS)
+    if any(k not in SEARCH_DOCUMENTS for k in kinds):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"Unknown kind {kind}")
+    if not user.is_admin:
+        kinds = [k for k in kinds if k != "user"]
+    if not kinds:
+        return []
+    params = {"match": match, "limit": max(1, min(limit, 200)), "offset": max(0, offset)}
+    params.update({f"kind{i}": k for i, k in enumerate(kinds)})
+    rows = db.execute(text(
+        f"""
+        SELECT kind, ref_id, server_id, name, snippet(fleet_search, -1, '[', ']', '...', 10),
+               bm25(fleet_search, {", ".join(str(weight) for weight in search_weights)}) AS score
+        FROM fleet_search
+        WHERE fleet_search MATCH :match AND kind IN ({", ".join(f":kind{i}" for i in range(len(kinds)))})
+        ORDER BY score
+        LIMIT :limit OFFSET :offset
+        """
+    ), params).all()
+    hosts = dict(db.query(Server.id, Server.host).filter(Server.id.in_({row[2] for row in rows if row[2] is not None})).all())
+    return [
+        {
+            "kind": row_kind,
+            "id": ref_id,
+            "name": name,
+            "server_id": server_id,
+            "server_host": hosts.get(server_id),
+            "match": snippet,
+            "score": -score
+        }
+        for row_kind, ref_id, server_id, name, snippet, score in rows
+    ]
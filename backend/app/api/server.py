@@ -1,11 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List, Dict
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from sqlalchemy.orm import Session, aliased, selectinload
+from typing import List, Dict, Optional
 from fastapi.responses import JSONResponse
 
-from app.database import get_db, Server, ServerTag, User, ServerInterface, InterfaceTag, Connection, SwitchPort
-from validator import getUserAdmin, getUser
+from app.database import get_db, Server, ServerStatus, ServerTag, User, ServerInterface, InterfaceTag, SwitchPort
+from validator import getUserAdmin, getUser, hashAgentToken
 from pydantic import BaseModel
+import secrets
+from topology import topology
+from pagination import max_page_size, next_cursor_header, paginate, parseFields, trimPage
 
 router = APIRouter()
 
@@ -48,27 +51,83 @@ def search_servers_by_interface_manufacturer(
         for iface in interfaces
     ]
 
+# Fields of /server/list, a `fields=` projection selects among them
+server_list_fields = ["id", "host", "port", "gateway", "os", "kernel", "tags", "proxy"]
+SERVER_LIST_COLUMNS = {
+    "host": Server.host,
+    "port": Server.port,
+    "gateway": Server.is_gateway,
+    "os": Server.os_version,
+    "kernel": Server.kernel_version,
+}
+
+def filterServers(query, server_status: Optional[ServerStatus], tag: Optional[str],
+                  gateway: Optional[bool], proxy_id: Optional[int]):
+    """
+    Filters shared by the server lists, proxy_id 0 keeps the servers reached directly.
+    """
+    if server_status is not None:
+        query = query.filter(Server.server_status == server_status)
+    if tag:
+        query = query.filter(Server.tags.any(ServerTag.tag == tag))
+    if gateway is not None:
+        query = query.filter(Server.is_gateway == gateway)
+    if proxy_id is not None:
+        query = query.filter(Server.proxy_server_id == proxy_id if proxy_id else Server.proxy_server_id.is_(None))
+    return query
+
 @router.get("/list", response_model=List[Dict])
 def list_servers(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=max_page_size),
+    fields: Optional[str] = None,
+    server_status: Optional[ServerStatus] = Query(None, alias="status"),
+    tag: Optional[str] = None,
+    gateway: Optional[bool] = None,
+    proxy_id: Optional[int] = Query(None, alias="proxy"),
     user: User = Depends(getUser),
     db: Session = Depends(get_db)
 ):
+    """
+    Servers in id order, all of them unless a `limit` is given, the next page is then fetched with
+    the cursor of the X-Next-Cursor header. Only the columns and relations of `fields` are loaded.
+    """
     if not user:
         raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Not authenticated")
-    servers = db.query(Server).all()
-    return [
-        {
-            "id": s.id,
-            "host": s.host,
-            "port": s.port,
-            "gateway": s.is_gateway,
-            "os": s.os_version,
-            "kernel": s.kernel_version,
-            "tags": [t.tag for t in s.tags],
-            "proxy": {"id": s.proxy_server.id, "host": s.proxy_server.host, "port": s.proxy_server.port} if s.proxy_server else None
-        }
-        for s in servers
-    ]
+    names = parseFields(fields, server_list_fields)
+    query = db.query(Server.id, *(SERVER_LIST_COLUMNS[name].label(name) for name in names if name in SERVER_LIST_COLUMNS))
+    if "proxy" in names:
+        proxy = aliased(Server)
+        query = (
+            query.add_columns(proxy.id.label("proxy_id"), proxy.host.label("proxy_host"), proxy.port.label("proxy_port"))
+                 .outerjoin(proxy, Server.proxy_server_id == proxy.id)
+        )
+    query = filterServers(query, server_status, tag, gateway, proxy_id)
+    servers, next_cursor = trimPage(paginate(query, Server.id, cursor, limit).all(), limit)
+    if next_cursor:
+        response.headers[next_cursor_header] = next_cursor
+    tags = {}
+    if "tags" in names and servers:
+        for server_id, tag_name in (
+            db.query(ServerTag.server_id, ServerTag.tag)
+              .filter(ServerTag.server_id.in_([s.id for s in servers]))
+              .order_by(ServerTag.id)
+              .all()
+        ):
+            tags.setdefault(server_id, []).append(tag_name)
+    result = []
+    for s in servers:
+        item = {}
+        for name in names:
+            if name == "tags":
+                item["tags"] = tags.get(s.id, [])
+            elif name == "proxy":
+                item["proxy"] = {"id": s.proxy_id, "host": s.proxy_host, "port": s.proxy_port} if s.proxy_id else None
+            else:
+                item[name] = getattr(s, name)
+        result.append(item)
+    return result
 
 @router.get("/{server_id}", response_model=dict)
 def get_server_detail(
@@ -78,7 +137,12 @@ def get_server_detail(
 ):
     if not user:
         raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Not authenticated")
-    srv = db.query(Server).filter(Server.id == server_id).first()
+    srv = (
+        db.query(Server)
+          .options(selectinload(Server.tags), selectinload(Server.interfaces).selectinload(ServerInterface.tags))
+          .filter(Server.id == server_id)
+          .first()
+    )
     if not srv:
         raise HTTPException(status.HTTP_404_NOT_FOUND, "Server not found")
     result = {
@@ -93,46 +157,45 @@ def get_server_detail(
         "os_version": srv.os_version,
         "kernel_version": srv.kernel_version,
         "ipmi": srv.ipmi,
+        "has_agent": srv.agent_token_hash != "",
+        "agent_last_seen": srv.agent_last_seen,
         "tags": [{"id": t.id, "tag": t.tag} for t in srv.tags],
         "interfaces": []
     }
-    for i in srv.interfaces:
-        peer_interface = None
-        peer_switch = None
-        if i.conn_id:
-            conn = db.query(Connection).get(i.conn_id)
-            if conn:
-                # try find other interface
-                for pi in conn.interfaces:
-                    if pi.id != i.id:
-                        peer_interface = {
-                            "id": pi.id,
-                            "server_id": pi.server_id,
-                            "server_host": pi.server.host,
-                            "interface": pi.interface,
-                            "manufacturer": pi.manufacturer,
-                            "pci_address": pi.pci_address
-                        }
-                        break
-                # else check switch ports
-                if not peer_interface and conn.switch_ports:
-                    sp = conn.switch_ports[0]
+    with topology.view(db) as topo:
+        for i in srv.interfaces:
+            peer_interface = None
+            peer_switch = None
+            connected = topo.peer(("interface", i.id))
+            if connected:
+                kind, peer = connected
+                if kind == "interface":
+                    peer_interface = {
+                        "id": peer.id,
+                        "server_id": peer.server_id,
+                        "server_host": peer.server_host,
+                        "interface": peer.interface,
+                        "manufacturer": peer.manufacturer,
+                        "pci_address": peer.pci_address
+                    }
+                else:
                     peer_switch = {
-                        "switch_id": sp.switch_id,
-                        "switch_name": sp.switch.name,
-                        "phy_row": sp.phy_row,
-                        "phy_col": sp.phy_col,
-                        "port_num": sp.phy_col * sp.switch.num_row + sp.phy_row + 1
+                        "switch_id": peer.switch_id,
+                        "switch_name": topo.switches[peer.switch_id].name,
+                        "phy_row": peer.phy_row,
+                        "phy_col": peer.phy_col,
+                        "port_num": topo.portNumber(peer)
                     }
-        result["interfaces"].append({
-            "id": i.id,
-            "interface": i.interface,
-            "pci_address": i.pci_address,
-            "manufacturer": i.manufacturer,
-            "tags": [{"id": tg.id, "tag": tg.tag} for tg in i.tags],
-            "peer_interface": peer_interface,
-            "peer_switch": peer_switch
-        })
+            result["interfaces"].append({
+                "id": i.id,
+                "interface": i.interface,
+                "pci_address": i.pci_address,
+                "manufacturer": i.manufacturer,
+                "is_present": i.is_present,
+                "tags": [{"id": tg.id, "tag": tg.tag} for tg in i.tags],
+                "peer_interface": peer_interface,
+                "peer_switch": peer_switch
+            })
     return result
 
 class ServerTagAddIn(BaseModel):
@@ -222,6 +285,38 @@ def update_ipmi(
     db.commit()
     return {"msg": "IPMI updated"}
 
+@router.post("/{server_id}/agent_token", response_model=dict)
+def issue_agent_token(
+    server_id: int,
+    admin: User = Depends(getUserAdmin),
+    db: Session = Depends(get_db)
+):
+    """
+    Issue a new push agent token for the server, the previous token stops working.
+    The token is only returned here, the database keeps its hash.
+    """
+    srv = db.query(Server).filter(Server.id == server_id).first()
+    if not srv:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Server not found")
+    token = secrets.token_urlsafe(32)
+    srv.agent_token_hash = hashAgentToken(token)
+    db.commit()
+    return {"msg": "Agent token issued", "token": token}
+
+@router.delete("/{server_id}/agent_token", response_model=dict)
+def revoke_agent_token(
+    server_id: int,
+    admin: User = Depends(getUserAdmin),
+    db: Session = Depends(get_db)
+):
+    srv = db.query(Server).filter(Server.id == server_id).first()
+    if not srv:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Server not found")
+    srv.agent_token_hash = ""
+    srv.agent_last_seen = None
+    db.commit()
+    return {"msg": "Agent token revoked"}
+
 @router.post("/refresh", response_model=dict)
 def refresh_server(
     admin: User = Depends(getUserAdmin)
@@ -1,40 +1,77 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
-from typing import List, Dict
+from typing import List, Dict, Optional
 
-from app.database import get_db, Server, User
+from app.database import get_db, Account, Server, ServerStatus, User
+from app.api.server import filterServers
 from validator import getUser
+from pagination import max_page_size, next_cursor_header, paginate, parseFields, trimPage
 
 router = APIRouter()
 
+# Fields of /summary/get, a `fields=` projection selects among them
+summary_fields = ["id", "host", "status", "isGateway", "isMounted", "users"]
+SUMMARY_COLUMNS = {
+    "host": Server.host,
+    "status": Server.server_status,
+    "isGateway": Server.is_gateway,
+    "isMounted": Server.is_mounted_home,
+}
+
 @router.get("/get", response_model=List[Dict])
 def get_summary(
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=max_page_size),
+    fields: Optional[str] = None,
+    server_status: Optional[ServerStatus] = Query(None, alias="status"),
+    tag: Optional[str] = None,
+    gateway: Optional[bool] = None,
+    proxy_id: Optional[int] = Query(None, alias="proxy"),
     user: User = Depends(getUser),
     db: Session = Depends(get_db)
 ):
+    """
+    Servers with their loginable accounts, paginated and filtered like /server/list.
+    """
     if not user:
         raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Not authenticated")
-    servers = db.query(Server).all()
+    names = parseFields(fields, summary_fields)
+    # One query for the servers and one for the loginable accounts of all of them, only the shown columns
+    query = db.query(Server.id, *(SUMMARY_COLUMNS[name].label(name) for name in names if name in SUMMARY_COLUMNS))
+    query = filterServers(query, server_status, tag, gateway, proxy_id)
+    servers, next_cursor = trimPage(paginate(query, Server.id, cursor, limit).all(), limit)
+    users = {}
+    if "users" in names and servers:
+        accounts = (
+            db.query(Account.server_id, Account.id, User.realname, Account.is_sudo, Account.last_login_date)
+              .join(User, Account.user_id == User.id)
+              .filter(Account.is_login_able == True)
+              .order_by(Account.server_id, Account.id)
+        )
+        if limit is not None or cursor or any(f is not None for f in (server_status, tag, gateway, proxy_id)):
+            # A page or a filtered list only needs the accounts of its servers, the full list reads them all
+            accounts = accounts.filter(Account.server_id.in_([s.id for s in servers]))
+        for server_id, account_id, realname, is_sudo, last_login_date in accounts.all():
+            users.setdefault(server_id, []).append({
+                "id": account_id,
+                "user": realname,
+                "sudo": is_sudo,
+                "lastLogin": last_login_date.strftime("%Y-%m-%d %H:%M:%S")
+            })
     result = []
-    for srv in servers:
-        result.append({
-            "id": srv.id,
-            "host": srv.host,
-            "status": srv.server_status.value,
-            "isGateway": srv.is_gateway,
-            "isMounted": srv.is_mounted_home,
-            "users": [
-                {
-                    "id": acct.id,
-                    "user": acct.user.realname,
-                    "sudo": acct.is_sudo,
-                    "lastLogin": acct.last_login_date.strftime("%Y-%m-%d %H:%M:%S")
-                }
-                for acct in srv.accounts if acct.is_login_able
-            ]
-        })
+    for s in servers:
+        item = {}
+        for name in names:
+            if name == "users":
+                item["users"] = users.get(s.id, [])
+            elif name == "status":
+                item["status"] = s.status.value
+            else:
+                item[name] = getattr(s, name)
+        result.append(item)
     return JSONResponse(
         content=result,
-        status_code=status.HTTP_200_OK
+        status_code=status.HTTP_200_OK,
+        headers={next_cursor_header: next_cursor} if next_cursor else None
     )
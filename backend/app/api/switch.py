@@ -1,11 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Dict, Optional
 from pydantic import BaseModel
 
 from app.database import get_db, Switch, User, SwitchPort
 from validator import getUserAdmin
 from logger import logger
+from topology import topology
+from pagination import max_page_size, next_cursor_header, paginate, parseFields, trimPage
 
 router = APIRouter()
 
@@ -47,9 +49,25 @@ def add_switch(body: SwitchCreate, db: Session = Depends(get_db), _=Depends(getU
         logger.error(f"Error adding switch ports: {e}")
         db.rollback()
         raise HTTPException(status_code=500, detail="Failed to add switch ports")
+    topology.invalidate()
     logger.info(f"Switch {body.name} added with ID {db_sw.id}")
     return db_sw
 
-@router.get("/list", response_model=List[SwitchOut])
-def list_switches(db: Session = Depends(get_db), _=Depends(getUserAdmin)):
-    return db.query(Switch).all()
\ No newline at end of file
+# Fields of /switch/list, a `fields=` projection selects among them
+switch_list_fields = list(SwitchOut.model_fields)
+
+@router.get("/list", response_model=List[Dict])
+def list_switches(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=max_page_size),
+    fields: Optional[str] = None,
+    db: Session = Depends(get_db),
+    _=Depends(getUserAdmin)
+):
+    names = parseFields(fields, switch_list_fields)
+    query = db.query(Switch.id, *(getattr(Switch, name) for name in names if name != "id"))
+    switches, next_cursor = trimPage(paginate(query, Switch.id, cursor, limit).all(), limit)
+    if next_cursor:
+        response.headers[next_cursor_header] = next_cursor
+    return [{name: getattr(sw, name) for name in names} for sw in switches]
\ No newline at end of file
@@ -0,0 +1,116 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+from typing import List, Dict, Optional
+import datetime
+
+from app.database import get_db, User, SyncJob, SyncJobKind, SyncJobState
+from validator import getUserAdmin
+from sync_events import notifySync
+from sync_jobs import worker_id
+from leader_lease import getLease
+import account_sync
+
+router = APIRouter()
+
+def followerReport(db: Session) -> Optional[dict]:
+    """
+    The engine stats are kept by the process running the engine, another worker only points to it.
+    None on the leader.
+    """
+    if account_sync.start_watcher:
+        return None
+    lease = getLease(db, account_sync.leader_lease_name)
+    return {
+        "is_leader": False,
+        "worker": worker_id,
+        "leader": lease["holder"] if lease and lease["holder"] and not lease["expired"] else None
+    }
+
+@router.get("/scheduler", response_model=dict)
+def get_scheduler_stats(
+    admin: User = Depends(getUserAdmin),
+    db: Session = Depends(get_db)
+):
+    follower = followerReport(db)
+    if follower:
+        return follower
+    return {
+        "scheduler": account_sync.scheduler.stats(),
+        "connections": account_sync.pool.stats()
+    }
+
+@router.get("/health", response_model=dict)
+def get_server_health(
+    admin: User = Depends(getUserAdmin),
+    db: Session = Depends(get_db)
+):
+    return followerReport(db) or account_sync.health.stats()
+
+@router.get("/loop", response_model=dict)
+def get_loop_lag(
+    admin: User = Depends(getUserAdmin),
+    db: Session = Depends(get_db)
+):
+    return followerReport(db) or account_sync.loop_monitor.stats()
+
+@router.get("/leader", response_model=dict)
+def get_leader(
+    admin: User = Depends(getUserAdmin),
+    db: Session = Depends(get_db)
+):
+    return {
+        "worker": worker_id,
+        "is_leader": account_sync.start_watcher,
+        "lease": getLease(db, account_sync.leader_lease_name)
+    }
+
+@router.get("/jobs", response_model=List[Dict])
+def list_sync_jobs(
+    state: Optional[SyncJobState] = None,
+    kind: Optional[SyncJobKind] = None,
+    server_id: Optional[int] = None,
+    limit: int = 200,
+    admin: User = Depends(getUserAdmin),
+    db: Session = Depends(get_db)
+):
+    query = db.query(SyncJob)
+    if state is not None:
+        query = query.filter(SyncJob.state == state)
+    if kind is not None:
+        query = query.filter(SyncJob.kind == kind)
+    if server_id is not None:
+        query = query.filter(SyncJob.server_id == server_id)
+    jobs = query.order_by(SyncJob.next_run_at.is_(None), SyncJob.next_run_at).limit(limit).all()
+    return [
+        {
+            "id": job.id,
+            "kind": job.kind.value,
+            "server_id": job.server_id,
+            "state": job.state.value,
+            "attempts": job.attempts,
+            "next_run_at": job.next_run_at,
+            "lease_owner": job.lease_owner,
+            "lease_expires_at": job.lease_expires_at,
+            "last_error": job.last_error,
+            "updated_at": job.updated_at,
+            "finished_at": job.finished_at
+        }
+        for job in jobs
+    ]
+
+@router.post("/jobs/{job_id}/retry", response_model=dict)
+def retry_sync_job(
+    job_id: int,
+    admin: User = Depends(getUserAdmin),
+    db: Session = Depends(get_db)
+):
+    job = db.query(SyncJob).filter(SyncJob.id == job_id).first()
+    if not job:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Sync job not found")
+    if job.state == SyncJobState.RUNNING:
+        raise HTTPException(status.HTTP_409_CONFLICT, "Sync job is running")
+    job.state = SyncJobState.PENDING
+    job.next_run_at = datetime.datetime.now()
+    db.commit()
+    notifySync([])
+    return {"msg": "Sync job scheduled"}
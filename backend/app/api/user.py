@@ -1,11 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from sqlalchemy.orm import Session
-from typing import List, Dict
+from typing import List, Dict, Optional
 from pydantic import BaseModel, EmailStr
 
 from app.database import get_db, User as DBUser, Application, Account, UserStatus, AccountStatus
-from validator import getUser, getUserAdmin
+from validator import getUser, getUserAdmin, principals
 from app.api.auth import verify_password, get_password_hash
+from sync_events import notifySync
+from pagination import max_page_size, next_cursor_header, paginate, parseFields, trimPage
 
 router = APIRouter()
 
@@ -67,15 +69,23 @@ def read_user_accounts(
         for acct in user.accounts if acct.is_login_able
     ]
 
+# Fields of /user/users, a `fields=` projection selects among them
+user_list_fields = ["id", "username", "status", "is_admin"]
+
 @router.get("/users", response_model=List[Dict])
 def list_users(
-    user_status: str,
+    response: Response,
+    user_status: str = "all",
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=max_page_size),
+    fields: Optional[str] = None,
     admin: DBUser = Depends(getUserAdmin),
     db: Session = Depends(get_db)
 ):
     if not admin:
         raise HTTPException(status.HTTP_403_FORBIDDEN, "Admin privileges required")
-    query = db.query(DBUser)
+    names = parseFields(fields, user_list_fields)
+    query = db.query(DBUser.id, *(getattr(DBUser, name) for name in names if name != "id"))
     if user_status and user_status != "all":
         mapping = {
             "active": UserStatus.ACTIVE,
@@ -85,8 +95,10 @@ def list_users(
         if user_status not in mapping:
             raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid user status")
         query = query.filter(DBUser.status == mapping[user_status])
-    users = query.all()
-    return [{"id": u.id, "username": u.username, "status": u.status, "is_admin": u.is_admin} for u in users]
+    users, next_cursor = trimPage(paginate(query, DBUser.id, cursor, limit).all(), limit)
+    if next_cursor:
+        response.headers[next_cursor_header] = next_cursor
+    return [{name: getattr(u, name) for name in names} for u in users]
 
 @router.post("/user/{user_id}/approve", response_model=dict)
 def approve_user(
@@ -99,6 +111,8 @@ def approve_user(
         raise HTTPException(status.HTTP_404_NOT_FOUND, "User not found")
     user.status = UserStatus.ACTIVE
     db.commit()
+    principals.invalidate(user_id)
+    notifySync()
     return {"msg": "User approved"}
 
 @router.post("/user/{user_id}/revoke-admin", response_model=dict)
@@ -112,6 +126,8 @@ def revoke_admin(
         raise HTTPException(status.HTTP_404_NOT_FOUND, "User not found")
     user.is_admin = False
     db.commit()
+    principals.invalidate(user_id)
+    notifySync()
     return {"msg": "Admin rights revoked"}
 
 @router.post("/user/{user_id}/graduate", response_model=dict)
@@ -125,6 +141,8 @@ def graduate_user(
         raise HTTPException(status.HTTP_404_NOT_FOUND, "User not found")
     user.status = UserStatus.GRADUATED
     db.commit()
+    principals.invalidate(user_id)
+    notifySync()
     return {"msg": "User graduated"}
 
 @router.post("/user/{user_id}/grant-admin", response_model=dict)
@@ -138,6 +156,8 @@ def grant_admin_user(
         raise HTTPException(status.HTTP_404_NOT_FOUND, "User not found")
     user.is_admin = True
     db.commit()
+    principals.invalidate(user_id)
+    notifySync()
     return {"msg": "Admin rights granted"}
 
 @router.post("/user/{user_id}/restore", response_model=dict)
@@ -151,6 +171,8 @@ def restore_user(
         raise HTTPException(status.HTTP_404_NOT_FOUND, "User not found")
     user.status = UserStatus.ACTIVE
     db.commit()
+    principals.invalidate(user_id)
+    notifySync()
     return {"msg": "User restored"}
 
 @router.post("/update", response_model=dict)
@@ -185,4 +207,7 @@ def update_user(
         for account in target.accounts:
             account.status = AccountStatus.DIRTY
     db.commit()
+    principals.invalidate(data.id)
+    if needUpdateAccounts:
+        notifySync([account.id for account in target.accounts])
     return {"msg": "User updated"}
@@ -1,11 +1,14 @@
+import fcntl
 import os
-from sqlalchemy import create_engine, ForeignKey, event, DDL
+from contextlib import contextmanager
+from sqlalchemy import create_engine, ForeignKey, event, func, DateTime, DDL, Index, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Mapped, mapped_column, relationship
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import List, Optional
 from enum import Enum
+from logger import logger
 
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -48,6 +51,12 @@ class Server(Base):
     is_mounted_home : Mapped[bool] = mapped_column(default=False)
     kernel_version : Mapped[str] = mapped_column(default="")
     os_version : Mapped[str] = mapped_column(default="")
+    # Hash of the kernel, release and NICs of the last collection, an unchanged server is not written again
+    inventory_fingerprint : Mapped[str] = mapped_column(default="")
+
+    # Push agent, only the sha256 of its token is stored
+    agent_token_hash : Mapped[str] = mapped_column(default="")
+    agent_last_seen : Mapped[Optional[datetime]] = mapped_column()
 
     # Proxy Server
     proxy_server_id : Mapped[Optional[int]] = mapped_column(ForeignKey("server.id"))
@@ -60,6 +69,7 @@ class Server(Base):
     # Relationships
     applications : Mapped[List["Application"]] = relationship(back_populates="server", cascade="all, delete-orphan")
     accounts : Mapped[List["Account"]] = relationship(back_populates="server", cascade="all, delete-orphan")
+    sync_jobs : Mapped[List["SyncJob"]] = relationship(back_populates="server", cascade="all, delete-orphan")
     tags : Mapped[List["ServerTag"]] = relationship(back_populates="server", cascade="all, delete-orphan")
     interfaces : Mapped[List["ServerInterface"]] = relationship(back_populates="server", cascade="all, delete-orphan")
 
@@ -111,10 +121,12 @@ class Account(Base):
     id : Mapped[int] = mapped_column(primary_key=True)
     is_sudo : Mapped[bool] = mapped_column(default=False)
     is_login_able : Mapped[bool] = mapped_column(default=True)
-    status : Mapped[AccountStatus] = mapped_column(default=AccountStatus.DIRTY)
+    status : Mapped[AccountStatus] = mapped_column(default=AccountStatus.DIRTY, index=True)
 
     # Automatically collected data
     last_login_date : Mapped[datetime] = mapped_column(default=datetime.now)
+    # Hash of the account state on the server after the last successful sync, empty if unknown
+    sync_fingerprint : Mapped[str] = mapped_column(default="")
     
     # Relationships
     user_id : Mapped[int] = mapped_column(ForeignKey("user.id"))
@@ -146,10 +158,16 @@ class Connection(Base):
 
 class ServerInterface(Base):
     __tablename__ = 'server_interface'
+    __table_args__ = (
+        # One interface per PCI address of a server, target of the inventory upsert
+        Index("ix_server_interface_server_pci", "server_id", "pci_address", unique=True),
+    )
     id : Mapped[int] = mapped_column(primary_key=True)
     interface : Mapped[str] = mapped_column()
     manufacturer : Mapped[str] = mapped_column()
     pci_address : Mapped[str] = mapped_column()
+    # False once the interface is no longer reported by the server
+    is_present : Mapped[bool] = mapped_column(default=True)
 
     server_id : Mapped[int] = mapped_column(ForeignKey("server.id"))
     server : Mapped["Server"] = relationship("Server", back_populates="interfaces")
@@ -187,6 +205,61 @@ class SwitchPort(Base):
     )
     conn : Mapped[Optional["Connection"]] = relationship(back_populates="switch_ports")
 
+class SyncJobKind(Enum):
+    ACCOUNTS = 'accounts' # Reconcile the dirty accounts of the server
+    COLLECT = 'collect' # Collect the inventory and the login history of the server
+
+class SyncJobState(Enum):
+    PENDING = 'pending' # Runs once next_run_at is reached
+    RUNNING = 'running' # Leased by a worker until lease_expires_at
+    DONE = 'done' # Finished, runs again at next_run_at if it is set
+    FAILED = 'failed' # Finished with errors, retried at next_run_at
+
+class SyncJob(Base):
+    """
+    Durable sync work, one row per server and kind.
+    A worker claims a due job by leasing it; a job whose lease expired (its worker died) can be claimed again.
+    """
+    __tablename__ = 'sync_job'
+    __table_args__ = (
+        Index("ix_sync_job_kind_server", "kind", "server_id", unique=True),
+        Index("ix_sync_job_next_run", "state", "next_run_at"),
+    )
+    id : Mapped[int] = mapped_column(primary_key=True)
+    kind : Mapped[SyncJobKind] = mapped_column()
+    state : Mapped[SyncJobState] = mapped_column(default=SyncJobState.PENDING)
+    attempts : Mapped[int] = mapped_column(default=0)
+    next_run_at : Mapped[Optional[datetime]] = mapped_column(default=datetime.now)
+    lease_owner : Mapped[str] = mapped_column(default="")
+    lease_expires_at : Mapped[Optional[datetime]] = mapped_column()
+    last_error : Mapped[str] = mapped_column(default="")
+    updated_at : Mapped[datetime] = mapped_column(default=datetime.now, onupdate=datetime.now)
+    finished_at : Mapped[Optional[datetime]] = mapped_column()
+
+    server_id : Mapped[int] = mapped_column(ForeignKey("server.id", ondelete="CASCADE"))
+    server : Mapped["Server"] = relationship(back_populates="sync_jobs")
+
+class EngineLease(Base):
+    """
+    Lease of a role that only one process may hold at a time (e.g. running the sync engine).
+    The holder renews it before it expires, once expired any process may take it over.
+    """
+    __tablename__ = 'engine_lease'
+    name : Mapped[str] = mapped_column(primary_key=True)
+    holder : Mapped[str] = mapped_column(default="")
+    expires_at : Mapped[datetime] = mapped_column()
+    acquired_at : Mapped[datetime] = mapped_column()
+
+def dbNow(offset: Optional[timedelta] = None):
+    """
+    Time of the database (plus `offset`) as a SQL expression, in the format datetimes are stored in.
+    Leases are written and checked against it rather than the clock of the worker that runs the query.
+    """
+    modifiers = ["now", "localtime"]
+    if offset is not None:
+        modifiers.append(f"{offset.total_seconds():+f} seconds")
+    return func.strftime("%Y-%m-%d %H:%M:%f", *modifiers, type_=DateTime)
+
 # Trigger: when a ServerInterface is deleted, delete its Connection
 event.listen(
     ServerInterface.__table__,
@@ -220,3 +293,151 @@ event.listen(
         """
     ),
 )
+
+# Full-text index of the fleet search (/search): one row per server, interface and user, kept up to
+# date by the triggers below. The rowid is id * 4 + the code of the kind, so a trigger finds the row
+# of an entity without scanning the index.
+SEARCH_INDEX_DDL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS fleet_search USING fts5(
+    kind UNINDEXED, ref_id UNINDEXED, server_id UNINDEXED, name, details, tags,
+    tokenize = 'unicode61 remove_diacritics 2'
+)
+"""
+SEARCH_DOCUMENTS = {
+    # kind: (code, select of the documents, id column of the select)
+    "server": (1, """SELECT s.id * 4 + 1, 'server', s.id, s.id, s.host, s.os_version || ' ' || s.kernel_version,
+                 coalesce((SELECT group_concat(t.tag, ' ') FROM server_tag t WHERE t.server_id = s.id), '')
+                 FROM server s""", "s.id"),
+    "interface": (2, """SELECT i.id * 4 + 2, 'interface', i.id, i.server_id, i.interface || ' ' || i.pci_address, i.manufacturer,
+                    coalesce((SELECT group_concat(t.tag, ' ') FROM interface_tag t WHERE t.interface_id = i.id), '')
+                    FROM server_interface i""", "i.id"),
+    "user": (3, """SELECT u.id * 4 + 3, 'user', u.id, NULL, u.realname, u.account_name || ' ' || u.username, ''
+               FROM "user" u""", "u.id"),
+}
+
+def _searchRefresh(kind: str, id_expr: str) -> str:
+    code, select, id_column = SEARCH_DOCUMENTS[kind]
+    return (
+        f"DELETE FROM fleet_search WHERE rowid = {id_expr} * 4 + {code};\n"
+        f"INSERT INTO fleet_search(rowid, kind, ref_id, server_id, name, details, tags) {select} WHERE {id_column} = {id_expr};\n"
+    )
+
+def _searchDelete(kind: str, id_expr: str) -> str:
+    return f"DELETE FROM fleet_search WHERE rowid = {id_expr} * 4 + {SEARCH_DOCUMENTS[kind][0]};\n"
+
+SEARCH_TRIGGERS = {
+    "trg_search_server_insert": ("AFTER INSERT ON server", _searchRefresh("server", "NEW.id")),
+    "trg_search_server_update": ("AFTER UPDATE OF host, os_version, kernel_version ON server", _searchRefresh("server", "NEW.id")),
+    "trg_search_server_delete": ("AFTER DELETE ON server", _searchDelete("server", "OLD.id")),
+    "trg_search_server_tag_insert": ("AFTER INSERT ON server_tag", _searchRefresh("server", "NEW.server_id")),
+    "trg_search_server_tag_update": ("AFTER UPDATE ON server_tag", _searchRefresh("server", "OLD.server_id") + _searchRefresh("server", "NEW.server_id")),
+    "trg_search_server_tag_delete": ("AFTER DELETE ON server_tag", _searchRefresh("server", "OLD.server_id")),
+    "trg_search_interface_insert": ("AFTER INSERT ON server_interface", _searchRefresh("interface", "NEW.id")),
+    "trg_search_interface_update": ("AFTER UPDATE OF interface, manufacturer, pci_address, server_id ON server_interface", _searchRefresh("interface", "NEW.id")),
+    "trg_search_interface_delete": ("AFTER DELETE ON server_interface", _searchDelete("interface", "OLD.id")),
+    "trg_search_interface_tag_insert": ("AFTER INSERT ON interface_tag", _searchRefresh("interface", "NEW.interface_id")),
+    "trg_search_interface_tag_update": ("AFTER UPDATE ON interface_tag", _searchRefresh("interface", "OLD.interface_id") + _searchRefresh("interface", "NEW.interface_id")),
+    "trg_search_interface_tag_delete": ("AFTER DELETE ON interface_tag", _searchRefresh("interface", "OLD.interface_id")),
+    "trg_search_user_insert": ('AFTER INSERT ON "user"', _searchRefresh("user", "NEW.id")),
+    "trg_search_user_update": ('AFTER UPDATE OF realname, account_name, username ON "user"', _searchRefresh("user", "NEW.id")),
+    "trg_search_user_delete": ('AFTER DELETE ON "user"', _searchDelete("user", "OLD.id")),
+}
+
+def rebuildSearchIndex(conn):
+    """
+    Fill the search index from scratch, the triggers keep it up to date afterwards.
+    """
+    conn.execute(text("DELETE FROM fleet_search"))
+    for code, select, _ in SEARCH_DOCUMENTS.values():
+        conn.execute(text(f"INSERT INTO fleet_search(rowid, kind, ref_id, server_id, name, details, tags) {select}"))
+
+def createSearchIndex(conn):
+    """
+    Create the search index and its triggers if they are missing, a new index is filled from the existing rows.
+    """
+    created = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fleet_search'")).first() is None
+    conn.execute(text(SEARCH_INDEX_DDL))
+    for name, (when, body) in SEARCH_TRIGGERS.items():
+        conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS {name} {when} FOR EACH ROW BEGIN\n{body}END;"))
+    if created:
+        rebuildSearchIndex(conn)
+
+def dedupeServerInterfaces(conn):
+    """
+    Drop the interfaces that share the server and PCI address of another one (left by older versions),
+    so the unique index the inventory upsert relies on can be created. The cabled interface is kept,
+    else the newest; the tags of the dropped ones move to it.
+    """
+    rows = conn.execute(text(
+        """
+        SELECT id, server_id, pci_address FROM server_interface
+        WHERE (server_id, pci_address) IN (
+            SELECT server_id, pci_address FROM server_interface GROUP BY server_id, pci_address HAVING COUNT(*) > 1
+        )
+        ORDER BY server_id, pci_address, conn_id IS NULL, id DESC
+        """
+    )).all()
+    kept = {}
+    for interface_id, server_id, pci_address in rows:
+        keep = kept.setdefault((server_id, pci_address), interface_id)
+        if keep == interface_id:
+            continue
+        conn.execute(text("UPDATE interface_tag SET interface_id = :keep WHERE interface_id = :drop"), {"keep": keep, "drop": interface_id})
+        conn.execute(text("DELETE FROM server_interface WHERE id = :drop"), {"drop": interface_id})
+    if rows:
+        logger.warning(f"Removed {len(rows) - len(kept)} duplicated server interfaces")
+
+# Indexes that can only be created once the rows violating them are cleaned up
+INDEX_CLEANUPS = {
+    "ix_server_interface_server_pci": dedupeServerInterfaces,
+}
+
+@contextmanager
+def schemaLock():
+    """
+    Serialize the schema setup of the API workers starting at once, on a lock file next to the database.
+    """
+    database = engine.url.database
+    if engine.dialect.name != "sqlite" or not database or database == ":memory:":
+        yield
+        return
+    with open(f"{database}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def migrateSchema():
+    """
+    Create the missing tables and bring the existing tables up to date: add the columns and indexes
+    that were added to the models since the table was created, and create the search index.
+    Runs once per worker at startup, the workers take turns; the later ones find nothing left to do.
+    """
+    with schemaLock():
+        Base.metadata.create_all(bind=engine)
+        _migrateSchema()
+
+def _migrateSchema():
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                if column.default is not None and column.default.is_scalar:
+                    conn.execute(table.update().values({column.name: column.default.arg}))
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in indexes:
+                    continue
+                if index.name in INDEX_CLEANUPS:
+                    INDEX_CLEANUPS[index.name](conn)
+                # A failure stops the startup, the code relies on the index (e.g. as an upsert target)
+                index.create(conn)
+        createSearchIndex(conn)
@@ -0,0 +1,267 @@
+"""
+Throughput benchmark of the sync engine against a fake fleet (see fake_fleet.py).
+
+For every fleet size a fresh database gets `--accounts` dirty accounts on each host, the engine is
+started as the leader and timed until the account job of every host ran once. With `--passes 2`
+every account is marked dirty again and the (fingerprint) resync of the already reconciled fleet
+is timed as well. Reports accounts/s, the SSH connections opened and the tail latency of the jobs.
+
+    cd backend
+    python -m bench.bench_sync --hosts 10 100 500 2000 --accounts 10 --latency 0.02 --proxy-hops 1
+
+The database is a temporary SQLite file unless DATABASE_URL is set, it is dropped and created again
+for every fleet size.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def populate(db, fleet, hosts: int, accounts: int, proxy_hops: int, proxy_fanout: int, collect: bool) -> list[int]:
+    """
+    Add the users, the servers (with their jump hosts) and the dirty accounts, returns the ids of the target servers.
+    """
+    import datetime
+    from sqlalchemy import insert
+    from app.database import Account, AccountStatus, Server, SyncJob, SyncJobKind, SyncJobState, User, UserStatus
+
+    now = datetime.datetime.now()
+    user_ids = db.execute(insert(User).returning(User.id), [{
+        "username": f"bench{j:04d}", "realname": f"Bench {j}", "account_name": f"bench{j:04d}",
+        "mail": f"bench{j:04d}@example.com", "is_admin": j == 0, "password": "",
+        "public_key": f"ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI{j:032d} bench{j:04d}",
+        "status": UserStatus.ACTIVE,
+    } for j in range(accounts)]).scalars().all()
+
+    server_ids = []
+    proxy_id = None
+    for i in range(hosts):
+        # Every `proxy_fanout` hosts share a chain of `proxy_hops` jump hosts
+        if proxy_hops and i % proxy_fanout == 0:
+            proxy_id = None
+            for _ in range(proxy_hops):
+                jump = fleet.addHost()
+                proxy_id = db.execute(insert(Server).returning(Server.id), [{
+                    "host": jump.address, "port": 0, "proxy_server_id": proxy_id,
+                }]).scalar_one()
+        host = fleet.addHost()
+        server_ids.append(db.execute(insert(Server).returning(Server.id), [{
+            "host": host.address, "port": 0, "proxy_server_id": proxy_id,
+        }]).scalar_one())
+
+    db.execute(insert(Account), [{
+        "user_id": user_id, "server_id": server_id, "is_sudo": j == 0, "is_login_able": True,
+        "status": AccountStatus.DIRTY, "last_login_date": now,
+    } for server_id in server_ids for j, user_id in enumerate(user_ids)])
+    if not collect:
+        # A scheduled collection is kept by enqueueCollections, push them out of the run
+        db.execute(insert(SyncJob), [{
+            "kind": SyncJobKind.COLLECT, "server_id": server_id, "state": SyncJobState.DONE,
+            "next_run_at": now + datetime.timedelta(days=1),
+        } for server_id, in db.query(Server.id).all()])
+    db.commit()
+    return server_ids
+
+async def runPass(server_ids: list[int], timeout: float) -> dict:
+    """
+    Wake the engine and wait until the account job of every server finished once.
+    """
+    import account_sync
+    from sqlalchemy import func
+    from app.database import Account, AccountStatus, SessionLocal
+    from sync_events import notifySync
+
+    durations = []
+    completions = []
+    finished = set()
+    targets = set(server_ids)
+    done = asyncio.Event()
+    start = time.perf_counter()
+    syncServerAccounts = account_sync.syncServerAccounts
+
+    async def timedSync(server, entries, job_id):
+        job_start = time.perf_counter()
+        try:
+            await syncServerAccounts(server, entries, job_id)
+        finally:
+            now = time.perf_counter()
+            durations.append(now - job_start)
+            completions.append(now - start)
+            finished.add(server.id)
+            if targets <= finished:
+                done.set()
+
+    account_sync.syncServerAccounts = timedSync
+    pool_before = account_sync.pool.stats()
+    try:
+        notifySync()
+        await asyncio.wait_for(done.wait(), timeout=timeout)
+        timed_out = False
+    except asyncio.TimeoutError:
+        timed_out = True
+    finally:
+        account_sync.syncServerAccounts = syncServerAccounts
+    elapsed = time.perf_counter() - start
+    pool_after = account_sync.pool.stats()
+
+    db = SessionLocal()
+    try:
+        active = db.query(func.count(Account.id)).filter(Account.status == AccountStatus.ACTIVE).scalar()
+        total = db.query(func.count(Account.id)).scalar()
+    finally:
+        db.close()
+    return {
+        "seconds": round(elapsed, 3),
+        "timed_out": timed_out,
+        "servers_done": len(finished & targets),
+        "accounts": total,
+        "accounts_active": active,
+        "accounts_per_second": round(active / elapsed, 1) if elapsed else 0.0,
+        "connections_opened": pool_after["connections_opened"] - pool_before["connections_opened"],
+        "connections_reused": pool_after["connections_reused"] - pool_before["connections_reused"],
+        "tunnels_opened": pool_after["tunnels_opened"] - pool_before["tunnels_opened"],
+        "job_p50": round(percentile(durations, 50), 3),
+        "job_p95": round(percentile(durations, 95), 3),
+        "job_p99": round(percentile(durations, 99), 3),
+        "job_max": round(max(durations, default=0.0), 3),
+        "done_p99": round(percentile(completions, 99), 3),
+    }
+
+async def benchFleet(args, hosts: int) -> list[dict]:
+    import account_sync
+    from sqlalchemy import update
+    from app.database import Account, AccountStatus, Base, SessionLocal, engine
+    from bench.fake_fleet import FakeFleet
+    from connection_pool import ConnectionPool
+    from server_health import HealthTracker
+    from sync_events import bindLoop, notifySync
+    from sync_scheduler import SyncScheduler
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    fleet = FakeFleet(latency=args.latency, jitter=args.jitter, connect_latency=args.connect_latency,
+                      hop_latency=args.hop_latency, failure_rate=args.failure_rate, down_rate=args.down_rate,
+                      seed=args.seed)
+    db = SessionLocal()
+    try:
+        server_ids = populate(db, fleet, hosts, args.accounts, args.proxy_hops, args.proxy_fanout, args.collect)
+    finally:
+        db.close()
+    await fleet.start()
+    db = SessionLocal()
+    try:
+        db.execute(update(account_sync.Server).values(port=fleet.port))
+        db.commit()
+    finally:
+        db.close()
+
+    # Fresh engine state for every fleet size, with the limits of account_sync
+    account_sync.scheduler = SyncScheduler(
+        max_running=args.concurrency or account_sync.scheduler.max_running,
+        max_per_server=account_sync.scheduler.max_per_server,
+        max_per_proxy=account_sync.scheduler.max_per_proxy,
+        max_queued=max(account_sync.scheduler.max_queued, hosts),
+    )
+    account_sync.pool = ConnectionPool(max_per_server=account_sync.pool.max_per_server,
+                                       idle_timeout=account_sync.pool.idle_timeout,
+                                       keepalive_interval=account_sync.pool.keepalive_interval)
+    account_sync.health = HealthTracker(base_backoff=account_sync.health.base_backoff,
+                                        max_backoff=account_sync.health.max_backoff,
+                                        failure_threshold=account_sync.health.failure_threshold)
+    account_sync.reconcile_with_script = not args.legacy
+    bindLoop(asyncio.get_running_loop())
+    account_sync.loop_monitor.start()
+    account_sync.startEngine()
+
+    results = []
+    try:
+        for run in range(args.passes):
+            if run:
+                db = SessionLocal()
+                try:
+                    account_ids = db.execute(update(Account).values(status=AccountStatus.DIRTY).returning(Account.id)).scalars().all()
+                    db.commit()
+                finally:
+                    db.close()
+                # Every pass starts from a clean slate: no backoff of the failed servers and jobs
+                account_sync.health = HealthTracker(base_backoff=account_sync.health.base_backoff,
+                                                    max_backoff=account_sync.health.max_backoff,
+                                                    failure_threshold=account_sync.health.failure_threshold)
+                notifySync(account_ids)
+            result = {"hosts": hosts, "pass": run + 1}
+            result.update(await runPass(server_ids, args.timeout))
+            result["loop_lag_max"] = round(account_sync.loop_monitor.max_lag, 3)
+            result["fleet"] = fleet.stats()
+            results.append(result)
+            report(result, args.json)
+    finally:
+        await account_sync.stopEngine()
+        account_sync.loop_monitor.stop()
+        await fleet.close()
+    return results
+
+COLUMNS = [
+    ("hosts", 6), ("pass", 4), ("accounts", 8), ("seconds", 8), ("accounts_per_second", 10),
+    ("connections_opened", 8), ("connections_reused", 8), ("tunnels_opened", 7),
+    ("job_p50", 7), ("job_p95", 7), ("job_p99", 7), ("job_max", 7), ("done_p99", 8), ("loop_lag_max", 8),
+]
+HEADERS = {"accounts_per_second": "acc/s", "connections_opened": "opened", "connections_reused": "reused",
+           "tunnels_opened": "tunnels", "loop_lag_max": "lag_max"}
+
+def report(result: dict, as_json: bool):
+    if as_json:
+        print(json.dumps(result), flush=True)
+        return
+    line = " ".join(str(result[name]).rjust(width) for name, width in COLUMNS)
+    if result["timed_out"]:
+        line += f"  TIMEOUT {result['servers_done']}/{result['hosts']} servers"
+    print(line, flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark watchAccountSync against a fake SSH fleet")
+    parser.add_argument("--hosts", type=int, nargs="+", default=[10, 100, 500, 2000], help="Fleet sizes to run")
+    parser.add_argument("--accounts", type=int, default=10, help="Accounts per host")
+    parser.add_argument("--passes", type=int, default=2, help="Runs per fleet size, the later ones resync an already reconciled fleet")
+    parser.add_argument("--latency", type=float, default=0.01, help="Seconds added to every command")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many seconds added to every command at random")
+    parser.add_argument("--connect-latency", type=float, default=0.0, help="Seconds added to every handshake")
+    parser.add_argument("--hop-latency", type=float, default=0.0, help="Seconds added to every channel opened by a jump host")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of the commands (and reconciled accounts) that fail")
+    parser.add_argument("--down-rate", type=float, default=0.0, help="Fraction of the hosts that drop every connection")
+    parser.add_argument("--proxy-hops", type=int, default=0, help="Jump hosts in front of every host")
+    parser.add_argument("--proxy-fanout", type=int, default=50, help="Hosts behind one chain of jump hosts")
+    parser.add_argument("--concurrency", type=int, default=0, help="Jobs running at once (default: account_sync.concurrent_tasks)")
+    parser.add_argument("--legacy", action="store_true", help="Sync with the sshAccount* helpers instead of the reconcile script")
+    parser.add_argument("--collect", action="store_true", help="Run the inventory collections alongside the account jobs")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds before a pass is given up")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the injected latency and failures")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per pass")
+    parser.add_argument("--verbose", action="store_true", help="Keep the INFO logs of the engine")
+    args = parser.parse_args()
+
+    if not os.getenv("DATABASE_URL"):
+        path = os.path.join(tempfile.mkdtemp(prefix="n2sys-bench-"), "bench.db")
+        os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    from logger import logger
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+
+    if not args.json:
+        print(" ".join(HEADERS.get(name, name).rjust(width) for name, width in COLUMNS), flush=True)
+    async def run():
+        for hosts in args.hosts:
+            await benchFleet(args, hosts)
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    sys.exit(main())
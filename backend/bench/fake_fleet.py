@@ -0,0 +1,392 @@
+"""
+Fake fleet of SSH servers for the sync engine benchmarks.
+
+Every FakeHost keeps its passwd, sudo group and authorized_keys in memory and answers the commands
+of account_helpers.py and server_helpers.py like a real server: the reconcile script fed to
+`sudo bash -s` is interpreted in Python with the same end state and the same result lines, which
+tests/test_fake_fleet.py checks against the real script run under bash.
+One port serves the whole fleet, each host listens on its own loopback address (127.x.y.z) and is
+recognized by the address it was reached at, so the servers of the database only differ by host.
+Jump hosts forward direct-tcpip channels, so proxy chains are exercised like in production.
+
+    fleet = FakeFleet(latency=0.02, failure_rate=0.01)
+    hosts = [fleet.addHost() for _ in range(100)]
+    await fleet.start()
+    ...
+    await fleet.close()
+"""
+import asyncio
+import base64
+import datetime
+import hashlib
+import random
+import re
+import shlex
+from collections import Counter
+
+import asyncssh
+
+from server_helpers import INVENTORY_FINGERPRINT_CMD, LOGIN_RECORDS_CMD, NIC_DUMP_CMD, RELEASE_CMD
+
+class FakeHost:
+    """
+    In-memory state of one server: passwd entries, members of the sudo group and files (with owner and mode).
+    """
+    def __init__(self, address: str, kernel: str = "5.15.0-105-generic", release: str = "Ubuntu 22.04.4 LTS"):
+        self.address = address
+        self.kernel = kernel
+        self.release = release
+        self.passwd: dict[str, str] = {"root": "root:x:0:0:root:/root:/bin/bash"}
+        self.sudoers: list[str] = []
+        self.files: dict[str, str] = {}
+        self.stats: dict[str, str] = {}
+        self.lspci = (
+            "0000:3b:00.0 Ethernet controller: Intel Corporation Ethernet Controller X710 for 10GbE SFP+ (rev 02)\n"
+            "0000:3b:00.1 Ethernet controller: Intel Corporation Ethernet Controller X710 for 10GbE SFP+ (rev 02)\n"
+            "0000:5e:00.0 Infiniband controller: Mellanox Technologies MT28908 Family [ConnectX-6]\n"
+        )
+        self.net_devices = {"eno1": "0000:3b:00.0", "eno2": "0000:3b:00.1", "ibp94s0": "0000:5e:00.0", "lo": ""}
+        # Lines of `last -F -R -w`
+        self.logins: list[str] = []
+        # Behaviour, overrides the defaults of the fleet when set
+        self.down = False
+        self.latency: float | None = None
+        self.failure_rate: float | None = None
+        self.connections = 0
+        self.commands: Counter = Counter()
+
+    def addUser(self, name: str, shell: str = "/bin/sh"):
+        uid = 1000 + len(self.passwd)
+        self.passwd[name] = f"{name}:x:{uid}:{uid}::/home/{name}:{shell}"
+
+    def shell(self, name: str) -> str:
+        return self.passwd[name].rsplit(":", 1)[1]
+
+    def setShell(self, name: str, shell: str):
+        self.passwd[name] = self.passwd[name].rsplit(":", 1)[0] + ":" + shell
+
+    def groups(self, name: str) -> str:
+        return name + (" sudo" if name in self.sudoers else "")
+
+    def nicDump(self) -> str:
+        net = "".join(f"{interface} {f'../../../{pci}' if pci else ''}\n" for interface, pci in self.net_devices.items())
+        return self.lspci + "#N2SYS#\n" + net
+
+    def inventoryFingerprint(self) -> str:
+        inventory = f"{self.kernel}\nDISTRIB_DESCRIPTION=\"{self.release}\"\n{self.nicDump()}"
+        return hashlib.sha256(inventory.encode()).hexdigest()
+
+    def accountFingerprint(self, name: str, login: str, sudo: str, keys_b64: str) -> str:
+        """
+        Hash of the desired state and of what the reconcile looks at, like fingerprint() of the script.
+        """
+        keys_path = f"/home/{name}/.ssh/authorized_keys"
+        parts = [login, sudo, keys_b64, self.passwd.get(name, ""),
+                 self.groups(name) if name in self.passwd else "",
+                 self.files.get(keys_path, ""), "#", self.stats.get(keys_path, ""),
+                 "backup" if keys_path + ".n2sysbackup" in self.files else ""]
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def reconcile(self, name: str, login: str, sudo: str, keys_b64: str, expected: str, fail: bool) -> tuple[str, list[str], str]:
+        """
+        Bring one account to its desired state like reconcile() of RECONCILE_SCRIPT.
+        Returns the status (ok or error), the changes and the error.
+        """
+        if expected == self.accountFingerprint(name, login, sudo, keys_b64):
+            return "ok", ["unchanged"], ""
+        changes = []
+        keys_path = f"/home/{name}/.ssh/authorized_keys"
+        backup_path = keys_path + ".n2sysbackup"
+        if name not in self.passwd:
+            self.addUser(name)
+            changes.append("created")
+        if fail:
+            return "error", changes, "usermod: cannot lock /etc/passwd; try again later."
+        if login != "1":
+            if keys_path in self.files:
+                self.files[backup_path] = self.files.pop(keys_path)
+                self.stats.pop(keys_path, None)
+                changes.append("disabled")
+            return "ok", changes, ""
+        old = self.files.get(keys_path, self.files.get(backup_path, ""))
+        # The old lines are all kept, the new keys are added once, blank lines are dropped
+        merged = old.split("\n")
+        for key in base64.b64decode(keys_b64).decode().split("\n"):
+            if key not in merged:
+                merged.append(key)
+        merged = "\n".join(key for key in merged if key.strip())
+        if self.files.get(keys_path) != merged:
+            self.files[keys_path] = merged
+            changes.append("keys")
+        self.stats[keys_path] = f"{name} 600"
+        if self.shell(name) in ("/bin/false", "/usr/sbin/nologin"):
+            self.setShell(name, "/bin/bash")
+            changes.append("shell")
+        if name in self.sudoers and sudo != "1":
+            self.sudoers.remove(name)
+            changes.append("unsudo")
+        elif name not in self.sudoers and sudo == "1":
+            self.sudoers.append(name)
+            changes.append("sudo")
+        return "ok", changes, ""
+
+class FakeFleet:
+    """
+    The fake hosts and the SSH listener serving them.
+    `latency` (plus up to `jitter`) delays every command, `connect_latency` every handshake and
+    `hop_latency` every channel forwarded by a jump host. `failure_rate` makes commands (and single
+    accounts of a reconcile) fail, `down_rate` marks hosts that drop every connection.
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, connect_latency: float = 0.0,
+                 hop_latency: float = 0.0, failure_rate: float = 0.0, down_rate: float = 0.0, seed: int | None = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.connect_latency = connect_latency
+        self.hop_latency = hop_latency
+        self.failure_rate = failure_rate
+        self.down_rate = down_rate
+        self.random = random.Random(seed)
+        self.hosts: dict[str, FakeHost] = {}
+        self.port = 0
+        self.forwarded = 0
+        self._servers: list[asyncssh.SSHAcceptor] = []
+
+    def addHost(self, **kwargs) -> FakeHost:
+        i = len(self.hosts)
+        address = f"127.{1 + i // 62500}.{i // 250 % 250 + 1}.{i % 250 + 1}"
+        host = FakeHost(address, **kwargs)
+        host.down = self.random.random() < self.down_rate
+        self.hosts[address] = host
+        return host
+
+    async def start(self, port: int = 0):
+        """
+        Listen on the address of every host, on one port.
+        """
+        key = asyncssh.generate_private_key("ssh-ed25519")
+        addresses = list(self.hosts)
+        options = {"server_host_keys": [key], "process_factory": self._handle, "keepalive_interval": 0}
+        first = await asyncssh.create_server(lambda: FakeSSHServer(self), addresses[0], port, **options)
+        self._servers.append(first)
+        self.port = first.sockets[0].getsockname()[1]
+        for i in range(1, len(addresses), 500):
+            self._servers.append(await asyncssh.create_server(
+                lambda: FakeSSHServer(self), addresses[i:i + 500], self.port, **options))
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers.clear()
+
+    def stats(self) -> dict:
+        commands = Counter()
+        for host in self.hosts.values():
+            commands.update(host.commands)
+        return {
+            "hosts": len(self.hosts),
+            "down": sum(host.down for host in self.hosts.values()),
+            "connections": sum(host.connections for host in self.hosts.values()),
+            "forwarded": self.forwarded,
+            "commands": dict(commands),
+        }
+
+    def _latency(self, host: FakeHost) -> float:
+        latency = self.latency if host.latency is None else host.latency
+        return latency + self.random.uniform(0, self.jitter)
+
+    def _fails(self, host: FakeHost) -> bool:
+        failure_rate = self.failure_rate if host.failure_rate is None else host.failure_rate
+        return failure_rate > 0 and self.random.random() < failure_rate
+
+    async def _handle(self, proc: asyncssh.SSHServerProcess):
+        host = self.hosts[proc.get_extra_info("sockname")[0]]
+        stdin = ""
+        if proc.command == "sudo bash -s":
+            stdin = await proc.stdin.read()
+        await asyncio.sleep(self._latency(host))
+        try:
+            exit_status, stdout, stderr = self.run(host, proc.command or "", stdin)
+        except Exception as e:
+            exit_status, stdout, stderr = 1, "", f"fake_fleet: {e}\n"
+        proc.stdout.write(stdout)
+        proc.stderr.write(stderr)
+        proc.exit(exit_status)
+
+    def run(self, host: FakeHost, command: str, stdin: str = "") -> tuple[int, str, str]:
+        """
+        Run one command on the host, returns (exit status, stdout, stderr).
+        """
+        for pattern, handler in COMMANDS:
+            match = pattern.fullmatch(command)
+            if match:
+                host.commands[handler.__name__] += 1
+                if handler is not _reconcile and self._fails(host):
+                    return 1, "", "Injected failure\n"
+                return handler(self, host, stdin, *match.groups())
+        host.commands["unknown"] += 1
+        return 127, "", f"bash: {command.split(' ', 1)[0]}: command not found\n"
+
+class FakeSSHServer(asyncssh.SSHServer):
+    def __init__(self, fleet: FakeFleet):
+        self.fleet = fleet
+        self.conn = None
+        self.host = None
+
+    def connection_made(self, conn: asyncssh.SSHServerConnection):
+        self.conn = conn
+        self.host = self.fleet.hosts.get(conn.get_extra_info("sockname")[0])
+        if self.host is None or self.host.down:
+            conn.close()
+            return
+        self.host.connections += 1
+
+    async def begin_auth(self, username: str) -> bool:
+        # Every client is let in, the delay stands for the key exchange and the authentication
+        await asyncio.sleep(self.fleet.connect_latency)
+        return False
+
+    def connection_requested(self, dest_host: str, dest_port: int, orig_host: str, orig_port: int):
+        self.fleet.forwarded += 1
+        async def forward():
+            await asyncio.sleep(self.fleet.hop_latency)
+            return await self.conn.forward_connection(dest_host, dest_port)
+        return forward()
+
+# Handlers of the commands, called with the fleet, the host, stdin and the groups of their pattern
+
+def _reconcile(fleet: FakeFleet, host: FakeHost, stdin: str) -> tuple[int, str, str]:
+    def b64(value: str) -> str:
+        return base64.b64encode(value.encode()).decode()
+    out = []
+    for line in stdin.splitlines():
+        parts = line.split(" ")
+        if len(parts) != 6 or parts[0] != "reconcile":
+            continue
+        name = base64.b64decode(parts[1]).decode()
+        state, changes, error = host.reconcile(name, parts[2], parts[3], parts[4], parts[5], fleet._fails(host))
+        fingerprint = host.accountFingerprint(name, parts[2], parts[3], parts[4]) if state == "ok" else "-"
+        out.append(f"RESULT {b64(name)} {state} {','.join(changes) or '-'} {b64(error)} {fingerprint}\n")
+    return 0, "".join(out), ""
+
+def _snapshot(fleet: FakeFleet, host: FakeHost, stdin: str, names: str) -> tuple[int, str, str]:
+    out = "".join(entry + "\n" for entry in host.passwd.values()) + "#N2SYS#\n"
+    out += ",".join(host.sudoers) + "\n#N2SYS#\n"
+    for name in shlex.split(names):
+        keys_path = f"/home/{name}/.ssh/authorized_keys"
+        if keys_path in host.files:
+            out += f"{name} keys {base64.b64encode(host.files[keys_path].encode()).decode()}\n"
+        elif keys_path + ".n2sysbackup" in host.files:
+            out += f"{name} backup {base64.b64encode(host.files[keys_path + '.n2sysbackup'].encode()).decode()}\n"
+        else:
+            out += f"{name} none\n"
+    return 0, out, ""
+
+def _getentPasswd(fleet: FakeFleet, host: FakeHost, stdin: str, name: str) -> tuple[int, str, str]:
+    if name not in host.passwd:
+        return 2, "", ""
+    return 0, host.passwd[name] + "\n", ""
+
+def _useradd(fleet: FakeFleet, host: FakeHost, stdin: str, name: str) -> tuple[int, str, str]:
+    if name in host.passwd:
+        return 9, "", f"useradd: user '{name}' already exists\n"
+    host.addUser(name)
+    return 0, "", ""
+
+def _chpasswd(fleet: FakeFleet, host: FakeHost, stdin: str, name: str) -> tuple[int, str, str]:
+    if name not in host.passwd:
+        return 1, "", f"chpasswd: line 1: user '{name}' does not exist\n"
+    return 0, "", ""
+
+def _cat(fleet: FakeFleet, host: FakeHost, stdin: str, path: str) -> tuple[int, str, str]:
+    if path not in host.files:
+        return 1, "", f"cat: {path}: No such file or directory\n"
+    return 0, host.files[path] + "\n", ""
+
+def _mkdir(fleet: FakeFleet, host: FakeHost, stdin: str, path: str) -> tuple[int, str, str]:
+    return 0, "", ""
+
+def _tee(fleet: FakeFleet, host: FakeHost, stdin: str, content: str, path: str) -> tuple[int, str, str]:
+    host.files[path] = content
+    host.stats.setdefault(path, "root 644")
+    return 0, content + "\n", ""
+
+def _chown(fleet: FakeFleet, host: FakeHost, stdin: str, owner: str, path: str) -> tuple[int, str, str]:
+    if path not in host.files:
+        return 1, "", f"chown: cannot access '{path}': No such file or directory\n"
+    host.stats[path] = owner + " " + host.stats.get(path, "root 644").split(" ")[1]
+    return 0, "", ""
+
+def _chmod(fleet: FakeFleet, host: FakeHost, stdin: str, mode: str, path: str) -> tuple[int, str, str]:
+    if path not in host.files:
+        return 1, "", f"chmod: cannot access '{path}': No such file or directory\n"
+    host.stats[path] = host.stats.get(path, "root 644").split(" ")[0] + " " + mode
+    return 0, "", ""
+
+def _mv(fleet: FakeFleet, host: FakeHost, stdin: str, source: str, target: str) -> tuple[int, str, str]:
+    if source not in host.files:
+        return 1, "", f"mv: cannot stat '{source}': No such file or directory\n"
+    host.files[target] = host.files.pop(source)
+    host.stats.pop(source, None)
+    return 0, "", ""
+
+def _usermodShell(fleet: FakeFleet, host: FakeHost, stdin: str, shell: str, name: str) -> tuple[int, str, str]:
+    if name not in host.passwd:
+        return 6, "", f"usermod: user '{name}' does not exist\n"
+    host.setShell(name, shell)
+    return 0, "", ""
+
+def _sudo(fleet: FakeFleet, host: FakeHost, stdin: str, name: str) -> tuple[int, str, str]:
+    if name not in host.passwd:
+        return 6, "", f"usermod: user '{name}' does not exist\n"
+    if name not in host.sudoers:
+        host.sudoers.append(name)
+    return 0, "", ""
+
+def _unsudo(fleet: FakeFleet, host: FakeHost, stdin: str, name: str) -> tuple[int, str, str]:
+    if name not in host.sudoers:
+        return 3, "", f"gpasswd: user '{name}' is not a member of 'sudo'\n"
+    host.sudoers.remove(name)
+    return 0, f"Removing user {name} from group sudo\n", ""
+
+def _sudoMembers(fleet: FakeFleet, host: FakeHost, stdin: str) -> tuple[int, str, str]:
+    return 0, ",".join(host.sudoers) + "\n", ""
+
+def _kernel(fleet: FakeFleet, host: FakeHost, stdin: str) -> tuple[int, str, str]:
+    return 0, host.kernel + "\n", ""
+
+def _release(fleet: FakeFleet, host: FakeHost, stdin: str) -> tuple[int, str, str]:
+    return 0, f"DISTRIB_DESCRIPTION=\"{host.release}\"\n", ""
+
+def _nicDump(fleet: FakeFleet, host: FakeHost, stdin: str) -> tuple[int, str, str]:
+    return 0, host.nicDump(), ""
+
+def _inventoryFingerprint(fleet: FakeFleet, host: FakeHost, stdin: str) -> tuple[int, str, str]:
+    return 0, host.inventoryFingerprint() + "\n", ""
+
+def _loginRecords(fleet: FakeFleet, host: FakeHost, stdin: str) -> tuple[int, str, str]:
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return 0, now + "\n" + "".join(line + "\n" for line in host.logins) + "\nwtmp begins\n", ""
+
+COMMANDS = [(re.compile(pattern, re.DOTALL), handler) for pattern, handler in (
+    (r"sudo bash -s", _reconcile),
+    (r"getent passwd; echo '#N2SYS#'; .*for a in (.*?); do .*", _snapshot),
+    (r"(?:sudo )?getent passwd (\S+)", _getentPasswd),
+    (r"sudo useradd (\S+) -m -d \S+", _useradd),
+    (r"echo \"(\S+):\S*\" \| sudo chpasswd.*", _chpasswd),
+    (r"sudo cat (\S+)", _cat),
+    (r"sudo mkdir -p (\S+)", _mkdir),
+    (r"echo \"(.*)\" \| sudo tee (\S+)", _tee),
+    (r"sudo chown (\S+):\S+ (\S+)", _chown),
+    (r"sudo chmod (\d+) (\S+)", _chmod),
+    (r"sudo mv (\S+) (\S+)", _mv),
+    (r"sudo usermod -s (\S+) (\S+)", _usermodShell),
+    (r"sudo usermod -aG sudo (\S+)", _sudo),
+    (r"sudo gpasswd -d (\S+) sudo", _unsudo),
+    (r"sudo getent group sudo \| cut -d: -f4", _sudoMembers),
+    (r"uname -r", _kernel),
+    (re.escape(INVENTORY_FINGERPRINT_CMD), _inventoryFingerprint),
+    (re.escape(RELEASE_CMD), _release),
+    (re.escape(NIC_DUMP_CMD), _nicDump),
+    (re.escape(LOGIN_RECORDS_CMD), _loginRecords),
+)]
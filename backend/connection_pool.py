@@ -0,0 +1,234 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Hashable
+
+import asyncssh
+from logger import logger
+
+# Errors after which a connection can not be handed out again
+BROKEN_CONNECTION_ERRORS = (
+    asyncssh.DisconnectError,
+    asyncssh.ConnectionLost,
+    asyncssh.ChannelOpenError,
+    ConnectionError,
+    BrokenPipeError,
+)
+
+class PooledConnection:
+    def __init__(self, server_id: int, target: Hashable, conn: asyncssh.SSHClientConnection, via: tuple[int, ...] = ()):
+        self.server_id = server_id
+        self.target = target
+        self.conn = conn
+        # Ids of the tunnels (jump hosts) this connection goes through
+        self.via = via
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+    def isAlive(self) -> bool:
+        return not self.conn.is_closed()
+
+class ConnectionPool:
+    """
+    Pool of SSH connections keyed by server id.
+    A connection is leased to one user at a time and put back afterwards, so consecutive
+    operations on the same server share one handshake. At most `max_per_server` connections
+    are opened per server, idle connections are closed after `idle_timeout` seconds and
+    dead connections (keepalive failure, disconnect) are dropped and reopened on demand.
+    Jump hosts are kept as shared tunnels: one connection per proxy server multiplexes the
+    connections of every server behind it, and stays open as long as one of them is alive.
+    """
+    def __init__(self, max_per_server: int = 4, idle_timeout: float = 300,
+                 keepalive_interval: float = 30, keepalive_count_max: int = 3, reap_interval: float = 30):
+        self.max_per_server = max_per_server
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count_max = keepalive_count_max
+        self.reap_interval = reap_interval
+        self._idle: dict[int, list[PooledConnection]] = {}
+        self._opened: dict[int, int] = {}
+        self._conds: dict[int, asyncio.Condition] = {}
+        self._live: set[PooledConnection] = set()
+        self._tunnels: dict[int, PooledConnection] = {}
+        self._tunnel_locks: dict[int, asyncio.Lock] = {}
+        self._reaper = None
+        # Counters for observability
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.tunnels_opened = 0
+        self.tunnels_reused = 0
+
+    def _cond(self, server_id: int) -> asyncio.Condition:
+        if server_id not in self._conds:
+            self._conds[server_id] = asyncio.Condition()
+        return self._conds[server_id]
+
+    def _discard(self, entry: PooledConnection):
+        self._opened[entry.server_id] = self._opened.get(entry.server_id, 1) - 1
+        self._live.discard(entry)
+        entry.conn.close()
+
+    async def acquire(self, server_id: int, target: Hashable,
+                      connector: Callable[[], Awaitable[asyncssh.SSHClientConnection]],
+                      via: tuple[int, ...] = ()) -> PooledConnection:
+        """
+        Lease a live connection to the server, opening a new one if none is idle and the
+        per-server limit is not reached, otherwise wait until one is released.
+        `target` identifies the address the connection goes to, a connection opened for
+        another target (e.g. the host or proxy changed) is never reused.
+        """
+        cond = self._cond(server_id)
+        async with cond:
+            while True:
+                idle = self._idle.get(server_id, [])
+                while idle:
+                    entry = idle.pop()
+                    if entry.isAlive() and entry.target == target:
+                        entry.last_used = time.monotonic()
+                        self.connections_reused += 1
+                        return entry
+                    logger.info(f"Dropping stale connection to server {server_id}.")
+                    self._discard(entry)
+                if self._opened.get(server_id, 0) < self.max_per_server:
+                    self._opened[server_id] = self._opened.get(server_id, 0) + 1
+                    break
+                await cond.wait()
+        try:
+            conn = await connector()
+        except BaseException:
+            async with cond:
+                self._opened[server_id] -= 1
+                cond.notify()
+            raise
+        self.connections_opened += 1
+        entry = PooledConnection(server_id, target, conn, via)
+        self._live.add(entry)
+        return entry
+
+    async def release(self, entry: PooledConnection, broken: bool = False):
+        """
+        Give the connection back to the pool, a broken or closed connection is closed instead.
+        """
+        cond = self._cond(entry.server_id)
+        async with cond:
+            if broken or not entry.isAlive():
+                self._discard(entry)
+            else:
+                entry.last_used = time.monotonic()
+                self._idle.setdefault(entry.server_id, []).append(entry)
+            cond.notify()
+
+    @asynccontextmanager
+    async def connection(self, server_id: int, target: Hashable,
+                         connector: Callable[[], Awaitable[asyncssh.SSHClientConnection]],
+                         via: tuple[int, ...] = ()):
+        entry = await self.acquire(server_id, target, connector, via)
+        broken = False
+        try:
+            yield entry.conn
+        except BROKEN_CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            await self.release(entry, broken)
+
+    async def tunnel(self, server_id: int, target: Hashable,
+                     connector: Callable[[], Awaitable[asyncssh.SSHClientConnection]],
+                     via: tuple[int, ...] = ()) -> asyncssh.SSHClientConnection:
+        """
+        Get the shared tunnel connection to a jump host, opening it if it is missing or dead.
+        Unlike leased connections, a tunnel is used by many downstream connections at once.
+        """
+        if server_id not in self._tunnel_locks:
+            self._tunnel_locks[server_id] = asyncio.Lock()
+        async with self._tunnel_locks[server_id]:
+            entry = self._tunnels.get(server_id)
+            if entry is not None and entry.isAlive() and entry.target == target:
+                entry.last_used = time.monotonic()
+                self.tunnels_reused += 1
+                return entry.conn
+            if entry is not None:
+                logger.info(f"Dropping stale tunnel through server {server_id}.")
+                entry.conn.close()
+                del self._tunnels[server_id]
+            conn = await connector()
+            self._tunnels[server_id] = PooledConnection(server_id, target, conn, via)
+            self.tunnels_opened += 1
+            return conn
+
+    def _tunnelInUse(self, server_id: int) -> bool:
+        for entry in list(self._live) + list(self._tunnels.values()):
+            if server_id in entry.via and entry.isAlive():
+                return True
+        return False
+
+    async def reapIdle(self):
+        """
+        Close the connections that have been idle for longer than `idle_timeout` or died while idle.
+        """
+        now = time.monotonic()
+        for server_id in list(self._idle):
+            cond = self._cond(server_id)
+            async with cond:
+                keep = []
+                for entry in self._idle.get(server_id, []):
+                    if not entry.isAlive() or now - entry.last_used > self.idle_timeout:
+                        logger.info(f"Closing idle connection to server {server_id}.")
+                        self._discard(entry)
+                    else:
+                        keep.append(entry)
+                self._idle[server_id] = keep
+                cond.notify_all()
+        for server_id, entry in list(self._tunnels.items()):
+            if self._tunnelInUse(server_id):
+                entry.last_used = now
+            elif not entry.isAlive() or now - entry.last_used > self.idle_timeout:
+                logger.info(f"Closing idle tunnel through server {server_id}.")
+                entry.conn.close()
+                del self._tunnels[server_id]
+
+    async def _reapLoop(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.reapIdle()
+            except Exception as e:
+                logger.error(f"Error reaping idle connections: {e}")
+
+    def start(self):
+        if self._reaper is None:
+            self._reaper = asyncio.get_event_loop().create_task(self._reapLoop())
+
+    async def closeAll(self):
+        """
+        Close the idle connections, then the tunnels they went through, and wait until they are closed.
+        """
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        closing = []
+        for server_id in list(self._idle):
+            cond = self._cond(server_id)
+            async with cond:
+                for entry in self._idle.pop(server_id, []):
+                    self._discard(entry)
+                    closing.append(entry.conn)
+                cond.notify_all()
+        # The tunnels go last, the connections above still send their disconnect through them
+        await asyncio.gather(*(conn.wait_closed() for conn in closing), return_exceptions=True)
+        tunnels = [entry.conn for entry in self._tunnels.values()]
+        self._tunnels.clear()
+        for conn in tunnels:
+            conn.close()
+        await asyncio.gather(*(conn.wait_closed() for conn in tunnels), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "opened": dict(self._opened),
+            "idle": {server_id: len(entries) for server_id, entries in self._idle.items()},
+            "connections_opened": self.connections_opened,
+            "connections_reused": self.connections_reused,
+            "tunnels": sorted(self._tunnels),
+            "tunnels_opened": self.tunnels_opened,
+            "tunnels_reused": self.tunnels_reused,
+        }
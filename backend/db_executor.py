@@ -0,0 +1,34 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from app.database import SessionLocal
+
+T = TypeVar("T")
+
+# Threads running the database work of the sync engine.
+# SQLAlchemy sessions are blocking, a query or a SQLite lock wait run on the event loop would
+# stall every SSH connection and API request, so the coroutines of the engine never touch a
+# session directly: they hand a plain function to runDB and await its result.
+# The functions open and close their own session and only return detached objects or plain values.
+db_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sync-db")
+
+async def runDB(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run a blocking database function in the database executor and wait for its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(fn, *args, **kwargs))
+
+async def runInSession(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run `fn(db, *args)` in the database executor with a session of its own, closed afterwards.
+    """
+    def call():
+        db = SessionLocal()
+        try:
+            return fn(db, *args, **kwargs)
+        finally:
+            db.close()
+    return await runDB(call)
@@ -0,0 +1,52 @@
+import datetime
+from sqlalchemy import case, or_, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from app.database import EngineLease, dbNow
+
+def acquireLease(db: Session, name: str, holder: str, ttl: datetime.timedelta) -> bool:
+    """
+    Take or renew the lease, returns whether `holder` holds it now.
+    The lease is taken over only if it is free or expired; the check and the write are one
+    statement, so two processes can never both get it.
+    """
+    # Times come from the database clock, the workers' clocks may disagree
+    stmt = insert(EngineLease).values(name=name, holder=holder, expires_at=dbNow(ttl), acquired_at=dbNow())
+    held = db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[EngineLease.name],
+            set_={
+                "holder": holder,
+                "expires_at": dbNow(ttl),
+                "acquired_at": case((EngineLease.holder == holder, EngineLease.acquired_at), else_=dbNow()),
+            },
+            where=or_(EngineLease.holder == holder, EngineLease.expires_at < dbNow()),
+        ).returning(EngineLease.holder)
+    ).first()
+    db.commit()
+    return held is not None
+
+def releaseLease(db: Session, name: str, holder: str):
+    """
+    Give the lease up at once, so another process does not have to wait for it to expire.
+    """
+    db.execute(
+        update(EngineLease)
+        .where(EngineLease.name == name, EngineLease.holder == holder)
+        .values(holder="", expires_at=dbNow())
+    )
+    db.commit()
+
+def getLease(db: Session, name: str) -> dict | None:
+    row = db.query(EngineLease, EngineLease.expires_at < dbNow()).filter(EngineLease.name == name).first()
+    if not row:
+        return None
+    lease, expired = row
+    return {
+        "name": lease.name,
+        "holder": lease.holder,
+        "acquired_at": lease.acquired_at,
+        "expires_at": lease.expires_at,
+        "expired": bool(expired),
+    }
@@ -0,0 +1,56 @@
+import asyncio
+import time
+from collections import deque
+
+from logger import logger
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up a task that sleeps `interval` seconds.
+    The lag is the time the loop was busy running something else without yielding, e.g. a
+    blocking call in a coroutine. Lags above `warn_threshold` seconds are counted and logged.
+    """
+    def __init__(self, interval: float = 0.1, warn_threshold: float = 0.02, window: int = 3000):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self._lags: deque[float] = deque(maxlen=window)
+        self._task = None
+        self.samples = 0
+        self.max_lag = 0.0
+        self.slow_count = 0
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.samples += 1
+            self._lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.warn_threshold:
+                self.slow_count += 1
+                logger.warning(f"Event loop was blocked for {lag * 1000:.1f}ms.")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        lags = sorted(self._lags)
+        def percentile(p: float) -> float:
+            return lags[min(len(lags) - 1, int(len(lags) * p))] * 1000 if lags else 0.0
+        return {
+            "samples": self.samples,
+            "window": len(lags),
+            "avg_ms": sum(lags) / len(lags) * 1000 if lags else 0.0,
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+            "max_ms": self.max_lag * 1000,
+            "warn_threshold_ms": self.warn_threshold * 1000,
+            "slow_count": self.slow_count,
+        }
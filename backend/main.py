@@ -1,6 +1,6 @@
 from fastapi import FastAPI
 import uvicorn
-from app.database import engine, Base
+from app.database import migrateSchema
 from app.api.auth import router as auth_router
 from app.api.summary import router as summary_router
 from app.api.server import router as server_router
@@ -9,6 +9,11 @@ from app.api.application import router as app_router
 from app.api.switch import router as switch_router
 from app.api.account import router as account_router
 from app.api.link import router as link_router
+from app.api.sync import router as sync_router
+from app.api.ingest import router as ingest_router
+from app.api.metrics import router as metrics_router
+from app.api.search import router as search_router
+from metrics import MetricsMiddleware
 from logger import logger
 from contextlib import asynccontextmanager
 from account_sync import startWatcher, stopWatcher
@@ -16,7 +21,7 @@ from account_sync import startWatcher, stopWatcher
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # if there is no users in db, add a ADMIN db with username admin and password admin
-    from app.database import SessionLocal, User, UserStatus, Account, AccountStatus
+    from app.database import SessionLocal, User, UserStatus
     from app.api import auth
 
     db = SessionLocal()
@@ -35,19 +40,17 @@ async def lifespan(app: FastAPI):
         db.commit()
         db.refresh(admin)
         logger.info("No users found in the database. Added admin user with username 'admin' and password 'admin'.")
-    # Modify all accounts with status UPDATING to DIRTY
-    for account in db.query(Account).filter(Account.status == AccountStatus.UPDATING).all():
-        account.status = AccountStatus.DIRTY
-        db.commit()
-        logger.info(f"Updated account {account.id} status from UPDATING to DIRTY.")
+    db.close()
+    # Accounts left UPDATING by a crash are taken over by their sync job once its lease expires
     startWatcher()
     yield
     await stopWatcher()
 
 # Create database tables
-Base.metadata.create_all(bind=engine)
+migrateSchema()
 
 app = FastAPI(title="N2SysManager Backend", lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 
 # Include Routers
 app.include_router(auth_router, prefix="/auth", tags=["auth"])
@@ -58,6 +61,10 @@ app.include_router(server_router, prefix="/server", tags=["server"])
 app.include_router(switch_router, prefix="/switch", tags=["switch"])
 app.include_router(account_router, prefix="/account", tags=["account"])
 app.include_router(link_router, prefix="/link", tags=["link"])
+app.include_router(sync_router, prefix="/sync", tags=["sync"])
+app.include_router(ingest_router, prefix="/ingest", tags=["ingest"])
+app.include_router(metrics_router, prefix="/metrics", tags=["metrics"])
+app.include_router(search_router, prefix="/search", tags=["search"])
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="127.0.0.1", port=3876, reload=True)
\ No newline at end of file
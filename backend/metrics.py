@@ -0,0 +1,166 @@
+import contextvars
+import sys
+import time
+
+from prometheus_client import Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event, func
+
+from app.database import engine, SessionLocal, Account, AccountStatus, SyncJob, SyncJobKind, SyncJobState
+
+# Metrics exported on /metrics, see app/api/metrics.py
+
+SSH_CONNECT_SECONDS = Histogram(
+    "n2sys_ssh_connect_seconds", "Time to open an SSH connection (direct or through a tunnel)",
+    ["server"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 3, 6, 10),
+)
+SSH_COMMAND_SECONDS = Histogram(
+    "n2sys_ssh_command_seconds", "Time of a conn.run call, by the helper that issued it",
+    ["helper", "server"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+WATCHER_ROUTINE_SECONDS = Histogram(
+    "n2sys_watcher_routine_seconds", "Duration of the routines of a watcher tick",
+    ["routine"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "n2sys_http_request_seconds", "API request latency",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+HTTP_REQUEST_SQL_QUERIES = Histogram(
+    "n2sys_http_request_sql_queries", "SQL statements executed by an API request",
+    ["method", "route"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 250, 1000),
+)
+
+# Statement counter of the current request, the list is shared with the threads the request runs in
+_sql_queries: contextvars.ContextVar[list[int] | None] = contextvars.ContextVar("sql_queries", default=None)
+
+@event.listens_for(engine, "before_cursor_execute")
+def _countQuery(conn, cursor, statement, parameters, context, executemany):
+    counter = _sql_queries.get()
+    if counter is not None:
+        counter[0] += 1
+
+class MeteredConnection:
+    """
+    Wraps an SSH connection to time every conn.run, labelled with the calling helper and the server.
+    """
+    def __init__(self, conn, server: str):
+        self._conn = conn
+        self._server = server
+
+    async def run(self, *args, **kwargs):
+        helper = sys._getframe(1).f_code.co_name
+        start = time.perf_counter()
+        try:
+            return await self._conn.run(*args, **kwargs)
+        finally:
+            SSH_COMMAND_SECONDS.labels(helper, self._server).observe(time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+def routeTemplate(scope) -> str:
+    """
+    Path template of the matched route with the prefix of its router, e.g. /server/{server_id}.
+    """
+    route = scope.get("route")
+    if route is None or not hasattr(route, "path_regex"):
+        return "unmatched"
+    path = scope["path"]
+    # The route of an included router only knows its own path, find the prefix it was mounted at;
+    # a route declared as "" matches the empty rest of the path
+    for i in range(len(path) + 1):
+        if (i == len(path) or path[i] == "/") and route.path_regex.match(path[i:]):
+            return path[:i] + route.path
+    return route.path
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency and the SQL statement count of every API request by route.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        counter = [0]
+        token = _sql_queries.set(counter)
+        status_code = [500]
+        async def sendWithStatus(message):
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+            await send(message)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, sendWithStatus)
+        finally:
+            _sql_queries.reset(token)
+            # The route template, not the path, so ids do not create new series
+            route = routeTemplate(scope)
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route, str(status_code[0])).observe(time.perf_counter() - start)
+            HTTP_REQUEST_SQL_QUERIES.labels(scope["method"], route).observe(counter[0])
+
+class SyncEngineCollector:
+    """
+    Gauges read when /metrics is scraped: account states, the occupancy of the scheduler and the SSH pool,
+    and the hits of the principal cache.
+    """
+    def describe(self):
+        # Keeps the registry from calling collect() (and querying the database) on registration
+        return []
+
+    def collect(self):
+        import account_sync
+        from validator import principals
+
+        accounts = GaugeMetricFamily("n2sys_accounts", "Accounts by sync status", labels=["status"])
+        db = SessionLocal()
+        try:
+            counts = dict(db.query(Account.status, func.count(Account.id)).group_by(Account.status).all())
+            failing = (
+                db.query(func.count(Account.id))
+                  .join(SyncJob, (SyncJob.server_id == Account.server_id) & (SyncJob.kind == SyncJobKind.ACCOUNTS))
+                  .filter(Account.status == AccountStatus.DIRTY, SyncJob.state == SyncJobState.FAILED)
+                  .scalar()
+            )
+        finally:
+            db.close()
+        for account_status in AccountStatus:
+            accounts.add_metric([account_status.value], counts.get(account_status, 0))
+        # Dirty accounts whose last sync failed and wait for a retry
+        accounts.add_metric(["failing"], failing)
+        yield accounts
+
+        stats = account_sync.scheduler.stats()
+        yield GaugeMetricFamily("n2sys_scheduler_running", "Sync jobs running", value=stats["running"])
+        yield GaugeMetricFamily("n2sys_scheduler_max_running", "Limit of sync jobs running at once", value=stats["max_running"])
+        queued = GaugeMetricFamily("n2sys_scheduler_queued", "Sync jobs waiting for a slot", labels=["lane"])
+        oldest = GaugeMetricFamily("n2sys_scheduler_oldest_wait_seconds", "Wait of the oldest queued sync job", labels=["lane"])
+        for lane, lane_stats in stats["lanes"].items():
+            queued.add_metric([lane], lane_stats["queued"])
+            oldest.add_metric([lane], lane_stats["oldest_wait"])
+        yield queued
+        yield oldest
+
+        pool_stats = account_sync.pool.stats()
+        yield GaugeMetricFamily("n2sys_ssh_pool_open", "SSH connections open", value=sum(pool_stats["opened"].values()))
+        yield GaugeMetricFamily("n2sys_ssh_pool_idle", "SSH connections idle in the pool", value=sum(pool_stats["idle"].values()))
+        yield GaugeMetricFamily("n2sys_ssh_pool_tunnels", "Shared jump host tunnels open", value=len(pool_stats["tunnels"]))
+        yield GaugeMetricFamily("n2sys_event_loop_lag_max_seconds", "Largest event loop lag measured",
+                                value=account_sync.loop_monitor.max_lag)
+        yield GaugeMetricFamily("n2sys_sync_engine_leader", "Whether this worker runs the sync engine",
+                                value=1 if account_sync.start_watcher else 0)
+
+        principal_stats = principals.stats()
+        lookups = CounterMetricFamily("n2sys_principal_cache_lookups", "Users looked up in the principal cache of getUser", labels=["result"])
+        lookups.add_metric(["hit"], principal_stats["hits"])
+        lookups.add_metric(["miss"], principal_stats["misses"])
+        yield lookups
+        yield GaugeMetricFamily("n2sys_principal_cache_size", "Users held by the principal cache", value=principal_stats["size"])
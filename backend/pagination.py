@@ -0,0 +1,63 @@
+import base64
+import binascii
+import json
+from typing import Iterable, Optional
+from fastapi import HTTPException, status
+
+# Largest page a list endpoint returns at once
+max_page_size = 1000
+# Response header with the cursor of the next page, absent on the last page
+next_cursor_header = "X-Next-Cursor"
+
+def encodeCursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"id": last_id}).encode()).decode().rstrip("=")
+
+def decodeCursor(cursor: Optional[str]) -> Optional[int]:
+    """
+    Id of the last row of the previous page, None for the first page.
+    """
+    if not cursor:
+        return None
+    try:
+        last_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))["id"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor")
+    if not isinstance(last_id, int):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor")
+    return last_id
+
+def parseFields(fields: Optional[str], allowed: Iterable[str]) -> list[str]:
+    """
+    Fields of a `fields=a,b` projection in the order of `allowed`, all of them when none is asked.
+    """
+    allowed = list(allowed)
+    if not fields:
+        return allowed
+    asked = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = asked.difference(allowed)
+    if unknown:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"Unknown fields: {', '.join(sorted(unknown))}")
+    return [name for name in allowed if name in asked]
+
+def paginate(query, id_column, cursor: Optional[str], limit: Optional[int]):
+    """
+    Keyset pagination of a query on its id column: the rows after the cursor, in id order, and one
+    more than the page so trimPage() knows whether there is a next page. Without a limit every
+    remaining row is returned.
+    """
+    after = decodeCursor(cursor)
+    if after is not None:
+        query = query.filter(id_column > after)
+    query = query.order_by(id_column)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    return query
+
+def trimPage(rows: list, limit: Optional[int], key=lambda row: row.id) -> tuple[list, Optional[str]]:
+    """
+    Drop the extra row fetched by paginate(), returns the page and the cursor of the next one (or None).
+    """
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encodeCursor(key(rows[-1]))
@@ -0,0 +1,107 @@
+import time
+from enum import Enum
+
+class CircuitState(Enum):
+    CLOSED = 'closed' # Jobs are dispatched normally
+    OPEN = 'open' # The server is unreachable, nothing is dispatched until the backoff expires
+    HALF_OPEN = 'half_open' # One probe job is running to find out if the server is back
+
+class ServerHealth:
+    def __init__(self):
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_error = ""
+
+class HealthTracker:
+    """
+    Per-server health with exponential backoff and a circuit breaker.
+    Every connection failure delays the next attempt by base_backoff * 2^(failures - 1), capped at
+    max_backoff. After `failure_threshold` consecutive failures the circuit opens; once the backoff
+    expires a single probe is let through (half-open), a success closes the circuit again.
+    """
+    def __init__(self, base_backoff: float = 15, max_backoff: float = 1800, failure_threshold: int = 3):
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self._servers: dict[int, ServerHealth] = {}
+
+    def _get(self, server_id: int) -> ServerHealth:
+        if server_id not in self._servers:
+            self._servers[server_id] = ServerHealth()
+        return self._servers[server_id]
+
+    def allow(self, server_id: int) -> bool:
+        """
+        Whether a job may be dispatched to the server now, claims the probe of a half-open circuit.
+        """
+        health = self._get(server_id)
+        if time.monotonic() < health.retry_at:
+            return False
+        if health.state == CircuitState.HALF_OPEN:
+            return False
+        if health.state == CircuitState.OPEN:
+            health.state = CircuitState.HALF_OPEN
+        return True
+
+    def cancelProbe(self, server_id: int):
+        """
+        Give back the probe claimed by allow() when no job was started after all.
+        """
+        health = self._get(server_id)
+        if health.state == CircuitState.HALF_OPEN:
+            health.state = CircuitState.OPEN
+
+    def recordSuccess(self, server_id: int) -> bool:
+        """
+        Reset the server health, returns True if this closed an open circuit.
+        """
+        health = self._get(server_id)
+        reopened = health.state != CircuitState.CLOSED
+        health.state = CircuitState.CLOSED
+        health.failures = 0
+        health.retry_at = 0.0
+        health.last_error = ""
+        return reopened
+
+    def recordFailure(self, server_id: int, error: str) -> bool:
+        """
+        Count a connection failure and back off, returns True if this opened the circuit.
+        """
+        health = self._get(server_id)
+        health.failures += 1
+        health.last_error = error
+        health.retry_at = time.monotonic() + self.retryDelay(server_id)
+        if health.state == CircuitState.CLOSED and health.failures < self.failure_threshold:
+            return False
+        opened = health.state == CircuitState.CLOSED
+        health.state = CircuitState.OPEN
+        return opened
+
+    def retryIn(self, server_id: int) -> float:
+        """
+        Seconds until the server may be tried again, 0 if it may be tried now.
+        """
+        return max(0.0, self._get(server_id).retry_at - time.monotonic())
+
+    def isProbing(self, server_id: int) -> bool:
+        return self._get(server_id).state == CircuitState.HALF_OPEN
+
+    def retryDelay(self, server_id: int) -> float:
+        failures = self._get(server_id).failures
+        if failures == 0:
+            return 0.0
+        return min(self.base_backoff * 2 ** (failures - 1), self.max_backoff)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            server_id: {
+                "state": health.state.value,
+                "failures": health.failures,
+                "retry_in": max(0.0, health.retry_at - now),
+                "last_error": health.last_error,
+            }
+            for server_id, health in self._servers.items()
+            if health.state != CircuitState.CLOSED or health.failures > 0
+        }
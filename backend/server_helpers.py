@@ -1,4 +1,5 @@
 import asyncssh
+import datetime
 from logger import logger
 
 async def sshServerGetKernel(conn: asyncssh.SSHClientConnection) -> str:
@@ -11,97 +12,144 @@ async def sshServerGetKernel(conn: asyncssh.SSHClientConnection) -> str:
         return ""
     return result.stdout.strip()
 
+RELEASE_CMD = "cat /etc/*release | grep -i DISTRIB_DESCRIPTION"
+
+def parseRelease(output: str) -> str:
+    """
+    Make the DISTRIB_DESCRIPTION line a one line string and shorten it.
+    """
+    if "=" not in output:
+        return ""
+    return str(output.strip().split("=")[1].strip().replace('"', ""))
+
 async def sshServerGetRelease(conn: asyncssh.SSHClientConnection) -> str:
     """
     Get the release version of the server.
     Make it a one line string and shorten it.
     """
-    result = await conn.run("cat /etc/*release | grep -i DISTRIB_DESCRIPTION", timeout=3)
+    result = await conn.run(RELEASE_CMD, timeout=3)
     if result.exit_status != 0:
         err_result = result.stderr.strip()
         return ""
-    release = str(result.stdout.strip().split("=")[1].strip().replace('"', ""))
-    return release
+    return parseRelease(result.stdout)
 
-async def sshServerGetIBNICs(conn: asyncssh.SSHClientConnection) -> list[dict]:
+def parseNICs(lspci: str, net_devices: str) -> tuple[list[dict], list[dict]]:
     """
-    Get the infiniband controllers of the server from PCI.
-    If it has corresponding interfaces, add them to the dictionary.
+    Parse the output of `lspci -D` and the `<interface> <device link>` lines of /sys/class/net
+    into the ethernet controllers and the infiniband controllers of the server.
+    If a controller has a corresponding interface, it is added to the dictionary.
     """
-    result = await conn.run("lspci -D | grep -i infiniband", timeout=3)
-    if result.exit_status != 0:
-        err_result = result.stderr.strip()
-        return []
     nics = []
-    for line in result.stdout.splitlines():
+    ib_nics = []
+    for line in lspci.splitlines():
         parts = line.split()
         if len(parts) < 2:
             continue
         pci_address = parts[0]
         nic_name = " ".join(parts[1:])
-        nics.append({"pci_address": pci_address, "nic_name": nic_name, "interface_name": None})
-    # Iterate all interfaces under /sys/class/net
-    result = await conn.run("ls /sys/class/net", timeout=3)
-    if result.exit_status != 0:
-        err_result = result.stderr.strip()
-        return nics
-    interfaces = result.stdout.splitlines()
-    for interface in interfaces:
-        # Get the PCI address of the interface
-        result = await conn.run(f"readlink /sys/class/net/{interface}/device", timeout=3)
-        if result.exit_status != 0:
+        if "ethernet" in line.lower():
+            nics.append({"pci_address": pci_address, "nic_name": nic_name, "interface_name": None})
+        if "infiniband" in line.lower():
+            ib_nics.append({"pci_address": pci_address, "nic_name": nic_name, "interface_name": None})
+    for line in net_devices.splitlines():
+        parts = line.split(" ", 1)
+        if len(parts) < 2 or not parts[1].strip():
             continue
-        pci_address = result.stdout.strip().split("/")[-1]
+        interface = parts[0]
+        # The device link ends with the PCI address of the interface
+        pci_address = parts[1].strip().split("/")[-1]
         # Find the corresponding NIC
-        for nic in nics:
+        for nic in nics + ib_nics:
             if nic["pci_address"] == pci_address:
                 nic["interface_name"] = interface
-                break
-    return nics
+    return nics, ib_nics
 
-async def sshServerGetNICs(conn: asyncssh.SSHClientConnection) -> list[dict]:
+# lspci output and the device link of every interface under /sys/class/net, separated by a marker line
+NIC_DUMP_CMD = "lspci -D; echo '#N2SYS#'; for i in /sys/class/net/*; do echo \"${i##*/} $(readlink \"$i/device\")\"; done"
+
+def parseNICDump(output: str) -> tuple[list[dict], list[dict]] | None:
+    """
+    Parse the output of NIC_DUMP_CMD, None if it is incomplete or lspci listed nothing (not
+    installed or failed, a server always has PCI devices).
+    """
+    if "#N2SYS#" not in output:
+        return None
+    lspci, net_devices = output.split("#N2SYS#", 1)
+    if not lspci.strip():
+        return None
+    return parseNICs(lspci, net_devices)
+
+# Everything the kernel, release and NIC collection reads, hashed on the server
+INVENTORY_FINGERPRINT_CMD = "{ uname -r; cat /etc/*release; " + NIC_DUMP_CMD + "; } 2>/dev/null | sha256sum | cut -d' ' -f1"
+
+async def sshServerGetFingerprint(conn: asyncssh.SSHClientConnection) -> str:
     """
-    Get the ethernet controllers and infiniband controllers of the server from PCI.
-    If it has corresponding interfaces, add them to the dictionary.
+    Get the fingerprint of the inventory of the server, empty if it can not be computed.
     """
-    result = await conn.run("lspci -D | grep -i ethernet", timeout=3)
+    result = await conn.run(INVENTORY_FINGERPRINT_CMD, timeout=6)
     if result.exit_status != 0:
         err_result = result.stderr.strip()
-        return []
-    nics = []
-    for line in result.stdout.splitlines():
+        return ""
+    return result.stdout.strip()
+
+async def sshServerGetAllNICs(conn: asyncssh.SSHClientConnection) -> tuple[list[dict] | None, list[dict] | None]:
+    """
+    Get the ethernet controllers and the infiniband controllers of the server with a single command,
+    (None, None) if they could not be read.
+    """
+    result = await conn.run(NIC_DUMP_CMD, timeout=6)
+    parsed = parseNICDump(result.stdout)
+    if parsed is None:
+        err_result = result.stderr.strip()
+        logger.error(f"Error collecting NICs: {err_result}")
+        return None, None
+    return parsed
+
+def parseLoginDates(last: str, now: datetime.datetime) -> dict[str, datetime.datetime]:
+    """
+    Parse the output of `last -F -R -w` into the latest login date of every user.
+    A session counts at its logout time, or `now` (the server time) if the user is still logged in.
+    Sessions ended by a crash or a shutdown count at their login time.
+    """
+    dates = {}
+    for line in last.splitlines():
         parts = line.split()
-        if len(parts) < 2:
+        if len(parts) < 7:
             continue
-        pci_address = parts[0]
-        nic_name = " ".join(parts[1:])
-        nics.append({"pci_address": pci_address, "nic_name": nic_name, "interface_name": None})
-    # Iterate all interfaces under /sys/class/net
-    result = await conn.run("ls /sys/class/net", timeout=3)
-    if result.exit_status != 0:
-        err_result = result.stderr.strip()
-        return nics
-    interfaces = result.stdout.splitlines()
-    for interface in interfaces:
-        # Get the PCI address of the interface
-        result = await conn.run(f"readlink /sys/class/net/{interface}/device", timeout=3)
-        if result.exit_status != 0:
+        try:
+            date = datetime.datetime.strptime(" ".join(parts[3:7]), "%b %d %H:%M:%S %Y")
+        except ValueError:
             continue
-        pci_address = result.stdout.strip().split("/")[-1]
-        # Find the corresponding NIC
-        for nic in nics:
-            if nic["pci_address"] == pci_address:
-                nic["interface_name"] = interface
-                break
-    return nics
+        if "still logged in" in line:
+            date = now
+        elif len(parts) >= 13 and parts[7] == "-":
+            try:
+                date = datetime.datetime.strptime(" ".join(parts[9:13]), "%b %d %H:%M:%S %Y")
+            except ValueError:
+                pass
+        user = parts[0]
+        if user not in dates or dates[user] < date:
+            dates[user] = date
+    return dates
+
+# The current time of the server followed by its login records
+LOGIN_RECORDS_CMD = "date '+%Y-%m-%d %H:%M:%S'; LC_ALL=C last -F -R -w 2>/dev/null"
+
+def parseLoginRecords(output: str) -> dict[str, datetime.datetime]:
+    """
+    Parse the output of LOGIN_RECORDS_CMD into the last login date of every user.
+    """
+    lines = output.split("\n", 1)
+    now = datetime.datetime.strptime(lines[0].strip(), "%Y-%m-%d %H:%M:%S")
+    return parseLoginDates(lines[1] if len(lines) > 1 else "", now)
 
-async def sshServerGetAccountLoginDate(conn: asyncssh.SSHClientConnection, user: str) -> tuple[bool, str]:
+async def sshServerGetLoginDates(conn: asyncssh.SSHClientConnection) -> dict[str, datetime.datetime] | None:
     """
-    Get the last login date of the server of all users
+    Get the last login date of all users of the server from one pass over the login records.
     """
-    cmd = f"""{{ last -F -R "{user}" 2>/dev/null | head -1 | grep -q 'still logged in' && date '+%Y-%m-%d %H:%M:%S' || date -d "$(last -F -R "{user}" 2>/dev/null | head -1 | awk '{{print $10, $11, $12, $13}}')" '+%Y-%m-%d %H:%M:%S'; }} || echo '1970-01-01 00:00:00'"""
-    result = await conn.run(cmd, timeout=6)
+    result = await conn.run(LOGIN_RECORDS_CMD, timeout=10)
     if result.exit_status != 0:
         err_result = result.stderr.strip()
-        return False, ""
-    return True, result.stdout.strip()
\ No newline at end of file
+        logger.error(f"Error collecting login records: {err_result}")
+        return None
+    return parseLoginRecords(result.stdout)
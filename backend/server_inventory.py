@@ -0,0 +1,104 @@
+import datetime
+from sqlalchemy import update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from app.database import Account, Server, ServerInterface, ServerStatus, User
+from topology import topology
+
+def interfaceRows(server_id: int, nics: list[dict], ib_nics: list[dict]) -> list[dict]:
+    """
+    Turn the collected NICs into server_interface rows, unnamed interfaces get a placeholder name.
+    """
+    rows = {}
+    for nics_of_kind, no_name in ((nics, "No Name Eth"), (ib_nics, "No Name IB")):
+        for nic in nics_of_kind:
+            rows[nic["pci_address"]] = {
+                "server_id": server_id,
+                "pci_address": nic["pci_address"],
+                "interface": nic["interface_name"] if nic["interface_name"] else no_name,
+                "manufacturer": nic["nic_name"],
+                "is_present": True,
+            }
+    return list(rows.values())
+
+def applyLoginDates(db: Session, server_id: int, login_dates: dict[str, datetime.datetime] | None) -> int:
+    """
+    Update the accounts of the server whose login date is newer, returns the number of updated accounts.
+    """
+    if not login_dates:
+        return 0
+    accounts = (
+        db.query(Account.id, Account.last_login_date, User.account_name)
+          .join(User, Account.user_id == User.id)
+          .filter(Account.server_id == server_id, Account.is_login_able == True)
+          .all()
+    )
+    # update if date is newer
+    updates = [
+        {"id": account_id, "last_login_date": login_dates[account_name]}
+        for account_id, last_login_date, account_name in accounts
+        if account_name in login_dates and last_login_date < login_dates[account_name]
+    ]
+    if updates:
+        db.execute(update(Account), updates)
+    return len(updates)
+
+def applyServerInventory(db: Session, server_id: int, fingerprint: str, kernel_version: str, os_version: str,
+                         nics: list[dict] | None, ib_nics: list[dict] | None,
+                         login_dates: dict[str, datetime.datetime] | None) -> int:
+    """
+    Write everything collected from a server in one transaction:
+    the server facts and their fingerprint, the interfaces (one upsert, missing ones are marked as
+    not present) and the newer login dates of its accounts. Returns the number of accounts whose
+    login date was updated.
+    NICs that could not be read (None) leave the interfaces as they are.
+    """
+    db.execute(
+        update(Server)
+        .where(Server.id == server_id)
+        .values(server_status=ServerStatus.ACTIVE, kernel_version=kernel_version, os_version=os_version,
+                inventory_fingerprint=fingerprint)
+    )
+
+    if nics is not None and ib_nics is not None:
+        rows = interfaceRows(server_id, nics, ib_nics)
+        if rows:
+            stmt = insert(ServerInterface).values(rows)
+            db.execute(stmt.on_conflict_do_update(
+                index_elements=[ServerInterface.server_id, ServerInterface.pci_address],
+                set_={
+                    "interface": stmt.excluded.interface,
+                    "manufacturer": stmt.excluded.manufacturer,
+                    "is_present": True,
+                },
+            ))
+        db.execute(
+            update(ServerInterface)
+            .where(
+                ServerInterface.server_id == server_id,
+                ServerInterface.pci_address.not_in([row["pci_address"] for row in rows]),
+                ServerInterface.is_present == True,
+            )
+            .values(is_present=False)
+        )
+
+    updated = applyLoginDates(db, server_id, login_dates)
+    db.commit()
+    # New or renamed interfaces
+    topology.invalidate()
+    return updated
+
+def applyUnchangedInventory(db: Session, server_id: int,
+                            login_dates: dict[str, datetime.datetime] | None) -> int:
+    """
+    Record a collection whose fingerprint matched: the inventory is not written again, only the
+    status (if it is not active already) and the newer login dates.
+    """
+    db.execute(
+        update(Server)
+        .where(Server.id == server_id, Server.server_status != ServerStatus.ACTIVE)
+        .values(server_status=ServerStatus.ACTIVE)
+    )
+    updated = applyLoginDates(db, server_id, login_dates)
+    db.commit()
+    return updated
@@ -0,0 +1,55 @@
+import asyncio
+import threading
+
+# In-process channel used by the API to wake the sync engine.
+# API handlers run in the thread pool, so everything here is guarded by a lock and the
+# watcher is woken through call_soon_threadsafe.
+_lock = threading.Lock()
+_loop: asyncio.AbstractEventLoop | None = None
+_event: asyncio.Event | None = None
+_pending_accounts: set[int] = set()
+_pending_full = False
+
+def bindLoop(loop: asyncio.AbstractEventLoop):
+    """
+    Attach the channel to the event loop running the watcher, must be called from that loop.
+    """
+    global _loop, _event
+    _loop = loop
+    _event = asyncio.Event()
+
+def notifySync(account_ids: list[int] | None = None):
+    """
+    Wake the sync engine now.
+    With account ids, the dirty accounts on the servers of these accounts are dispatched at once,
+    without ids a full watcher tick (gateway accounts, revocations, collection) is run.
+    Does nothing if no watcher is running in this process.
+    """
+    global _pending_full
+    with _lock:
+        if account_ids is None:
+            _pending_full = True
+        else:
+            _pending_accounts.update(account_id for account_id in account_ids if account_id)
+        loop, event = _loop, _event
+    if loop is None or event is None or loop.is_closed():
+        return
+    loop.call_soon_threadsafe(event.set)
+
+async def waitForSync(timeout: float) -> tuple[set[int], bool]:
+    """
+    Wait until the sync engine is notified or `timeout` seconds passed.
+    Returns the account ids that were notified and whether a full tick was requested by notifySync().
+    """
+    global _pending_full
+    try:
+        await asyncio.wait_for(_event.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+    _event.clear()
+    with _lock:
+        account_ids = set(_pending_accounts)
+        _pending_accounts.clear()
+        full = _pending_full
+        _pending_full = False
+    return account_ids, full
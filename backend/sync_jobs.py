@@ -0,0 +1,134 @@
+import datetime
+import os
+import socket
+from sqlalchemy import and_, case, func, literal, or_, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from app.database import SyncJob, SyncJobKind, SyncJobState, dbNow
+
+# Identifies this process as the holder of the leases it takes
+worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+def isClaimable(now: datetime.datetime):
+    """
+    Condition of the jobs that may be claimed: due and not running, or running with an expired lease
+    (by the database clock, like the leases are written).
+    """
+    return or_(
+        and_(SyncJob.state != SyncJobState.RUNNING, SyncJob.next_run_at <= now),
+        and_(SyncJob.state == SyncJobState.RUNNING, SyncJob.lease_expires_at < dbNow()),
+    )
+
+def enqueueJobs(db: Session, kind: SyncJobKind, server_ids: list[int], run_at: datetime.datetime, wake: bool = False):
+    """
+    Make sure the job of the kind is scheduled for every server, does not commit.
+    A missing or unscheduled job runs at `run_at`, a scheduled one keeps its time (e.g. a retry
+    backoff) unless `wake` moves it earlier. Running jobs are left alone.
+    """
+    if not server_ids:
+        return
+    pending = literal(SyncJobState.PENDING, SyncJob.__table__.c.state.type)
+    stmt = insert(SyncJob).values([
+        {"kind": kind, "server_id": server_id, "state": SyncJobState.PENDING, "next_run_at": run_at}
+        for server_id in server_ids
+    ])
+    scheduled_at = func.coalesce(SyncJob.next_run_at, run_at)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[SyncJob.kind, SyncJob.server_id],
+        set_={
+            "state": case((SyncJob.next_run_at.is_(None), pending), else_=SyncJob.state),
+            "next_run_at": func.min(scheduled_at, run_at) if wake else scheduled_at,
+        },
+        where=SyncJob.state != SyncJobState.RUNNING,
+    ))
+
+def claimJob(db: Session, job_id: int, lease: datetime.timedelta) -> bool:
+    """
+    Lease the job to this worker if it is still claimable, does not commit.
+    The check and the update are one statement, so two workers can never both claim the job.
+    """
+    now = datetime.datetime.now()
+    claimed = db.execute(
+        update(SyncJob)
+        .where(SyncJob.id == job_id, isClaimable(now))
+        .values(state=SyncJobState.RUNNING, lease_owner=worker_id, lease_expires_at=dbNow(lease),
+                attempts=SyncJob.attempts + 1)
+        .returning(SyncJob.id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    return claimed is not None
+
+def finishJob(db: Session, job_id: int, state: SyncJobState, next_run_at: datetime.datetime | None,
+              error: str = "") -> bool:
+    """
+    Record the outcome of a job leased by this worker, does not commit.
+    Returns False if the lease was lost meanwhile (the job was claimed again by another worker).
+    """
+    values = {
+        "state": state,
+        "next_run_at": next_run_at,
+        "last_error": error,
+        "lease_owner": "",
+        "lease_expires_at": None,
+        "finished_at": datetime.datetime.now(),
+    }
+    if state == SyncJobState.DONE:
+        values["attempts"] = 0
+    finished = db.execute(
+        update(SyncJob)
+        .where(SyncJob.id == job_id, SyncJob.state == SyncJobState.RUNNING, SyncJob.lease_owner == worker_id)
+        .values(**values)
+        .returning(SyncJob.id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    return finished is not None
+
+def postponeJob(db: Session, job_id: int, run_at: datetime.datetime):
+    db.execute(
+        update(SyncJob)
+        .where(SyncJob.id == job_id, SyncJob.state != SyncJobState.RUNNING)
+        .values(next_run_at=run_at)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+def renewLeases(db: Session, lease: datetime.timedelta):
+    """
+    Extend the leases of the jobs this worker is running.
+    """
+    db.execute(
+        update(SyncJob)
+        .where(SyncJob.state == SyncJobState.RUNNING, SyncJob.lease_owner == worker_id)
+        .values(lease_expires_at=dbNow(lease))
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+def releaseLeases(db: Session):
+    """
+    Give back the jobs this worker still holds, they can be claimed again at once.
+    """
+    db.execute(
+        update(SyncJob)
+        .where(SyncJob.state == SyncJobState.RUNNING, SyncJob.lease_owner == worker_id)
+        .values(state=SyncJobState.PENDING, next_run_at=datetime.datetime.now(), lease_owner="", lease_expires_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+def nextJobDelay(db: Session) -> float | None:
+    """
+    Seconds until the next job becomes claimable, None if no job is scheduled.
+    """
+    next_at = db.execute(
+        select(func.min(case(
+            (SyncJob.state == SyncJobState.RUNNING, SyncJob.lease_expires_at),
+            else_=SyncJob.next_run_at,
+        )))
+    ).scalar()
+    if next_at is None:
+        return None
+    if isinstance(next_at, str):
+        next_at = datetime.datetime.fromisoformat(next_at)
+    return max(0.0, (next_at - datetime.datetime.now()).total_seconds())
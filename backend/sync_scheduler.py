@@ -0,0 +1,130 @@
+import asyncio
+import time
+from collections import Counter, deque
+from enum import IntEnum
+from typing import Awaitable, Callable, Optional
+
+from logger import logger
+
+class Priority(IntEnum):
+    ACCOUNT = 0 # User-visible account changes
+    COLLECT = 1 # Background inventory collection
+
+class ScheduledJob:
+    def __init__(self, name: str, priority: Priority, server_id: int, proxy_id: Optional[int],
+                 factory: Callable[[], Awaitable[None]]):
+        self.name = name
+        self.priority = priority
+        self.server_id = server_id
+        self.proxy_id = proxy_id
+        self.factory = factory
+        self.enqueued_at = time.monotonic()
+
+class SyncScheduler:
+    """
+    Runs the sync jobs with bounded queues and fair concurrency.
+    Jobs wait in one FIFO lane per priority, the account lane is always served before the
+    collection lane. A job only starts if the global limit, the limit of its server and the limit
+    of its proxy (jump host) are not reached, so one slow host or gateway can not take every slot.
+    """
+    def __init__(self, max_running: int = 20, max_per_server: int = 2, max_per_proxy: int = 8,
+                 max_queued: int = 1000):
+        self.max_running = max_running
+        self.max_per_server = max_per_server
+        self.max_per_proxy = max_per_proxy
+        self.max_queued = max_queued
+        self._queues: dict[Priority, deque[ScheduledJob]] = {p: deque() for p in Priority}
+        self._running = 0
+        self._running_server: Counter = Counter()
+        self._running_proxy: Counter = Counter()
+        self._tasks: set[asyncio.Task] = set()
+        # Recent wait times (seconds between submit and start) per lane
+        self._waits: dict[Priority, deque[float]] = {p: deque(maxlen=200) for p in Priority}
+        self._started: Counter = Counter()
+        self._rejected: Counter = Counter()
+
+    def hasRoom(self, priority: Priority) -> bool:
+        return len(self._queues[priority]) < self.max_queued
+
+    def isIdle(self) -> bool:
+        return self._running == 0 and not any(self._queues.values())
+
+    def submit(self, name: str, priority: Priority, server_id: int, proxy_id: Optional[int],
+               factory: Callable[[], Awaitable[None]]) -> bool:
+        """
+        Queue a job, returns False if the lane is full. `factory` is called when the job starts.
+        """
+        if not self.hasRoom(priority):
+            self._rejected[priority] += 1
+            logger.warning(f"Sync queue {priority.name} is full, rejected job {name}.")
+            return False
+        self._queues[priority].append(ScheduledJob(name, priority, server_id, proxy_id, factory))
+        self._startReady()
+        return True
+
+    def _eligible(self, job: ScheduledJob) -> bool:
+        if self._running_server[job.server_id] >= self.max_per_server:
+            return False
+        if job.proxy_id is not None and self._running_proxy[job.proxy_id] >= self.max_per_proxy:
+            return False
+        return True
+
+    def _startReady(self):
+        for priority in Priority:
+            queue = self._queues[priority]
+            for job in list(queue):
+                if self._running >= self.max_running:
+                    return
+                if not self._eligible(job):
+                    continue
+                queue.remove(job)
+                self._start(job)
+
+    def _start(self, job: ScheduledJob):
+        self._running += 1
+        self._running_server[job.server_id] += 1
+        if job.proxy_id is not None:
+            self._running_proxy[job.proxy_id] += 1
+        self._waits[job.priority].append(time.monotonic() - job.enqueued_at)
+        self._started[job.priority] += 1
+        task = asyncio.get_event_loop().create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: ScheduledJob):
+        try:
+            await job.factory()
+        except Exception as e:
+            logger.error(f"Error running sync job {job.name}: {e}")
+        finally:
+            self._running -= 1
+            self._running_server[job.server_id] -= 1
+            if self._running_server[job.server_id] <= 0:
+                del self._running_server[job.server_id]
+            if job.proxy_id is not None:
+                self._running_proxy[job.proxy_id] -= 1
+                if self._running_proxy[job.proxy_id] <= 0:
+                    del self._running_proxy[job.proxy_id]
+            self._startReady()
+
+    def stats(self) -> dict:
+        lanes = {}
+        now = time.monotonic()
+        for priority in Priority:
+            waits = self._waits[priority]
+            queue = self._queues[priority]
+            lanes[priority.name.lower()] = {
+                "queued": len(queue),
+                "started": self._started[priority],
+                "rejected": self._rejected[priority],
+                "oldest_wait": now - queue[0].enqueued_at if queue else 0.0,
+                "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+                "max_wait": max(waits) if waits else 0.0,
+            }
+        return {
+            "running": self._running,
+            "max_running": self.max_running,
+            "running_per_server": dict(self._running_server),
+            "running_per_proxy": dict(self._running_proxy),
+            "lanes": lanes,
+        }
@@ -0,0 +1,68 @@
+import datetime
+import os
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+
+# app.database reads the URL at import, every test module runs against a throwaway SQLite file
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='n2sys-test-'), 'test.db')}"
+
+from sqlalchemy import event
+
+from app.database import Account, AccountStatus, Base, Server, SessionLocal, User, UserStatus, engine, migrateSchema
+
+migrateSchema()
+
+@pytest.fixture
+def db():
+    """
+    A session on an emptied database.
+    """
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+@pytest.fixture
+def count_queries():
+    """
+    Context manager counting the SQL statements executed inside it: `with count_queries() as counter`,
+    the count is counter[0].
+    """
+    @contextmanager
+    def counting():
+        counter = [0]
+        def count(conn, cursor, statement, parameters, context, executemany):
+            counter[0] += 1
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            yield counter
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+    return counting
+
+def seedFleet(db, servers: int, users: int, gateways: int = 1) -> tuple[list[Server], list[User]]:
+    """
+    Servers (the first `gateways` of them gateways) and active users with a recently used account on every server.
+    """
+    now = datetime.datetime.now()
+    fleet = [Server(host=f"10.0.0.{i}", port=22, is_gateway=i < gateways) for i in range(servers)]
+    people = [
+        User(username=f"user{j}", realname=f"User {j}", account_name=f"user{j}", mail=f"user{j}@example.com",
+             public_key="", password="", is_admin=j == 0, status=UserStatus.ACTIVE)
+        for j in range(users)
+    ]
+    db.add_all(fleet + people)
+    db.flush()
+    db.add_all([
+        Account(user_id=user.id, server_id=server.id, is_sudo=user.is_admin, is_login_able=True,
+                status=AccountStatus.ACTIVE, last_login_date=now)
+        for server in fleet for user in people
+    ])
+    db.commit()
+    return fleet, people
@@ -0,0 +1,64 @@
+import datetime
+
+from account_sync import applyAccountPolicies
+from app.database import Account, AccountStatus, Server, User, UserStatus
+from conftest import seedFleet
+
+def test_query_count_does_not_grow_with_the_fleet(db, count_queries):
+    counts = []
+    for servers in (10, 100):
+        seedFleet(db, servers, 5)
+        with count_queries() as counter:
+            applyAccountPolicies(db)
+        counts.append(counter[0])
+        for table in (Account, Server, User):
+            db.query(table).delete()
+        db.commit()
+    assert counts[0] == counts[1]
+
+def test_gateway_accounts_are_created_for_active_users(db):
+    servers, users = seedFleet(db, 3, 2, gateways=2)
+    newcomer = User(username="new", realname="New", account_name="new", mail="new@example.com",
+                    public_key="", password="", status=UserStatus.ACTIVE)
+    pending = User(username="pending", realname="Pending", account_name="pending", mail="pending@example.com",
+                   public_key="", password="", status=UserStatus.VERIFYING)
+    db.add_all([newcomer, pending])
+    db.commit()
+    applyAccountPolicies(db)
+    created = db.query(Account).filter(Account.user_id == newcomer.id).all()
+    assert {account.server_id for account in created} == {servers[0].id, servers[1].id}
+    assert all(account.status == AccountStatus.DIRTY and account.is_login_able for account in created)
+    assert db.query(Account).filter(Account.user_id == pending.id).count() == 0
+
+def test_gateway_accounts_follow_admin_rights(db):
+    servers, users = seedFleet(db, 2, 2)
+    users[1].is_admin = True
+    db.commit()
+    applyAccountPolicies(db)
+    gateway = db.query(Account).filter(Account.user_id == users[1].id, Account.server_id == servers[0].id).one()
+    other = db.query(Account).filter(Account.user_id == users[1].id, Account.server_id == servers[1].id).one()
+    assert gateway.is_sudo and gateway.status == AccountStatus.DIRTY
+    assert not other.is_sudo and other.status == AccountStatus.ACTIVE
+
+def test_graduated_users_lose_their_accounts(db):
+    servers, users = seedFleet(db, 3, 2)
+    users[1].status = UserStatus.GRADUATED
+    db.commit()
+    applyAccountPolicies(db)
+    for account in db.query(Account).filter(Account.user_id == users[1].id):
+        assert not account.is_login_able and account.status == AccountStatus.DIRTY
+    for account in db.query(Account).filter(Account.user_id == users[0].id):
+        assert account.is_login_able and account.status == AccountStatus.ACTIVE
+
+def test_accounts_unused_for_30_days_lose_login(db):
+    servers, users = seedFleet(db, 3, 2)
+    stale = datetime.datetime.now() - datetime.timedelta(days=31)
+    db.query(Account).update({Account.last_login_date: stale})
+    db.commit()
+    applyAccountPolicies(db)
+    accounts = {(account.user_id, account.server_id): account for account in db.query(Account)}
+    # Not on the gateway and not for admins
+    assert not accounts[(users[1].id, servers[1].id)].is_login_able
+    assert accounts[(users[1].id, servers[1].id)].status == AccountStatus.DIRTY
+    assert accounts[(users[1].id, servers[0].id)].is_login_able
+    assert accounts[(users[0].id, servers[2].id)].is_login_able
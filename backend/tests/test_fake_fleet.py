@@ -0,0 +1,171 @@
+import asyncio
+import os
+import shutil
+import subprocess
+
+import asyncssh
+import pytest
+
+from account_helpers import sshAccountsReconcile
+from bench.fake_fleet import FakeFleet, FakeHost
+
+pytestmark = pytest.mark.skipif(shutil.which("bash") is None, reason="bash is needed to run the reconcile script")
+
+# Commands of the reconcile script that need root or the real user database, answered from files under $ROOT:
+# passwd, sudoers (the comma separated members of the sudo group) and owners ("<path> <owner>" lines)
+STUBS = r'''
+getent() {
+    case "$1" in
+        passwd) grep "^$2:" "$ROOT/passwd" ;;
+        group) [ "$2" = sudo ] && echo "sudo:x:27:$(cat "$ROOT/sudoers")" ;;
+    esac
+}
+id() {
+    grep -q "^$2:" "$ROOT/passwd" || return 1
+    case ",$(cat "$ROOT/sudoers")," in *",$2,"*) echo "$2 sudo" ;; *) echo "$2" ;; esac
+}
+useradd() {
+    local uid=$((1000 + $(wc -l < "$ROOT/passwd")))
+    echo "$1:x:$uid:$uid::/home/$1:/bin/sh" >> "$ROOT/passwd" && mkdir -p "$4"
+}
+chpasswd() { cat > /dev/null; }
+usermod() {
+    case "$1" in
+        -s) sed -i "s|^\($3:.*:\)[^:]*\$|\1$2|" "$ROOT/passwd" ;;
+        -aG) local members; members=$(cat "$ROOT/sudoers"); echo "${members:+$members,}$3" > "$ROOT/sudoers" ;;
+    esac
+}
+gpasswd() {
+    local members; members=$(tr , '\n' < "$ROOT/sudoers" | grep -vx "$2" | paste -sd,)
+    echo "$members" > "$ROOT/sudoers"
+}
+chown() { [ -e "$2" ] && echo "$2 ${1%%:*}" >> "$ROOT/owners"; }
+stat() {
+    [ -e "$3" ] || return 1
+    echo "$(awk -v path="$3" '$1 == path { owner = $2 } END { print owner }' "$ROOT/owners") $(command stat -c %a "$3")"
+}
+'''
+
+def writeHost(host: FakeHost, root: str):
+    """
+    Lay the state of a fake host out under root, /home/x becomes <root>/home/x.
+    """
+    with open(os.path.join(root, "passwd"), "w") as f:
+        f.write("".join(entry + "\n" for entry in host.passwd.values()))
+    with open(os.path.join(root, "sudoers"), "w") as f:
+        f.write(",".join(host.sudoers) + "\n")
+    with open(os.path.join(root, "owners"), "w") as f:
+        for path, content in host.files.items():
+            os.makedirs(os.path.dirname(root + path), exist_ok=True)
+            with open(root + path, "w") as keys:
+                keys.write(content + "\n")
+            if path in host.stats:
+                owner, mode = host.stats[path].split(" ")
+                os.chmod(root + path, int(mode, 8))
+                f.write(f"{root + path} {owner}\n")
+
+def readHost(root: str) -> dict:
+    with open(os.path.join(root, "passwd")) as f:
+        passwd = {line.split(":", 1)[0]: line for line in f.read().splitlines()}
+    with open(os.path.join(root, "sudoers")) as f:
+        sudoers = [name for name in f.read().strip().split(",") if name]
+    files = {}
+    for directory, _, names in os.walk(os.path.join(root, "home")):
+        for name in names:
+            with open(os.path.join(directory, name)) as f:
+                files[os.path.join(directory, name)[len(root):]] = f.read().removesuffix("\n")
+    owners = {}
+    with open(os.path.join(root, "owners")) as f:
+        for line in f.read().splitlines():
+            path, owner = line.split(" ")
+            owners[path[len(root):]] = owner
+    stats = {path: f"{owner} {os.stat(root + path).st_mode & 0o777:o}" for path, owner in owners.items() if path in files}
+    return {"passwd": passwd, "sudoers": sudoers, "files": files, "stats": stats}
+
+def hostState(host: FakeHost) -> dict:
+    return {
+        "passwd": dict(host.passwd),
+        "sudoers": list(host.sudoers),
+        "files": dict(host.files),
+        "stats": {path: stat for path, stat in host.stats.items() if path in host.files},
+    }
+
+class ScriptConnection:
+    """
+    Stands for the SSH connection of sshAccountsReconcile(): `sudo bash -s` runs the real script locally
+    with the stubs, home directories under root rather than in /home.
+    """
+    def __init__(self, root: str):
+        self.root = root
+
+    async def run(self, command: str, input: str, timeout: float):
+        assert command == "sudo bash -s"
+        script = STUBS + input.replace('"/home/', '"$ROOT/home/')
+        result = subprocess.run(["bash", "-s"], input=script, capture_output=True, text=True,
+                                env={**os.environ, "ROOT": self.root}, timeout=timeout)
+        assert result.returncode == 0, result.stderr
+        return asyncssh.SSHCompletedProcess(exit_status=result.returncode, stdout=result.stdout, stderr=result.stderr)
+
+class FakeConnection:
+    """
+    Stands for the SSH connection of sshAccountsReconcile() to a fake host.
+    """
+    def __init__(self, host: FakeHost):
+        self.fleet = FakeFleet()
+        self.host = host
+
+    async def run(self, command: str, input: str, timeout: float):
+        exit_status, stdout, stderr = self.fleet.run(self.host, command, input)
+        return asyncssh.SSHCompletedProcess(exit_status=exit_status, stdout=stdout, stderr=stderr)
+
+def reconcile(conn, accounts: list[tuple]) -> dict[str, dict]:
+    return asyncio.run(sshAccountsReconcile(conn, [
+        {"name": name, "is_login_able": login, "is_sudo": sudo, "public_key": keys, "fingerprint": fingerprint}
+        for name, login, sudo, keys, fingerprint in accounts
+    ]))
+
+def makeHosts() -> list[tuple[str, FakeHost]]:
+    hosts = []
+    host = FakeHost("127.0.1.1")
+    hosts.append(("empty", host))
+
+    host = FakeHost("127.0.1.2")
+    host.addUser("alice", shell="/usr/sbin/nologin")
+    host.sudoers.append("alice")
+    host.files["/home/alice/.ssh/authorized_keys"] = "ssh-ed25519 AAAA alice@old\nssh-ed25519 BBBB alice@laptop"
+    host.stats["/home/alice/.ssh/authorized_keys"] = "root 644"
+    hosts.append(("shell and sudo", host))
+
+    host = FakeHost("127.0.1.3")
+    host.addUser("alice", shell="/bin/bash")
+    host.files["/home/alice/.ssh/authorized_keys.n2sysbackup"] = "ssh-ed25519 AAAA alice@old"
+    hosts.append(("backup", host))
+
+    host = FakeHost("127.0.1.4")
+    host.addUser("alice", shell="/bin/bash")
+    host.files["/home/alice/.ssh/authorized_keys"] = "ssh-ed25519 AAAA alice@old\n\nssh-ed25519 AAAA alice@old"
+    host.stats["/home/alice/.ssh/authorized_keys"] = "alice 600"
+    hosts.append(("duplicate keys", host))
+    return hosts
+
+ACCOUNTS = [
+    [("alice", True, True, "ssh-ed25519 BBBB alice@laptop\n", None), ("bob", True, False, "ssh-ed25519 CCCC bob@desk", None)],
+    [("alice", True, False, "ssh-ed25519 BBBB alice@laptop\nssh-ed25519 DDDD alice@new", None)],
+    [("alice", False, False, "ssh-ed25519 BBBB alice@laptop", None), ("bob", False, True, "", None)],
+]
+
+@pytest.mark.parametrize("accounts", ACCOUNTS, ids=["enable", "keys", "disable"])
+@pytest.mark.parametrize("label,host", makeHosts(), ids=lambda value: value if isinstance(value, str) else "")
+def test_fake_reconcile_matches_the_script(tmp_path, label, host, accounts):
+    root = str(tmp_path)
+    writeHost(host, root)
+    script_results = reconcile(ScriptConnection(root), accounts)
+    fake_results = reconcile(FakeConnection(host), accounts)
+    # Fingerprints only have to agree with themselves, the fake hashes its state in Python
+    assert {name: {**result, "fingerprint": ""} for name, result in fake_results.items()} == \
+           {name: {**result, "fingerprint": ""} for name, result in script_results.items()}
+    assert hostState(host) == readHost(root)
+    # A second pass with the returned fingerprints leaves every account untouched on both sides
+    for conn, results in ((ScriptConnection(root), script_results), (FakeConnection(host), fake_results)):
+        again = [(name, login, sudo, keys, results[name]["fingerprint"]) for name, login, sudo, keys, _ in accounts]
+        assert all(result["changes"] == ["unchanged"] for result in reconcile(conn, again).values())
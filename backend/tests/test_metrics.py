@@ -0,0 +1,40 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app.database import User
+from conftest import seedFleet
+from main import app
+from metrics import HTTP_REQUEST_SECONDS
+from validator import getUser
+
+@pytest.fixture
+def client(db):
+    viewer = User(id=0, username="viewer", is_admin=False)
+    app.dependency_overrides[getUser] = lambda: viewer
+    try:
+        yield TestClient(app)
+    finally:
+        app.dependency_overrides.clear()
+
+def requestCount(method: str, route: str, status: str) -> float:
+    for metric in HTTP_REQUEST_SECONDS.collect():
+        for sample in metric.samples:
+            if sample.name.endswith("_count") and sample.labels == {"method": method, "route": route, "status": status}:
+                return sample.value
+    return 0.0
+
+@pytest.mark.parametrize("url, route", [
+    ("/search?q=10.0", "/search"),
+    ("/summary/get", "/summary/get"),
+    ("/server/{server_id}", "/server/{server_id}"),
+])
+def test_requests_are_labelled_with_their_route(db, client, url, route):
+    servers, _ = seedFleet(db, 1, 1)
+    before = requestCount("GET", route, "200")
+    assert client.get(url.replace("{server_id}", str(servers[0].id))).status_code == 200
+    assert requestCount("GET", route, "200") == before + 1
+
+def test_unmatched_requests_share_one_label(db, client):
+    before = requestCount("GET", "unmatched", "404")
+    assert client.get("/no/such/path").status_code == 404
+    assert requestCount("GET", "unmatched", "404") == before + 1
@@ -0,0 +1,34 @@
+from app.database import ServerInterface
+from conftest import seedFleet
+from server_helpers import parseNICDump
+from server_inventory import applyServerInventory
+
+LSPCI = "0000:3b:00.0 Ethernet controller: Intel Corporation Ethernet Controller X710\n"
+NET_DEVICES = "eno1 ../../../0000:3b:00.0\nlo \n"
+
+def nicDump(lspci: str) -> str:
+    return lspci + "#N2SYS#\n" + NET_DEVICES
+
+def test_nic_dump_without_lspci_output_is_incomplete():
+    assert parseNICDump(nicDump("")) is None
+    assert parseNICDump("") is None
+    nics, ib_nics = parseNICDump(nicDump(LSPCI))
+    assert nics == [{"pci_address": "0000:3b:00.0", "nic_name": "Ethernet controller: Intel Corporation Ethernet Controller X710",
+                     "interface_name": "eno1"}]
+    assert ib_nics == []
+
+def test_unreadable_nics_leave_the_interfaces_present(db):
+    server = seedFleet(db, 1, 0)[0][0]
+    nics, ib_nics = parseNICDump(nicDump(LSPCI))
+    applyServerInventory(db, server.id, "a", "6.1", "Debian 12", nics, ib_nics, None)
+    applyServerInventory(db, server.id, "b", "6.1", "Debian 12", None, None, None)
+    assert [(i.interface, i.is_present) for i in db.query(ServerInterface).filter(ServerInterface.server_id == server.id)] == [("eno1", True)]
+
+def test_interfaces_missing_from_the_dump_are_marked_absent(db):
+    server = seedFleet(db, 1, 0)[0][0]
+    nics, ib_nics = parseNICDump(nicDump(LSPCI + "0000:5e:00.0 Infiniband controller: Mellanox MT28908\n"))
+    applyServerInventory(db, server.id, "a", "6.1", "Debian 12", nics, ib_nics, None)
+    nics, ib_nics = parseNICDump(nicDump(LSPCI))
+    applyServerInventory(db, server.id, "b", "6.1", "Debian 12", nics, ib_nics, None)
+    present = {i.pci_address: i.is_present for i in db.query(ServerInterface).filter(ServerInterface.server_id == server.id)}
+    assert present == {"0000:3b:00.0": True, "0000:5e:00.0": False}
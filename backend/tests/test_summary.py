@@ -0,0 +1,62 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from app.database import User, engine
+from conftest import seedFleet
+from main import app
+from validator import getUser
+
+@pytest.fixture
+def client(db):
+    viewer = User(id=0, username="viewer", is_admin=False)
+    app.dependency_overrides[getUser] = lambda: viewer
+    try:
+        yield TestClient(app)
+    finally:
+        app.dependency_overrides.clear()
+
+@pytest.mark.parametrize("servers", [5, 50])
+def test_summary_query_count_does_not_grow_with_the_fleet(db, client, count_queries, servers):
+    seedFleet(db, servers, 4)
+    with count_queries() as counter:
+        response = client.get("/summary/get")
+    assert response.status_code == 200
+    assert len(response.json()) == servers
+    # The servers and the loginable accounts of all of them
+    assert counter[0] == 2
+
+@pytest.mark.parametrize("servers", [5, 50])
+def test_summary_page_query_count_does_not_grow_with_the_fleet(db, client, count_queries, servers):
+    seedFleet(db, servers, 4)
+    first = client.get("/summary/get", params={"limit": 2})
+    with count_queries() as counter:
+        response = client.get("/summary/get", params={"limit": 2, "cursor": first.headers["X-Next-Cursor"]})
+    assert response.status_code == 200
+    assert [server["id"] for server in response.json()] == [server["id"] + 2 for server in first.json()]
+    assert counter[0] == 2
+
+def test_summary_lists_the_loginable_accounts(db, client):
+    servers, users = seedFleet(db, 2, 3)
+    users[2].accounts[0].is_login_able = False
+    db.commit()
+    summary = {server["id"]: server for server in client.get("/summary/get").json()}
+    assert [account["user"] for account in summary[servers[0].id]["users"]] == ["User 0", "User 1"]
+    assert [account["user"] for account in summary[servers[1].id]["users"]] == ["User 0", "User 1", "User 2"]
+
+def test_filtered_summary_reads_only_the_accounts_of_its_servers(db, client):
+    servers, users = seedFleet(db, 4, 3, gateways=2)
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        response = client.get("/summary/get", params={"gateway": True})
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert [server["id"] for server in response.json()] == [servers[0].id, servers[1].id]
+    assert all(len(server["users"]) == 3 for server in response.json())
+    # The account query is bound to the two gateways rather than reading the accounts of the whole fleet
+    statement, parameters = statements[-1]
+    assert "FROM account " in statement and "account.server_id IN (?, ?)" in statement
+    assert servers[0].id in parameters and servers[1].id in parameters
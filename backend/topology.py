@@ -0,0 +1,228 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from sqlalchemy.orm import Session
+
+from app.database import Server, ServerInterface, Switch, SwitchPort
+
+# An endpoint of a connection: ("interface", interface id) or ("switch_port", switch port id)
+Endpoint = tuple[str, int]
+# A node of the L2 graph: an endpoint or ("switch", switch id)
+Node = tuple[str, int]
+
+class SwitchNode:
+    def __init__(self, id: int, name: str, num_row: int, num_col: int):
+        self.id = id
+        self.name = name
+        self.num_row = num_row
+        self.num_col = num_col
+        self.port_ids: list[int] = []
+
+class PortNode:
+    def __init__(self, id: int, switch_id: int, phy_row: int, phy_col: int, tag: str, conn_id: int | None):
+        self.id = id
+        self.switch_id = switch_id
+        self.phy_row = phy_row
+        self.phy_col = phy_col
+        self.tag = tag
+        self.conn_id = conn_id
+
+class InterfaceNode:
+    def __init__(self, id: int, server_id: int, server_host: str, interface: str, manufacturer: str,
+                 pci_address: str, conn_id: int | None):
+        self.id = id
+        self.server_id = server_id
+        self.server_host = server_host
+        self.interface = interface
+        self.manufacturer = manufacturer
+        self.pci_address = pci_address
+        self.conn_id = conn_id
+
+class TopologyIndex:
+    """
+    In-memory copy of the cabling: switches and their ports, server interfaces and the connections
+    between them, loaded with one query per table.
+    The link endpoints of this process apply their changes incrementally after they commit. Changes
+    made elsewhere (another API worker, new interfaces from a collection) are picked up by a reload
+    once the index is invalidated or older than `ttl` seconds.
+    API handlers run in a thread pool, every access goes through view(), which holds the lock.
+    """
+    def __init__(self, ttl: float = 60):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._loaded_at: float | None = None
+        self.switches: dict[int, SwitchNode] = {}
+        self.ports: dict[int, PortNode] = {}
+        self.interfaces: dict[int, InterfaceNode] = {}
+        # Endpoints of every connection, in the order a peer is looked for: interfaces first
+        self.connections: dict[int, list[Endpoint]] = {}
+        # L2 graph built from the above on the first path query, dropped on every change
+        self._adjacency: dict[Node, list[Node]] | None = None
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _load(self, db: Session):
+        switches = {
+            switch_id: SwitchNode(switch_id, name, num_row, num_col)
+            for switch_id, name, num_row, num_col in db.query(Switch.id, Switch.name, Switch.num_row, Switch.num_col).all()
+        }
+        ports = {}
+        for port_id, switch_id, phy_row, phy_col, tag, conn_id in (
+            db.query(SwitchPort.id, SwitchPort.switch_id, SwitchPort.phy_row, SwitchPort.phy_col, SwitchPort.tag, SwitchPort.conn_id)
+              .order_by(SwitchPort.id)
+              .all()
+        ):
+            ports[port_id] = PortNode(port_id, switch_id, phy_row, phy_col, tag, conn_id)
+            if switch_id in switches:
+                switches[switch_id].port_ids.append(port_id)
+        interfaces = {
+            row[0]: InterfaceNode(*row)
+            for row in (
+                db.query(ServerInterface.id, ServerInterface.server_id, Server.host, ServerInterface.interface,
+                         ServerInterface.manufacturer, ServerInterface.pci_address, ServerInterface.conn_id)
+                  .join(Server, ServerInterface.server_id == Server.id)
+                  .order_by(ServerInterface.id)
+                  .all()
+            )
+        }
+        connections = {}
+        for interface in interfaces.values():
+            if interface.conn_id:
+                connections.setdefault(interface.conn_id, []).append(("interface", interface.id))
+        for port in ports.values():
+            if port.conn_id:
+                connections.setdefault(port.conn_id, []).append(("switch_port", port.id))
+        self.switches, self.ports, self.interfaces, self.connections = switches, ports, interfaces, connections
+        self._adjacency = None
+        self._loaded_at = time.monotonic()
+
+    @contextmanager
+    def view(self, db: Session):
+        """
+        Lock the index for reading, (re)loading it first if it is missing, invalidated or expired.
+        """
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._load(db)
+            yield self
+
+    def _node(self, endpoint: Endpoint) -> PortNode | InterfaceNode | None:
+        kind, node_id = endpoint
+        return self.interfaces.get(node_id) if kind == "interface" else self.ports.get(node_id)
+
+    def removeConnection(self, conn_id: int):
+        """
+        Drop a deleted connection, its endpoints become unconnected.
+        """
+        with self._lock:
+            self._adjacency = None
+            for endpoint in self.connections.pop(conn_id, []):
+                node = self._node(endpoint)
+                if node is not None:
+                    node.conn_id = None
+
+    def setConnection(self, conn_id: int, endpoints: list[Endpoint]):
+        """
+        Record a new connection between the endpoints, the connections they had before must have been removed.
+        """
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            nodes = [self._node(endpoint) for endpoint in endpoints]
+            if any(node is None for node in nodes):
+                # Created after the index was loaded, read everything again on the next access
+                self._loaded_at = None
+                return
+            for node in nodes:
+                node.conn_id = conn_id
+            self._adjacency = None
+            self.connections[conn_id] = sorted(endpoints, key=lambda endpoint: endpoint[0] != "interface")
+
+    def peer(self, endpoint: Endpoint) -> tuple[str, PortNode | InterfaceNode] | None:
+        """
+        The other end of the connection of the endpoint, an interface if there is one, None if unconnected.
+        """
+        node = self._node(endpoint)
+        if node is None or not node.conn_id:
+            return None
+        for other in self.connections.get(node.conn_id, []):
+            if other != endpoint:
+                peer = self._node(other)
+                if peer is not None:
+                    return other[0], peer
+        return None
+
+    def portNumber(self, port: PortNode) -> int:
+        # Ports are numbered column by column, from 1
+        return port.phy_col * self.switches[port.switch_id].num_row + port.phy_row + 1
+
+    def adjacency(self) -> dict[Node, list[Node]]:
+        """
+        Neighbours of every node: the other endpoints of a connection, and a switch and its ports
+        (the hop through the switch). Server interfaces are leaves, a server does not forward.
+        """
+        if self._adjacency is None:
+            adjacency: dict[Node, list[Node]] = {}
+            for endpoints in self.connections.values():
+                for endpoint in endpoints:
+                    adjacency.setdefault(endpoint, []).extend(other for other in endpoints if other != endpoint)
+            for port in self.ports.values():
+                # Unconnected ports are dead ends, leave them out
+                if port.conn_id and port.switch_id in self.switches:
+                    adjacency.setdefault(("switch_port", port.id), []).append(("switch", port.switch_id))
+                    adjacency.setdefault(("switch", port.switch_id), []).append(("switch_port", port.id))
+            self._adjacency = adjacency
+        return self._adjacency
+
+    def serverInterfaces(self, server_id: int) -> list[Node]:
+        return [("interface", interface.id) for interface in self.interfaces.values() if interface.server_id == server_id]
+
+    def shortestPath(self, sources: list[Node], targets: list[Node]) -> list[Node] | None:
+        """
+        Shortest path from any of the sources to any of the targets (breadth-first), None if they are not connected.
+        """
+        adjacency = self.adjacency()
+        targets = set(targets)
+        previous: dict[Node, Node | None] = {source: None for source in sources}
+        queue = deque(sources)
+        while queue:
+            node = queue.popleft()
+            if node in targets:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = previous[node]
+                return path[::-1]
+            for neighbour in adjacency.get(node, []):
+                if neighbour not in previous:
+                    previous[neighbour] = node
+                    queue.append(neighbour)
+        return None
+
+    def reachable(self, switch_id: int) -> tuple[set[int], set[int]]:
+        """
+        Switches and servers reachable from the switch, through cables and other switches.
+        """
+        adjacency = self.adjacency()
+        start = ("switch", switch_id)
+        seen = {start}
+        queue = deque([start])
+        switch_ids, server_ids = set(), set()
+        while queue:
+            kind, node_id = queue.popleft()
+            if kind == "switch":
+                switch_ids.add(node_id)
+            elif kind == "interface":
+                server_ids.add(self.interfaces[node_id].server_id)
+            for neighbour in adjacency.get((kind, node_id), []):
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    queue.append(neighbour)
+        switch_ids.discard(switch_id)
+        return switch_ids, server_ids
+
+# Shared by the API handlers of this process
+topology = TopologyIndex()
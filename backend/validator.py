@@ -1,12 +1,79 @@
 from typing import Optional
-from fastapi import Depends, Cookie
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+from fastapi import Depends, Cookie, Header, status
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from fastapi import HTTPException
 
-from app.database import get_db, User
+from app.database import get_db, User, Server
 from app.api.auth import SECRET_KEY, ALGORITHM
 
+class PrincipalCache:
+    """
+    Users resolved from access tokens, keyed by the subject and the issue time of the token, so a
+    new login is always read from the database. Entries are detached snapshots of the user columns,
+    merged into the session of the request without a query; they expire after `ttl` seconds and the
+    least recently used one is dropped beyond `max_size`.
+    The user endpoints of this process invalidate the entries of the users they change, changes made
+    by another API worker are seen once the entry expires. The rights of a cached admin are read again
+    on every request though, a revocation must not wait for the expiry.
+    """
+    def __init__(self, ttl: float = 30, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple[str, Optional[int]], tuple[float, User]] = OrderedDict()
+        # Counters for observability
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple[str, Optional[int]]) -> Optional[User]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple[str, Optional[int]], user: User):
+        # A clean detached copy, the instance of the request session stays where it is
+        snapshot = User(**{attr.key: getattr(user, attr.key) for attr in User.__mapper__.column_attrs})
+        make_transient_to_detached(snapshot)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), snapshot)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        """
+        Forget every token of the user, call it after committing a change to the user.
+        """
+        with self._lock:
+            for key in [key for key, (_, user) in self._entries.items() if user.id == user_id]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+# Shared by the API handlers of this process
+principals = PrincipalCache()
+
 async def getUser(
     access_token: Optional[str] = Cookie(None),
     db: Session = Depends(get_db)
@@ -23,7 +90,25 @@ async def getUser(
             return None
     except JWTError:
         return None
-    return db.query(User).filter(User.username == username).first()
+    # Tokens issued before iat was added share the None key of their user
+    key = (username, payload.get("iat"))
+    cached = principals.get(key)
+    if cached is not None:
+        user = db.merge(cached, load=False)
+        if cached.is_admin:
+            # Another worker may have revoked the rights since the entry was cached, an admin is
+            # only trusted after reading them again (one primary key lookup)
+            fresh = db.query(User.is_admin, User.status).filter(User.id == user.id).first()
+            if fresh is None:
+                principals.invalidate(user.id)
+                return None
+            set_committed_value(user, "is_admin", fresh.is_admin)
+            set_committed_value(user, "status", fresh.status)
+        return user
+    user = db.query(User).filter(User.username == username).first()
+    if user:
+        principals.put(key, user)
+    return user
 
 async def getUserAdmin(
     user: Optional[User] = Depends(getUser)
@@ -35,3 +120,21 @@ async def getUserAdmin(
             headers={"WWW-Authenticate": "Bearer"},
         )
     return user
+
+def hashAgentToken(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+async def getAgentServer(
+    authorization: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+) -> Server:
+    """
+    Authenticate a push agent by the `Authorization: Bearer <token>` header, returns its server.
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Missing agent token")
+    server = db.query(Server).filter(Server.agent_token_hash == hashAgentToken(token.strip())).first()
+    if not server:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Invalid agent token")
+    return server